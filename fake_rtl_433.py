@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# A stand-in for rtl_433 that writes realistic -F json output for simulated
+# sensors, for load and stress testing without radios. Give its path as
+# rtl_path and it is run like the real thing; the rtl_433 options it is
+# passed are ignored. Its own options can also be set with FAKE_RTL_433_*
+# environment variables, as the logger only passes -R and -F.
+#
+#   FAKE_RTL_433_SENSORS=200 FAKE_RTL_433_RATE=50 ./fake_rtl_433.py -F json
+#
+# Ciarán Mooney 2017
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+def _wg_pb12v1(sensor, state, rng):
+    ''' The original sensor, temperature only plus the raw io bits.
+    '''
+    return {"model" : "WG-PB12V1", "id" : sensor,
+            "temperature_C" : round(state['temperature'], 1),
+            "io" : format(rng.getrandbits(48), '048b')}
+
+def _tx141thbv2(sensor, state, rng):
+    ''' A temperature and humidity sensor with a channel and battery flag.
+    '''
+    return {"model" : "LaCrosse-TX141THBv2", "id" : sensor,
+            "channel" : sensor % 3, "battery" : state['battery'],
+            "temperature_C" : round(state['temperature'], 1),
+            "humidity" : int(state['humidity']), "test" : "No"}
+
+def _acurite_tower(sensor, state, rng):
+    ''' Newer style output with battery_ok and extra fields.
+    '''
+    return {"model" : "Acurite-Tower", "id" : sensor, "channel" : "A",
+            "battery_ok" : int(state['battery'] == "OK"),
+            "temperature_C" : round(state['temperature'], 1),
+            "humidity" : int(state['humidity']), "mic" : "CHECKSUM"}
+
+def _thgr122n(sensor, state, rng):
+    ''' An Oregon Scientific sensor.
+    '''
+    return {"model" : "THGR122N", "id" : sensor, "channel" : 1 + sensor % 3,
+            "battery" : state['battery'],
+            "temperature_C" : round(state['temperature'], 2),
+            "humidity" : int(state['humidity'])}
+
+MODELS = (_wg_pb12v1, _tx141thbv2, _acurite_tower, _thgr122n)
+
+# Noise that the real rtl_433 writes to stderr.
+STDERR_NOISE = ("Found 1 device(s)\n",
+                "Tuned to 433.920MHz.\n",
+                "Detached kernel driver\n",
+                "rtlsdr_read_reg failed with -7\n",
+                "Allocating 15 zero-copy buffers\n")
+
+class fakeSensor(object):
+    ''' One simulated sensor, its readings drift slowly.
+    '''
+
+    def __init__(self, sensor, model, rng):
+        self.sensor = sensor
+        self.model = model
+        self.rng = rng
+        self.state = {'temperature' : rng.uniform(15, 25),
+                      'humidity' : rng.uniform(30, 70),
+                      'battery' : "OK"}
+
+    def reading(self):
+        ''' Returns the sensor's next reading, without the time field.
+        '''
+        self.state['temperature'] += self.rng.gauss(0, 0.05)
+        self.state['humidity'] = min(100, max(0, self.state['humidity']
+                                                  + self.rng.gauss(0, 0.2)))
+        if self.rng.random() < 0.001:
+            self.state['battery'] = "LOW"
+        return self.model(self.sensor, self.state, self.rng)
+
+def garble(line, rng):
+    ''' Returns line damaged the way a bad decode or a torn write is.
+    '''
+    if rng.random() < 0.5:
+        return line[:rng.randrange(1, len(line))] + "\n"
+    return "".join(chr(rng.randrange(32, 127)) for _ in range(20)) + "\n"
+
+def packets(sensors, rng, repeats):
+    ''' Yields the lines for one packet from a random sensor, repeated the
+        way cheap sensors send each packet several times.
+    '''
+    sensor = rng.choice(sensors)
+    reading = sensor.reading()
+    reading_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    line = json.dumps(dict({"time" : reading_time}, **reading)) + "\n"
+    for _ in range(repeats):
+        yield line
+
+def run(args, out=sys.stdout, err=sys.stderr):
+    ''' Writes packets at args.rate per second until args.count packets or
+        args.duration seconds, whichever comes first (0 is no limit).
+    '''
+    rng = random.Random(args.seed)
+    sensors = [fakeSensor(n, MODELS[n % len(MODELS)], rng)
+               for n in range(args.sensors)]
+    err.write(STDERR_NOISE[0])
+    err.flush()
+
+    start = time.monotonic()
+    sent = 0
+    while True:
+        elapsed = time.monotonic() - start
+        if args.duration and elapsed >= args.duration:
+            break
+        # Write everything that is due in one go, so high rates don't depend
+        # on how finely we can sleep.
+        due = int(elapsed * args.rate) + 1 if args.rate else sent + 1000
+        if args.count:
+            due = min(due, args.count)
+        lines = []
+        while sent < due:
+            for line in packets(sensors, rng, args.repeats):
+                if rng.random() < args.garble:
+                    line = garble(line, rng)
+                lines.append(line)
+            if rng.random() < args.stderr_noise:
+                err.write(rng.choice(STDERR_NOISE))
+            sent += 1
+        if lines:
+            out.write("".join(lines))
+            out.flush()
+            err.flush()
+        if args.count and sent >= args.count:
+            break
+        if args.rate:
+            time.sleep(max(0, (sent / args.rate) - (time.monotonic() - start)))
+
+def env(name, default, kind):
+    ''' Returns FAKE_RTL_433_<name> from the environment, or default.
+    '''
+    return kind(os.environ.get('FAKE_RTL_433_' + name, default))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stand-in for rtl_433.')
+    parser.add_argument('-R', action='append', help="ignored")
+    parser.add_argument('-F', help="ignored, output is always json")
+    parser.add_argument('--sensors', type=int, default=env('SENSORS', 10, int))
+    parser.add_argument('--rate', type=float, default=env('RATE', 1, float),
+                        help="packets per second, 0 for flat out")
+    parser.add_argument('--repeats', type=int, default=env('REPEATS', 1, int),
+                        help="lines per packet")
+    parser.add_argument('--garble', type=float,
+                        default=env('GARBLE', 0, float),
+                        help="fraction of lines to damage")
+    parser.add_argument('--stderr-noise', type=float,
+                        default=env('STDERR_NOISE', 0, float),
+                        help="chance of a stderr line per packet")
+    parser.add_argument('--count', type=int, default=env('COUNT', 0, int),
+                        help="packets to send, 0 for no limit")
+    parser.add_argument('--duration', type=float,
+                        default=env('DURATION', 0, float),
+                        help="seconds to run for, 0 for no limit")
+    parser.add_argument('--seed', type=int, default=env('SEED', 0, int))
+    args, unknown = parser.parse_known_args(argv)
+    try:
+        run(args)
+    except (BrokenPipeError, KeyboardInterrupt):
+        # The logger went away.
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -11,15 +11,35 @@
 # Notes 
 # * The "model" field in the JSON output is the device name
 
-import subprocess
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
 from datetime import datetime
+import io
+import subprocess
 import threading
 import queue as Queue
 import sqlite3 as sq
 import json
 import os
+import re
+import resource
+import struct
 import sys
 import time
+import urllib.parse
+
+import rtl_433_capture
+import rtl_433_latest
+import rtl_433_metrics
+import rtl_433_parse
+import rtl_433_query
+
+# Longest the consumers block with nothing buffered before checking for EOF,
+# stderr and the stats, in seconds.
+IDLE_TIMEOUT = 0.25
 
 class alreadyRunningError(Exception):
     ''' Class to handle when the programme is already running
@@ -32,30 +52,120 @@ class asyncFileReader(threading.Thread):
         be consumed in another thread.
     '''
 
-    def __init__(self, fd, queue, log_file=None):
+    def __init__(self, fd, queue, log_file=None, stamp=False, receiver=None,
+                 chunk_size=None):
+        ''' If stamp is True, (time.monotonic(), line, receiver) tuples are
+            put on the queue instead of bare lines, so the consumer can tell
+            how long a line has been waiting and which receiver it is from.
+
+            Every line is also written to log_file, a
+            rtl_433_capture.captureWriter, which several readers can share.
+            If log_file is a path the reader makes its own, and closes it
+            at EOF.
+
+            With chunk_size, fd is read with os.readv into a buffer of that
+            many bytes instead of a line at a time, and each read's complete
+            lines are put on the queue as one list in place of line. A read
+            returns whatever the pipe has, so lines don't wait for the
+            buffer to fill. fd must then have a fileno() and nothing else
+            may read from it.
+        '''
         assert isinstance(queue, Queue.Queue)
         assert callable(fd.readline)
         threading.Thread.__init__(self)
         self._fd = fd
         self._queue = queue
+        self._own_log = isinstance(log_file, str)
+        if self._own_log:
+            log_file = rtl_433_capture.captureWriter(log_file)
         self._log = log_file
+        self._stamp = stamp
+        self._receiver = receiver
+        self._chunk_size = chunk_size
         self._stop_event = threading.Event()
+        # time.monotonic() of the first line and of EOF, or None.
+        self.first_read = None
+        self.ended = None
 
     def run(self):
         ''' The body of the tread: read lines and put them on the queue.
         '''
+        if self._chunk_size is not None:
+            self._readChunks()
+        else:
+            self._readLines()
+        if self._own_log:
+            self._log.close()
+        self.ended = time.monotonic()
+
+    def _put(self, line):
+        if self._stamp:
+            self._queue.put((time.monotonic(), line, self._receiver))
+        else:
+            self._queue.put(line)
+
+    def _readLines(self):
         # print("Stop Flag: ", self._stop_event.is_set())
-        for line in iter(self._fd.readline, ''):
+        # Pipes give bytes, so EOF is b'' rather than ''.
+        while True:
+            line = self._fd.readline()
+            if not line:
+                break
+            if self.first_read is None:
+                self.first_read = time.monotonic()
             #print("Stop Flag: ", self._stop_event.is_set())
-            if self._log != None:
-                with open(self._log, 'w') as log:
-                    log.write(line)
-                    log.close()
+            if self._log is not None:
+                self._log.write(line)
             if self._stop_event.is_set():
                 #print('Stop flag set, breaking')
                 break
-            self._queue.put(line)
-        
+            self._put(line)
+
+    def _readChunks(self):
+        ''' Reads into one buffer, reused for every read, and frames the
+            lines in it. The tail of a line that is still being written
+            is moved to the front for the next read to finish. A line
+            longer than the buffer grows it.
+        '''
+        fileno = self._fd.fileno()
+        buffer = bytearray(self._chunk_size)
+        view = memoryview(buffer)
+        filled = 0
+        while True:
+            if filled == len(buffer):
+                view.release()
+                buffer.extend(bytes(len(buffer)))
+                view = memoryview(buffer)
+            read = os.readv(fileno, [view[filled:]])
+            end = filled + read
+            if read:
+                lines = []
+                start = 0
+                newline = buffer.find(b'\n', filled, end)
+                while newline >= 0:
+                    lines.append(bytes(view[start:newline + 1]))
+                    start = newline + 1
+                    newline = buffer.find(b'\n', start, end)
+            else:
+                # A last line with no newline, as readline gives it.
+                start = end
+                lines = [bytes(view[:end])] if end else []
+            if lines:
+                if self.first_read is None:
+                    self.first_read = time.monotonic()
+                if self._log is not None:
+                    # The complete lines, as they came, in one write.
+                    self._log.write(bytes(view[:start]))
+                if self._stop_event.is_set():
+                    break
+                self._put(lines)
+            if not read or self._stop_event.is_set():
+                break
+            filled = end - start
+            if start:
+                view[:filled] = buffer[start:end]
+        view.release()
+
     def stop(self):
         ''' Raises stop event so thread can be killed.
         '''
@@ -67,20 +177,224 @@ class asyncFileReader(threading.Thread):
         '''
         return not self.is_alive() and self._queue.empty()
 
+def epochMillis():
+    ''' Returns the current time as integer milliseconds since the epoch,
+        which is how sensor_data.date is stored.
+    '''
+    return int(time.time() * 1000)
+
+def monotonicToMillis(read_time):
+    ''' Returns the epochMillis() at which time.monotonic() was read_time.
+    '''
+    return epochMillis() - int((time.monotonic() - read_time) * 1000)
+
+def millisToMonotonic(millis):
+    ''' Returns the time.monotonic() at which epochMillis() was millis.
+    '''
+    return time.monotonic() - (epochMillis() - millis) / 1000
+
+def _key(key):
+    ''' Field getter for a key that is stored as it is.
+    '''
+    return lambda json_data: json_data.get(key)
+
+def _temperature_C(json_data):
+    ''' Field getter for temperature, converting models that report in
+        Fahrenheit.
+    '''
+    if 'temperature_C' in json_data:
+        return json_data['temperature_C']
+    if 'temperature_F' in json_data:
+        return (json_data['temperature_F'] - 32) * 5 / 9
+    return None
+
+def packIO(io):
+    ''' Packs an rtl_433 io bit string, e.g. "1100", into bytes: its length
+        in bits, see rtl_433_query.IO_LENGTH, then the bits, eight to a
+        byte. The 48 bits of a WG-PB12V1 take 8 bytes rather than 48.
+        Anything that isn't a bit string, such as None, '' or hex, is
+        returned as it is. rtl_433_query.unpackIO() reverses it.
+    '''
+    if (not isinstance(io, str) or not io or len(io) > 0xffff
+            or io.strip('01')):
+        return io
+    return (rtl_433_query.IO_LENGTH.pack(len(io))
+            + int(io, 2).to_bytes((len(io) + 7) // 8, 'big'))
+
+def _io(json_data):
+    ''' Field getter for io, packed, see packIO().
+    '''
+    return packIO(json_data.get('io'))
+
+def _battery(json_data):
+    ''' Field getter for the battery flag, 1 for OK and 0 for low. Older
+        rtl_433 reports battery "OK"/"LOW", newer battery_ok 1/0.
+    '''
+    if 'battery_ok' in json_data:
+        return int(json_data['battery_ok'])
+    if 'battery' in json_data:
+        return int(json_data['battery'] == 'OK')
+    return None
+
+# The typed columns of sensor_data that are filled from the rtl_433 JSON, in
+# the order they are written. Each is (getter, keys), where keys are the JSON
+# keys the getter uses up. Keys that no column uses go into the extra column.
+DEFAULT_FIELDS = collections.OrderedDict([
+    ('sensorID', (_key('id'), ('id',))),
+    ('temperature_C', (_temperature_C, ('temperature_C', 'temperature_F'))),
+    ('io', (_io, ('io',))),
+    ('model', (_key('model'), ('model',))),
+    ('channel', (_key('channel'), ('channel',))),
+    ('humidity', (_key('humidity'), ('humidity',))),
+    ('battery', (_battery, ('battery', 'battery_ok'))),
+    ('receiver', (_key('receiver'), ('receiver',))),
+    ])
+
+# Models whose JSON doesn't fit DEFAULT_FIELDS. Maps the model name to a dict
+# of {column : (getter, keys)} that replace the defaults for that model.
+MODEL_FIELDS = {}
+
+# JSON keys that are never stored. time is rtl_433's timestamp, which is
+# superseded by the date column.
+SKIP_KEYS = ('time',)
+
+def compileExtractor(fields):
+    ''' Returns a function that turns one reading's json_data into a tuple
+            (sensorID, temperature_C, io, model, channel, humidity, battery,
+             receiver, extra)
+        using the getters in fields. extra is any remaining keys as JSON,
+        or None.
+    '''
+    getters = tuple(getter for getter, keys in fields.values())
+    used = frozenset(key for getter, keys in fields.values() for key in keys)
+    used = used.union(SKIP_KEYS)
+
+    def extract(json_data):
+        row = [getter(json_data) for getter in getters]
+        extra = {key : value for key, value in json_data.items()
+                 if key not in used}
+        row.append(json.dumps(extra, sort_keys=True) if extra else None)
+        return tuple(row)
+    return extract
+
+class fieldExtractors(object):
+    ''' Registry of per-model extractors, compiled once so that each reading
+        only costs a dict lookup on its model to find the right one.
+    '''
+
+    def __init__(self, model_fields=None):
+        if model_fields is None:
+            model_fields = MODEL_FIELDS
+        self._default = compileExtractor(DEFAULT_FIELDS)
+        self._models = {}
+        for model, overrides in model_fields.items():
+            fields = collections.OrderedDict(DEFAULT_FIELDS)
+            fields.update(overrides)
+            self._models[model] = compileExtractor(fields)
+
+    def extract(self, json_data):
+        ''' Returns the typed columns for json_data, see compileExtractor.
+        '''
+        return self._models.get(json_data.get('model'),
+                                self._default)(json_data)
+
 class initDatabase(object):
     ''' Initialise database with the filelocation, db_file. If no database is
         present, then try and create it.
 
         Database Schema
         ---
-        xxx
+        sensor_data (id INTEGER PRIMARY KEY, date integer, sensorID int,
+                     temperature_C float, io text, model text, channel int,
+                     humidity float, battery int, extra text, receiver text)
+        index sensor_data_sensor_date on (sensorID, date)
+
+        io is stored as a BLOB, see packIO(). Rows written before that have
+        text, which pack_io_step() converts.
+
+        id is sqlite's rowid, so ids are handed out by the INSERT itself.
+        Databases from before this, which kept the next id in a current_id
+        table, are converted by migrate() when they are opened.
+
+        date is milliseconds since the epoch, UTC, see epochMillis(). Older
+        databases stored str(datetime.now()), which rebuild_step()
+        rewrites.
+
+        rollup_minute, rollup_hour and rollup_day (sensorID int,
+                     bucket integer, count int, total float, minimum float,
+                     maximum float)
+        rollup_state (incremental_from integer, backfilled_to integer)
+
+        The rollups hold temperature_C aggregates per sensorID, bucket is
+        the start of the minute, hour or UTC day in epoch milliseconds.
+        They are updated in the same transaction as the rows they cover.
+        Rows with ids below incremental_from were written before the
+        rollups existed and are added by backfill_rollups().
+
+        Every connection is set up with the pragmas given to __init__. The
+        default is WAL journal mode, so readers, see readPool, don't block
+        the writer and the writer doesn't block them. New databases are
+        created with auto_vacuum=INCREMENTAL, so the space freed by prune()
+        can be handed back a few pages at a time by incremental_vacuum().
+        Older ones only change on a full VACUUM, see rtl_433_admin.py.
+
+        Readings from any rtl_433 model can be stored. The common fields
+        have their own columns, see DEFAULT_FIELDS, and everything else is
+        kept in extra as a JSON object. receiver is the name of the
+        receiver a row was heard on, see startReceivers(), or NULL. Columns
+        missing from an older database are added when it is opened.
+
+        The schema's version is kept in PRAGMA user_version, see
+        MIGRATIONS. Databases from before it are 0.
     '''
 
-    def __init__(self, sq, db_path):
-        '''
+    # The migrations to SCHEMA_VERSION, in order, as (version, method,
+    # online). Offline ones only change the schema and run when the
+    # database is opened. Online ones rewrite rows and are done a chunk at
+    # a time, see migrate_step(), so the logger keeps writing while they
+    # run. Each is safe to run on a database that doesn't need it, and
+    # each chunk is a transaction that reads its progress after taking the
+    # write lock, so two processes can migrate the same database at once.
+    MIGRATIONS = ((1, 'migrate', False),
+                  (2, 'add_columns', False),
+                  (3, 'create_rollups', False),
+                  (4, 'rebuild_step', True),
+                  (5, 'backfill_step', True),
+                  (6, 'pack_io_step', True))
+    SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+    # Columns added to sensor_data after the original five.
+    EXTRA_COLUMNS = (('model', 'text'), ('channel', 'int'),
+                     ('humidity', 'float'), ('battery', 'int'),
+                     ('extra', 'text'), ('receiver', 'text'))
+
+    def __init__(self, sq, db_path, extractors=None, journal_mode='wal',
+                 synchronous='normal', cache_size=-2000, mmap_size=0,
+                 busy_timeout=5000, auto_vacuum='incremental'):
+        ''' extractors is the fieldExtractors used to turn JSON into rows,
+            a default one is made if it isn't given.
+
+            The rest are sqlite pragmas applied by connect(). cache_size is
+            in pages, or KiB if negative, mmap_size in bytes and
+            busy_timeout in milliseconds. Pass None to leave one at
+            sqlite's default.
         '''
         self.db_path = db_path
         self.sq = sq
+        # busy_timeout goes first so that changing the journal mode waits
+        # for other connections rather than failing, and auto_vacuum before
+        # anything that could write the first page.
+        self.pragmas = collections.OrderedDict([
+                            ('busy_timeout', busy_timeout),
+                            ('auto_vacuum', auto_vacuum),
+                            ('journal_mode', journal_mode),
+                            ('synchronous', synchronous),
+                            ('cache_size', cache_size),
+                            ('mmap_size', mmap_size)])
+        if extractors is None:
+            extractors = fieldExtractors()
+        self.extractors = extractors
+        self.db = None
         self.connect()
         #except sq.OperationalError:
         #    print("No directory for database")
@@ -93,20 +407,414 @@ class initDatabase(object):
 
         if table_exists == None:
             self.create_tables()
-        
-        self.max_id = self.get_max_id()
+        self.version = self.schema_version()
+        self.migrated = False
+        self._packed_to = 0
+        self._migrate(None)
+        # The connection may not be used by the thread that opened it, see
+        # asyncIngest().
+        self.close()
+
+    SENSOR_DATA = '''CREATE TABLE {}
+                     (id INTEGER PRIMARY KEY, date integer, sensorID int, 
+                      temperature_C float, io text, model text,
+                      channel int, humidity float, battery int,
+                      extra text, receiver text)'''
+
+    # Turns the text dates of older databases, local time from
+    # str(datetime.now()), into UTC epoch milliseconds.
+    TEXT_TO_MILLIS = '''CASE WHEN typeof(date) = 'text'
+                        THEN CAST(ROUND((julianday(date, 'utc') - 2440587.5)
+                                        * 86400000) AS INTEGER)
+                        ELSE date END'''
+
+    # The index every query uses, on sensor_data or a table being built to
+    # replace it.
+    SENSOR_DATE_INDEX = '''CREATE INDEX sensor_data_sensor_date
+                           ON {} (sensorID, date)'''
 
     def create_tables(self):
-        ''' Creates a database with the tables described above.
+        ''' Creates a database with the tables described above, at
+            SCHEMA_VERSION.
+        '''
+        self.connect()
+        self.cur.execute('BEGIN IMMEDIATE')
+        # Another process may have got there first.
+        if 'sensor_data' not in self._tables():
+            self.cur.execute(self.SENSOR_DATA.format('sensor_data'))
+            self.cur.execute(self.SENSOR_DATE_INDEX.format('sensor_data'))
+            self.cur.execute('PRAGMA user_version = {:d}'
+                             .format(self.SCHEMA_VERSION))
+        self.db.commit()
+        self.close()
+        self.create_rollups()
+
+    def schema_version(self):
+        ''' Returns the database's PRAGMA user_version.
         '''
         self.connect()
-        self.cur.execute('''CREATE TABLE sensor_data  
-                         (id integer, date text, sensorID int, 
-                          temperature_C float, io text)''')
+        version = self.cur.execute('PRAGMA user_version').fetchone()[0]
+        self.close()
+        return version
+
+    def _migrate(self, chunk_size):
+        ''' Runs the MIGRATIONS after self.version, in order, up to the
+            first online one that isn't finished by a chunk of chunk_size
+            rows, or the first online one at all if chunk_size is None.
+            Returns True once the database is at SCHEMA_VERSION.
+        '''
+        for version, method, online in self.MIGRATIONS:
+            if version <= self.version:
+                continue
+            if online:
+                if chunk_size is None:
+                    return False
+                if self.db is None:
+                    self.connect()
+                if not getattr(self, method)(chunk_size):
+                    return False
+            else:
+                self.close()
+                getattr(self, method)()
+            self._set_version(version)
+        self.migrated = True
+        return True
+
+    def _set_version(self, version):
+        ''' Records that the migrations up to version are done, unless
+            another process has already done more.
+        '''
+        if self.db is None:
+            self.connect()
+        with self.db:
+            self.cur.execute('BEGIN IMMEDIATE')
+            current = self.cur.execute('PRAGMA user_version').fetchone()[0]
+            if current < version:
+                self.cur.execute('PRAGMA user_version = {:d}'.format(version))
+        self.version = max(current, version)
+
+    def migrate_step(self, chunk_size=5000):
+        ''' Does a chunk, of at most chunk_size rows, of the online
+            migrations still to do and returns True once there are none
+            left. batchWriter calls it after each commit until then, on
+            the writer's connection, so it doesn't wait on the writer.
+        '''
+        if self.migrated:
+            return True
+        return self._migrate(chunk_size)
+
+    # Rollup tables and the length of their buckets in milliseconds.
+    ROLLUPS = (('rollup_minute', 60000), ('rollup_hour', 3600000),
+               ('rollup_day', 86400000))
+
+    def create_rollups(self):
+        ''' Creates the rollup tables if they are missing. Rows already in
+            sensor_data are left for backfill_rollups().
+        '''
+        self.connect()
+        self.cur.execute('BEGIN IMMEDIATE')
+        for table, period in self.ROLLUPS:
+            self.cur.execute('''CREATE TABLE IF NOT EXISTS {}
+                                (sensorID int, bucket integer, count int,
+                                 total float, minimum float, maximum float,
+                                 PRIMARY KEY (sensorID, bucket))'''
+                             .format(table))
+        self.cur.execute('''CREATE TABLE IF NOT EXISTS rollup_state
+                            (incremental_from integer,
+                             backfilled_to integer)''')
+        # By rowid, which is id apart from in a database from before id was
+        # the rowid. rebuild_step() moves them to its ids.
+        self.cur.execute('''INSERT INTO rollup_state
+                            SELECT COALESCE(MAX(rowid) + 1, 0),
+                                   COALESCE(MIN(rowid) - 1, 0)
+                            FROM sensor_data
+                            WHERE NOT EXISTS (SELECT * FROM rollup_state)''')
         self.db.commit()
-        self.cur.execute('CREATE TABLE current_id (max_id int)')
+        self.close()
+
+    def _update_rollups(self, records):
+        ''' Adds (date, sensorID, temperature_C) records to the rollups.
+            Must be called inside the transaction that writes them.
+        '''
+        for table, period in self.ROLLUPS:
+            buckets = {}
+            for date, sensor, temperature in records:
+                if sensor is None or temperature is None:
+                    continue
+                key = (sensor, date - date % period)
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = [1, temperature, temperature, temperature]
+                else:
+                    bucket[0] += 1
+                    bucket[1] += temperature
+                    bucket[2] = min(bucket[2], temperature)
+                    bucket[3] = max(bucket[3], temperature)
+            if not buckets:
+                continue
+
+            self.cur.executemany('''INSERT OR IGNORE INTO {}
+                                    VALUES (?, ?, 0, 0.0, ?, ?)'''
+                                 .format(table),
+                                 [key + (bucket[2], bucket[3])
+                                  for key, bucket in buckets.items()])
+            self.cur.executemany('''UPDATE {} SET count = count + ?,
+                                        total = total + ?,
+                                        minimum = min(minimum, ?),
+                                        maximum = max(maximum, ?)
+                                    WHERE sensorID = ? AND bucket = ?'''
+                                 .format(table),
+                                 [tuple(bucket) + key
+                                  for key, bucket in buckets.items()])
+
+    def _backfill_chunk(self, chunk_size):
+        ''' Adds the next chunk_size ids to the rollups, see
+            backfill_rollups(), and returns the last one, or None if they
+            are done.
+        '''
+        with self.db:
+            self.cur.execute('BEGIN IMMEDIATE')
+            self.cur.execute('SELECT * FROM rollup_state')
+            incremental_from, backfilled_to = self.cur.fetchone()
+            if backfilled_to + 1 >= incremental_from:
+                return None
+            last = min(backfilled_to + chunk_size, incremental_from - 1)
+            self.cur.execute('''SELECT date, sensorID, temperature_C
+                                FROM sensor_data
+                                WHERE id > ? AND id <= ?''',
+                             (backfilled_to, last))
+            self._update_rollups(self.cur.fetchall())
+            self.cur.execute('UPDATE rollup_state SET backfilled_to = ?',
+                             (last,))
+        return last
+
+    def backfill_rollups(self, chunk_size=50000):
+        ''' Adds rows written before the rollups existed to them,
+            chunk_size rows per transaction so the logger can keep writing
+            in between. Progress is saved after each chunk, so it can be
+            stopped and started again. Yields the last id done after each
+            chunk.
+        '''
+        self.connect()
+        while True:
+            last = self._backfill_chunk(chunk_size)
+            if last is None:
+                break
+            yield last
+        self.close()
+
+    def backfill_step(self, chunk_size):
+        ''' Online migration, a chunk of backfill_rollups(). Returns True
+            once it is done.
+        '''
+        return self._backfill_chunk(chunk_size) is None
+
+    def pack_io(self, chunk_size=50000):
+        ''' Packs the io of rows written before io was packed, see packIO(),
+            chunk_size rows per transaction so the logger can keep writing
+            in between. It can be stopped and started again. Yields the
+            last id done after each chunk.
+
+            The space is only handed back to the file system by a VACUUM,
+            or incremental_vacuum() for the pages that end up empty.
+        '''
+        self.connect()
+        last = 0
+        while True:
+            last = self._pack_io_chunk(last, chunk_size)
+            if last is None:
+                break
+            yield last
+        self.close()
+
+    def _pack_io_chunk(self, after, chunk_size):
+        ''' Packs the io of up to chunk_size rows with ids after after and
+            returns the last id, or None if there were none.
+        '''
+        with self.db:
+            self.cur.execute('BEGIN IMMEDIATE')
+            # The rows packIO() packs.
+            self.cur.execute('''SELECT id, io FROM sensor_data
+                                WHERE id > ? AND typeof(io) = 'text'
+                                AND io != '' AND length(io) <= 65535
+                                AND io NOT GLOB '*[^01]*'
+                                ORDER BY id LIMIT ?''', (after, chunk_size))
+            rows = self.cur.fetchall()
+            if not rows:
+                return None
+            self.cur.executemany('UPDATE sensor_data SET io = ? WHERE id = ?',
+                                 [(packIO(io), id) for id, io in rows])
+        return rows[-1][0]
+
+    def pack_io_step(self, chunk_size):
+        ''' Online migration, a chunk of pack_io(). Returns True once it is
+            done.
+        '''
+        last = self._pack_io_chunk(self._packed_to, chunk_size)
+        if last is None:
+            return True
+        self._packed_to = last
+        return False
+
+    # Dates written into a text date column while it is being rebuilt are
+    # stored as digits.
+    DATE_TO_MILLIS = '''CASE WHEN typeof(date) != 'text' THEN date
+                        WHEN date NOT GLOB '*[^0-9]*'
+                        THEN CAST(date AS INTEGER)
+                        ELSE {} END'''.format(TEXT_TO_MILLIS)
+
+    # The next chunk of sensor_data for the table replacing it, with its
+    # rowid first. It is copied in rowid order, as id isn't the rowid in a
+    # database from before it was, and may be NULL or repeated.
+    COPY = '''SELECT rowid, id, {}, sensorID, temperature_C, pack_io(io),
+                     model, channel, humidity, battery, extra, receiver
+              FROM sensor_data WHERE rowid > ? ORDER BY rowid LIMIT ?'''
+
+    def _tables(self):
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        return set(row[0] for row in self.cur.fetchall())
+
+    def _needs_rebuild(self):
+        ''' True if sensor_data has text dates, no sensor_date index or an
+            id that isn't the rowid.
+        '''
+        self.cur.execute("PRAGMA table_info('sensor_data');")
+        columns = dict((column[1], (column[2].lower(), column[5]))
+                       for column in self.cur.fetchall())
+        self.cur.execute("PRAGMA index_list('sensor_data');")
+        indexes = set(row[1] for row in self.cur.fetchall())
+        return (columns['date'][0] != 'integer'
+                or columns['id'] != ('integer', 1)
+                or 'sensor_data_sensor_date' not in indexes)
+
+    def rebuild_step(self, chunk_size):
+        ''' Online migration of a sensor_data table with text dates, no
+            (sensorID, date) index, or from before id was the rowid, none
+            of which can be changed in place. Returns True once it is done.
+
+            sensor_data is copied a chunk at a time to sensor_data_new,
+            which has the current schema and index, converting dates and
+            packing io on the way. Rows the writer adds meanwhile are
+            copied too. Progress is kept in rebuild_state. Once it has
+            caught up, the tables are swapped in the same transaction as
+            the last chunk, and the old one emptied a chunk at a time and
+            dropped.
+
+            A row keeps its id unless an earlier one has it, which a crash
+            between the old per-row commits could do, or it has none, as
+            rows written to the old layout don't. Those are given ids after
+            the largest there was when the rebuild started. rollup_state,
+            which is by rowid until then, is moved to the new ids if any
+            row's id wasn't its rowid.
+        '''
+        with self.db:
+            self.cur.execute('BEGIN IMMEDIATE')
+            tables = self._tables()
+            if 'sensor_data_old' in tables:
+                self.cur.execute('''DELETE FROM sensor_data_old WHERE rowid IN (
+                                        SELECT rowid FROM sensor_data_old
+                                        LIMIT ?)''', (chunk_size,))
+                if self.cur.rowcount < chunk_size:
+                    self.cur.execute('DROP TABLE sensor_data_old')
+                    return True
+                return False
+
+            if 'sensor_data_new' not in tables:
+                if not self._needs_rebuild():
+                    return True
+                # Only one table can have the index's name.
+                self.cur.execute('DROP INDEX IF EXISTS sensor_data_sensor_date')
+                self.cur.execute(self.SENSOR_DATA.format('sensor_data_new'))
+                self.cur.execute(self.SENSOR_DATE_INDEX
+                                 .format('sensor_data_new'))
+                self.cur.execute('''CREATE TABLE rebuild_state
+                                    (copied integer, next_id integer,
+                                     rollups_from integer, moved int)''')
+                self.cur.execute('''INSERT INTO rebuild_state
+                                    SELECT COALESCE(MIN(rowid), 1) - 1,
+                                           COALESCE(MAX(id), 0) + 1, NULL, 0
+                                    FROM sensor_data''')
+                return False
+
+            self.cur.execute('SELECT * FROM rebuild_state')
+            copied, next_id, rollups_from, moved = self.cur.fetchone()
+            self.cur.execute('SELECT incremental_from FROM rollup_state')
+            incremental_from, = self.cur.fetchone()
+            self.cur.execute('SELECT MAX(id) FROM sensor_data_new')
+            top, = self.cur.fetchone()
+            self.cur.execute(self.COPY.format(self.DATE_TO_MILLIS),
+                             (copied, chunk_size))
+            rows = self.cur.fetchall()
+
+            ids = set()
+            records = []
+            for row in rows:
+                id = row[1]
+                # ids normally go up, so only one that doesn't can be taken.
+                if id is None or (top is not None and id <= top and (
+                        id in ids or self.cur.execute(
+                            'SELECT 1 FROM sensor_data_new WHERE id = ?',
+                            (id,)).fetchone() is not None)):
+                    id = next_id
+                    next_id += 1
+                if top is None or id > top:
+                    top = id
+                ids.add(id)
+                moved = moved or id != row[0]
+                # The first row whose rollups the writer kept up to date.
+                if rollups_from is None and row[0] >= incremental_from:
+                    rollups_from = id
+                records.append((id,) + row[2:])
+            self.cur.executemany('''INSERT INTO sensor_data_new
+                                    VALUES (?,?,?,?,?,?,?,?,?,?,?)''', records)
+
+            if len(rows) == chunk_size:
+                self.cur.execute('''UPDATE rebuild_state SET copied = ?,
+                                        next_id = ?, rollups_from = ?,
+                                        moved = ?''',
+                                 (rows[-1][0], next_id, rollups_from,
+                                  moved))
+                return False
+
+            if moved:
+                # Nothing has been backfilled, the dates were text.
+                if rollups_from is None:
+                    rollups_from = top + 1
+                self.cur.execute('''UPDATE rollup_state
+                                    SET incremental_from = ?,
+                                        backfilled_to = (
+                                            SELECT MIN(id) - 1
+                                            FROM sensor_data_new)''',
+                                 (rollups_from,))
+            self.cur.execute('DROP TABLE rebuild_state')
+            self.cur.execute('ALTER TABLE sensor_data '
+                             'RENAME TO sensor_data_old')
+            self.cur.execute('ALTER TABLE sensor_data_new '
+                             'RENAME TO sensor_data')
+        return False
+
+    def add_columns(self):
+        ''' Adds any of EXTRA_COLUMNS that sensor_data doesn't have yet.
+            Existing rows get NULL.
+        '''
+        self.connect()
+        self.cur.execute('BEGIN IMMEDIATE')
+        self.cur.execute("PRAGMA table_info('sensor_data');")
+        present = set(column[1] for column in self.cur.fetchall())
+        for name, kind in self.EXTRA_COLUMNS:
+            if name not in present:
+                self.cur.execute('ALTER TABLE sensor_data ADD COLUMN {} {}'
+                                 .format(name, kind))
         self.db.commit()
-        self.cur.execute('INSERT INTO current_id values (?)', (0,))
+        self.close()
+
+    def migrate(self):
+        ''' Drops the current_id table of a database from before id was the
+            rowid, which the writer no longer uses. Its rows are given
+            their ids by rebuild_step().
+        '''
+        self.connect()
+        self.cur.execute('DROP TABLE IF EXISTS current_id')
         self.db.commit()
         self.close()
 
@@ -114,78 +822,1101 @@ class initDatabase(object):
         ''' Re-wraps the sqlite3 database connect and cursor functions.
         '''
         self.db = self.sq.connect(self.db_path)
+        self.db.create_function('pack_io', 1, packIO)
         self.cur = self.db.cursor()
+        for pragma, value in self.pragmas.items():
+            if value is not None:
+                self.cur.execute('PRAGMA {} = {}'.format(pragma, value))
+
+    def read_pool(self, size=4):
+        ''' Returns a readPool on this database, with the same timeouts
+            and cache settings.
+        '''
+        return readPool(self.sq, self.db_path, size,
+                        busy_timeout=self.pragmas['busy_timeout'],
+                        cache_size=self.pragmas['cache_size'],
+                        mmap_size=self.pragmas['mmap_size'])
     
     def close(self):
         ''' Re-wraps the sqlite3 database closure function.
         '''
-        self.db.close()
+        if self.db is not None:
+            self.db.close()
+        self.db = None
     
+    INSERT = '''INSERT INTO sensor_data (date, sensorID, temperature_C, io,
+                                         model, channel, humidity, battery,
+                                         receiver, extra)
+                VALUES (?,?,?,?,?,?,?,?,?,?)'''
+
     def write(self, json_data):
         ''' Takes json_data and writes it to the sqlite database.
-            Increments the max_id.
         '''
-        timestamp = str(datetime.now())
+        timestamp = epochMillis()
         self.connect()
-        self.cur.execute('''INSERT INTO sensor_data VALUES
-                             (?,?,?,?,?)''', 
-                             (self.max_id, timestamp, json_data['id'],
-                              json_data['temperature_C'], json_data['io'],))
-        self.db.commit()
-        self.cur.execute("DELETE from current_id WHERE max_id = ?", 
-                          (self.max_id,))
-        self.db.commit()
-        # XXX Remove increment from write. Move to get_max_id.
-        self.cur.execute("INSERT INTO current_id values (?)", 
-                          (self.max_id + 1,))
-        self.db.commit()
+        with self.db:
+            self._insert([(timestamp,) + self.extractors.extract(json_data)])
         self.close()
 
-        # XXX Remove increment from write. Move to get_max_id.
-        self.max_id = self.get_max_id() + 1
+    def _insert(self, records):
+        ''' Inserts records, (date,) + fieldExtractors.extract(), and
+            updates the rollups. Must be called inside a transaction.
+        '''
+        self.cur.executemany(self.INSERT, records)
+        self._update_rollups([record[:3] for record in records])
+
+    def write_many(self, rows, timestamps=None):
+        ''' Takes a list of json_data and writes it to the sqlite database in
+            a single transaction. The connection is kept open between calls
+            so that a stream of batches only pays for one commit each.
+
+            timestamps, if given, is a list of epochMillis() the same length
+            as rows. Otherwise every row is stamped with the current time.
+        '''
+        if not rows:
+            return
+        if timestamps is None:
+            timestamps = [epochMillis()] * len(rows)
+        if self.db is None:
+            self.connect()
+
+        extract = self.extractors.extract
+        records = [(timestamp,) + extract(json_data)
+                   for timestamp, json_data in zip(timestamps, rows)]
+
+        with self.db:
+            self._insert(records)
+
+    # Skips through the (sensorID, date) index one sensorID at a time.
+    SENSOR_IDS = '''WITH RECURSIVE sensors(sensorID) AS (
+                        SELECT MIN(sensorID) FROM sensor_data
+                        UNION ALL
+                        SELECT (SELECT MIN(sensorID) FROM sensor_data
+                                WHERE sensorID > sensors.sensorID)
+                        FROM sensors WHERE sensors.sensorID IS NOT NULL)
+                    SELECT sensorID FROM sensors
+                    WHERE sensorID IS NOT NULL'''
+
+    # Deletes at most a given number of a sensor's rows older than a date,
+    # oldest first, walking the (sensorID, date) index.
+    DELETE_EXPIRED = '''DELETE FROM sensor_data WHERE id IN (
+                            SELECT id FROM sensor_data
+                            WHERE sensorID = ? AND date < ? {}
+                            ORDER BY date LIMIT ?)'''
+
+    def prune(self, retention, now=None):
+        ''' Deletes rows that retention, a retentionPolicy, no longer keeps,
+            at most retention.chunk_size of them in one transaction, so the
+            writer only waits for a short one. Returns the number deleted,
+            less than chunk_size once nothing more has expired. Rollups are
+            left alone.
+        '''
+        if now is None:
+            now = epochMillis()
+        if self.db is None:
+            self.connect()
+        limit = retention.chunk_size
+        models = sorted(retention.models)
+        others = ''
+        if models:
+            others = 'AND (model IS NULL OR model NOT IN ({}))'.format(
+                        ', '.join('?' * len(models)))
+        with self.db:
+            sensors = [row[0] for row in self.cur.execute(self.SENSOR_IDS)]
+            for sensor in sensors:
+                if sensor in retention.sensors:
+                    rules = [('', (), retention.sensors[sensor])]
+                else:
+                    rules = [('AND model = ?', (model,),
+                              retention.models[model]) for model in models]
+                    rules.append((others, tuple(models), retention.keep))
+                for where, parameters, keep in rules:
+                    if keep is None or limit <= 0:
+                        continue
+                    self.cur.execute(self.DELETE_EXPIRED.format(where),
+                                     (sensor, now - keep) + parameters
+                                     + (limit,))
+                    limit -= self.cur.rowcount
+                if limit <= 0:
+                    break
+        return retention.chunk_size - limit
+
+    def incremental_vacuum(self, pages=None):
+        ''' Returns up to pages free pages, or all of them if None, to the
+            filesystem and returns how many were freed. Does nothing unless
+            the database has auto_vacuum=INCREMENTAL.
+        '''
+        if self.db is None:
+            self.connect()
+        free = self.cur.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            return 0
+        # execute() only steps the pragma once, freeing one page.
+        self.db.executescript('PRAGMA incremental_vacuum{}'.format(
+                                '' if pages is None else '({})'.format(pages)))
+        return free - self.cur.execute('PRAGMA freelist_count').fetchone()[0]
 
     def get_max_id(self):
-        ''' Returns the (only) value in the current_id table.
+        ''' Returns the highest id in sensor_data, or None if it is empty.
         '''
         self.connect()
-        self.cur.execute("SELECT * from current_id;")
+        self.cur.execute("SELECT MAX(id) from sensor_data;")
         max_id =  self.cur.fetchone()[0]
         self.close()
         return max_id
 
-    def next_max_id(self):
-        ''' Returns the next max ID
+class readPool(object):
+    ''' A small pool of read-only connections for programs that read the
+        database while the logger writes it, such as the heating controller.
+        Connections are opened as they are needed, up to size, and reused.
+        A connection is only ever used by one thread at a time.
+
+            pool = database.read_pool()
+            with pool.connection() as db:
+                db.execute("SELECT ...")
+    '''
+
+    def __init__(self, sq, db_path, size=4, busy_timeout=5000,
+                 cache_size=None, mmap_size=None):
+        self.sq = sq
+        self.db_path = db_path
+        self.size = size
+        self.pragmas = collections.OrderedDict([
+                            ('busy_timeout', busy_timeout),
+                            ('cache_size', cache_size),
+                            ('mmap_size', mmap_size),
+                            ('query_only', 1)])
+        self._idle = Queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        ''' Opens a new read-only connection.
         '''
+        uri = 'file:{}?mode=ro'.format(urllib.parse.quote(self.db_path))
+        db = self.sq.connect(uri, uri=True, check_same_thread=False)
+        for pragma, value in self.pragmas.items():
+            if value is not None:
+                db.execute('PRAGMA {} = {}'.format(pragma, value))
+        return db
 
-        pass
+    @contextlib.contextmanager
+    def connection(self):
+        ''' Context manager that lends out a connection, waiting for one
+            to be returned if size are already in use.
+        '''
+        try:
+            db = self._idle.get_nowait()
+        except Queue.Empty:
+            with self._lock:
+                opening = self._opened < self.size
+                if opening:
+                    self._opened += 1
+            if opening:
+                try:
+                    db = self._open()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                db = self._idle.get()
+        try:
+            yield db
+        finally:
+            # Don't hand a connection on in the middle of a read.
+            if db.in_transaction:
+                db.rollback()
+            self._idle.put(db)
+
+    def close(self):
+        ''' Closes the idle connections. Connections that are lent out are
+            closed when they come back and close() is called again.
+        '''
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except Queue.Empty:
+                return
+            db.close()
+            with self._lock:
+                self._opened -= 1
+
+class latencyStats(object):
+    ''' Collects the time from a line being read by asyncFileReader to its
+        row being committed. Percentiles are taken over the most recent
+        samples, so memory use is fixed, or over all of them if samples is
+        None.
+    '''
+
+    def __init__(self, samples=1000):
+        self._samples = collections.deque(maxlen=samples)
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        ''' Adds one read to commit time, in seconds.
+        '''
+        self._samples.append(seconds)
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        ''' Returns the p'th percentile of the recent samples, in seconds.
+        '''
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def report(self):
+        ''' Returns a one line summary and starts a new reporting period.
+        '''
+        line = "latency: {} rows, p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms"
+        line = line.format(self.count, self.percentile(50) * 1000,
+                           self.percentile(99) * 1000, self.max * 1000)
+        self._samples.clear()
+        self.count = 0
+        self.max = 0.0
+        return line
+
+def _latestRows(database):
+    ''' Returns the newest row of each sensor in database, leaving out
+        sensors whose newest row doesn't have an integer date.
+    '''
+    pool = database.read_pool(size=1)
+    try:
+        rows = rtl_433_query.sensorQuery(pool).latest_all()
+    finally:
+        pool.close()
+    # Until rebuild_step has converted them, an old database's dates are
+    # text, and text sorts after any integer, so the row found may not be
+    # the newest and its date can't be compared with new ones.
+    return [row for row in rows if isinstance(row.date, int)]
+
+class latestCache(object):
+    ''' The newest reading of each sensorID, kept up to date by the
+        batchWriter as rows are committed, so that it can be served, see
+        rtl_433_latest.py, without reading the database. Readings are dicts
+        of FIELDS.
+
+        Subscribers are given every new reading on a queue of their own. One
+        that falls backlog readings behind is sent None and dropped, rather
+        than holding up the writer or using more memory.
+    '''
+
+    FIELDS = ('date', 'sensorID', 'temperature_C', 'model', 'channel',
+              'humidity', 'battery', 'receiver')
+
+    def __init__(self, backlog=1000):
+        self.backlog = backlog
+        self._latest = {}
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def load(self, database):
+        ''' Seeds the cache from the newest row of each sensor in database.
+        '''
+        rows = _latestRows(database)
+        with self._lock:
+            for row in rows:
+                self._latest[row.sensorID] = dict(
+                    (field, getattr(row, field)) for field in self.FIELDS)
+
+    def update(self, rows, timestamps):
+        ''' Takes the json_data rows of a committed batch and the dates they
+            were written with.
+        '''
+        with self._lock:
+            for date, json_data in zip(timestamps, rows):
+                sensor = json_data.get('id')
+                if sensor is None:
+                    continue
+                last = self._latest.get(sensor)
+                # Lines from the spill journal can be older.
+                if last is not None and last['date'] > date:
+                    continue
+                reading = {'date' : date, 'sensorID' : sensor,
+                           'temperature_C' : _temperature_C(json_data),
+                           'model' : json_data.get('model'),
+                           'channel' : json_data.get('channel'),
+                           'humidity' : json_data.get('humidity'),
+                           'battery' : _battery(json_data),
+                           'receiver' : json_data.get('receiver')}
+                self._latest[sensor] = reading
+                for updates, sensors in list(self._subscribers.items()):
+                    if sensors is not None and sensor not in sensors:
+                        continue
+                    if updates.qsize() >= self.backlog:
+                        updates.put_nowait(None)
+                        del self._subscribers[updates]
+                    else:
+                        updates.put_nowait(reading)
+
+    def get(self, sensor):
+        ''' Returns the newest reading of sensor, or None.
+        '''
+        return self._latest.get(sensor)
+
+    def all(self):
+        ''' Returns the newest reading of every sensor, by sensorID.
+        '''
+        with self._lock:
+            return [self._latest[sensor] for sensor in sorted(self._latest)]
+
+    def subscribe(self, sensors=None):
+        ''' Returns a queue that each new reading of sensors, or of every
+            sensor if None, is put on. None is put on it when the
+            subscription ends.
+        '''
+        # Room for the None.
+        updates = Queue.Queue(self.backlog + 1)
+        with self._lock:
+            self._subscribers[updates] = (None if sensors is None
+                                          else frozenset(sensors))
+        return updates
+
+    def unsubscribe(self, updates):
+        with self._lock:
+            self._subscribers.pop(updates, None)
+
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def close(self):
+        ''' Ends every subscription.
+        '''
+        with self._lock:
+            for updates in self._subscribers:
+                updates.put_nowait(None)
+            self._subscribers.clear()
+
+class dedupCache(object):
+    ''' Drops the repeats that cheap sensors send of each packet. A reading
+        is a repeat if one with the same (model, id, io) was let through
+        less than window milliseconds ago. Models without io are keyed on
+        all their fields apart from time instead.
+
+        At most size keys are remembered, the least recently seen are
+        forgotten first.
+    '''
+
+    def __init__(self, window=2000, size=1024):
+        self.window = window
+        self.size = size
+        self.passed = 0
+        self.suppressed = 0
+        self._seen = collections.OrderedDict()
+
+    def _key(self, json_data):
+        ''' Returns the key that repeats of json_data share.
+        '''
+        io = json_data.get('io')
+        if io is None:
+            io = repr(sorted((key, value) for key, value in json_data.items()
+                             if key != 'time'))
+        return (json_data.get('model'), json_data.get('id'), io)
+
+    def admit(self, json_data, now=None):
+        ''' Returns False if json_data is a repeat, otherwise remembers it
+            and returns True. now is time.monotonic() if not given.
+        '''
+        if now is None:
+            now = time.monotonic()
+        key = self._key(json_data)
+        first = self._seen.get(key)
+        if first is not None and (now - first) * 1000 < self.window:
+            # The window runs from the first copy, so a sensor that really
+            # does send the same value every few seconds is still stored.
+            self._seen.move_to_end(key)
+            self.suppressed += 1
+            return False
+
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        if len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+        self.passed += 1
+        return True
+
+    def report(self):
+        ''' Returns a one line summary of the counters.
+        '''
+        return "dedup: {} passed, {} suppressed".format(self.passed,
+                                                        self.suppressed)
+
+class deadbandFilter(object):
+    ''' Only lets a reading through if it differs from the last one stored
+        for its sensor, or heartbeat milliseconds have passed since then.
+        temperature_C and humidity differ if they have moved by more than
+        the sensor's threshold, the other typed columns if they have
+        changed at all.
+
+        threshold applies to every sensor not in thresholds, a dict of
+        {sensorID : threshold}. Sensors are told apart by (model, id).
+        Call load() at startup so the first reading of each sensor isn't
+        stored just because the logger was restarted.
+
+        The stored rows form a step function, see sensorQuery.value_at().
+    '''
+
+    NUMERIC = ('temperature_C', 'humidity')
+    EXACT = ('channel', 'battery')
+
+    def __init__(self, threshold=0.1, thresholds=None, heartbeat=600000):
+        self.threshold = threshold
+        self.thresholds = thresholds or {}
+        self.heartbeat = heartbeat
+        self.stored = 0
+        self.skipped = 0
+        self._last = {}
+
+    def load(self, database):
+        ''' Seeds the last stored values from the newest row of each sensor
+            in database.
+        '''
+        for row in _latestRows(database):
+            values = dict((key, getattr(row, key))
+                          for key in self.NUMERIC + self.EXACT)
+            self._last[(row.model, row.sensorID)] = (row.date, values)
+
+    def _values(self, json_data):
+        ''' Returns the compared fields of json_data as they are stored.
+        '''
+        return {'temperature_C' : _temperature_C(json_data),
+                'humidity' : json_data.get('humidity'),
+                'channel' : json_data.get('channel'),
+                'battery' : _battery(json_data)}
+
+    def _changed(self, sensor, old, new):
+        ''' True if the values new differ from old by more than the
+            deadband.
+        '''
+        # Sensors report in steps of 0.1, and 20.1 - 20.0 > 0.1 in floating
+        # point, so allow a little slack.
+        threshold = self.thresholds.get(sensor, self.threshold) + 1e-9
+        for key in self.NUMERIC:
+            if (new[key] is None) != (old[key] is None):
+                return True
+            if new[key] is not None and abs(new[key] - old[key]) > threshold:
+                return True
+        for key in self.EXACT:
+            if new[key] != old[key]:
+                return True
+        return False
+
+    def admit(self, json_data, now=None):
+        ''' Returns True if json_data should be stored, and if so remembers
+            it as the sensor's last stored value. now is epochMillis() if
+            not given.
+        '''
+        if now is None:
+            now = epochMillis()
+        key = (json_data.get('model'), json_data.get('id'))
+        values = self._values(json_data)
+        last = self._last.get(key)
+        if (last is not None and now - last[0] < self.heartbeat
+                and not self._changed(key[1], last[1], values)):
+            self.skipped += 1
+            return False
+        self._last[key] = (now, values)
+        self.stored += 1
+        return True
+
+    def report(self):
+        ''' Returns a one line summary of the counters.
+        '''
+        return "deadband: {} stored, {} skipped".format(self.stored,
+                                                        self.skipped)
+
+# Milliseconds in a day, for retention periods.
+DAY = 86400000
+
+class retentionPolicy(object):
+    ''' How long sensor_data rows are kept, in milliseconds, None is for
+        ever. keep applies to every row not covered by sensors, a dict of
+        {sensorID : keep}, or models, {model : keep}. A sensorID's entry
+        wins over its model's.
+
+        run() is called by the batchWriter after each commit. Every
+        interval milliseconds it deletes up to chunk_size expired rows, see
+        initDatabase.prune(), and hands back up to vacuum_pages free pages.
+        While there are more to delete it carries on after the next batch
+        rather than waiting, so a backlog is worked off between batches
+        without holding up the writer.
+    '''
+
+    def __init__(self, keep=90 * DAY, sensors=None, models=None,
+                 chunk_size=500, vacuum_pages=128, interval=60000):
+        self.keep = keep
+        self.sensors = sensors or {}
+        self.models = models or {}
+        self.chunk_size = chunk_size
+        self.vacuum_pages = vacuum_pages
+        self.interval = interval
+        self.deleted = 0
+        self.vacuumed = 0
+        self.seconds = 0.0
+        self._next = 0
+
+    def run(self, database, now=None):
+        ''' Prunes database if it is due. Returns the rows deleted.
+        '''
+        if now is None:
+            now = epochMillis()
+        if now < self._next:
+            return 0
+        start = time.perf_counter()
+        deleted = database.prune(self, now)
+        self.vacuumed += database.incremental_vacuum(self.vacuum_pages)
+        self.deleted += deleted
+        self.seconds += time.perf_counter() - start
+        self._next = now if deleted >= self.chunk_size else now + self.interval
+        return deleted
+
+    def report(self):
+        ''' Returns a one line summary of the counters.
+        '''
+        return ("retention: {} deleted, {} pages freed, {:.1f} s".format(
+                    self.deleted, self.vacuumed, self.seconds))
+
+class spillJournal(object):
+    ''' An append only file of lines that didn't fit in the ingest queue,
+        read back in the order they were written. Each record is the
+        epochMillis() the line was read at and the lengths of the receiver
+        name and the line, packed as HEADER, then the name and the line.
+
+        checkpoint() saves how far it has been read, once that has been
+        committed, in path + '.offset'. Records after it are read again
+        when the journal is next opened, so lines spilled before a crash
+        or shutdown are written at the next start.
+    '''
+
+    HEADER = struct.Struct('<qHI')
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self._writer = open(path, 'ab')
+        self._reader = open(path, 'rb')
+        self._saved = self._load_offset()
+        self._position = self._saved
+        self.pending = self._scan()
+        self.spilled = 0
+
+    def _load_offset(self):
+        ''' Returns the saved read position, 0 if there isn't one.
+        '''
+        try:
+            with open(self.offset_path) as offset:
+                position = int(offset.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+        return position if position <= os.path.getsize(self.path) else 0
+
+    def _scan(self):
+        ''' Counts the records after the saved position and cuts off a
+            record left half written by a crash.
+        '''
+        self._reader.seek(self._saved)
+        count = 0
+        end = self._saved
+        while True:
+            header = self._reader.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                break
+            millis, name_length, length = self.HEADER.unpack(header)
+            length += name_length
+            if len(self._reader.read(length)) < length:
+                break
+            count += 1
+            end += self.HEADER.size + length
+        self._writer.truncate(end)
+        self._reader.seek(self._saved)
+        return count
+
+    def append(self, millis, line, receiver=None):
+        ''' Adds line, read at epochMillis() millis from receiver, to the
+            end.
+        '''
+        name = receiver.encode('utf-8') if receiver else b''
+        self._writer.write(self.HEADER.pack(millis, len(name), len(line))
+                           + name + line)
+        self._writer.flush()
+        self.pending += 1
+        self.spilled += 1
+
+    def read(self):
+        ''' Returns the oldest unread (millis, line, receiver). Only call
+            it when pending is not 0.
+        '''
+        millis, name_length, length = self.HEADER.unpack(
+                                            self._reader.read(self.HEADER.size))
+        name = self._reader.read(name_length)
+        line = self._reader.read(length)
+        self._position += self.HEADER.size + name_length + length
+        self.pending -= 1
+        return millis, line, name.decode('utf-8') or None
+
+    def checkpoint(self):
+        ''' Saves the read position. Call it when everything read so far
+            has been committed. Once all of it has, the file is emptied.
+        '''
+        if self._position == self._saved:
+            return
+        if not self.pending:
+            self._writer.truncate(0)
+            self._reader.seek(0)
+            self._position = 0
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.offset_path)
+        else:
+            with open(self.offset_path + '.tmp', 'w') as offset:
+                offset.write(str(self._position))
+            os.replace(self.offset_path + '.tmp', self.offset_path)
+        self._saved = self._position
+
+    def close(self):
+        ''' Closes the file, removing it if nothing is left in it.
+        '''
+        self._writer.close()
+        self._reader.close()
+        if not self.pending and self._saved == 0:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+    def report(self):
+        ''' Returns a line with how many lines were spilled and how many
+            are still to be read.
+        '''
+        return "spill: {} spilled, {} pending".format(self.spilled,
+                                                      self.pending)
+
+class spillQueue(Queue.Queue):
+    ''' A Queue of stamped lines, (time.monotonic(), line, receiver), see
+        asyncFileReader, that holds at
+        most maxsize of them in memory. The rest go to a spillJournal and
+        come back out, in order, after the ones in memory. put() never
+        blocks, so rtl_433 isn't held up while the database is slow.
+
+        line can be a list of lines, from a chunked asyncFileReader, which
+        counts as that many against maxsize. Spilled lists come back out a
+        line at a time.
+    '''
+
+    def __init__(self, journal, maxsize=10000):
+        self.journal = journal
+        self.limit = maxsize
+        # Lines, rather than items, in self.queue.
+        self.held = 0
+        Queue.Queue.__init__(self)
+
+    def _qsize(self):
+        return self.held + self.journal.pending
+
+    def _put(self, item):
+        # Once anything is spilled, newer lines follow it into the journal
+        # until it is drained, so they come out in the order they came in.
+        read_time, line, receiver = item
+        lines = line if isinstance(line, list) else (line,)
+        if self.journal.pending or self.held + len(lines) > self.limit:
+            millis = monotonicToMillis(read_time)
+            for line in lines:
+                self.journal.append(millis, line, receiver)
+        else:
+            self.queue.append(item)
+            self.held += len(lines)
+
+    def _get(self):
+        if self.queue:
+            item = self.queue.popleft()
+            self.held -= len(item[1]) if isinstance(item[1], list) else 1
+            return item
+        millis, line, receiver = self.journal.read()
+        return millisToMonotonic(millis), line, receiver
+
+    def checkpoint(self):
+        ''' See spillJournal.checkpoint().
+        '''
+        with self.mutex:
+            self.journal.checkpoint()
+
+class pipelineMetrics(object):
+    ''' The metrics the reader, parser and writer update, kept in a
+        rtl_433_metrics.registry so they can be served.
+    '''
+
+    BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+    COMMIT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                      0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, registry=None):
+        self.registry = registry or rtl_433_metrics.registry()
+        self.lines = self.registry.counter('rtl433_lines_read_total',
+                                           'Lines read from rtl_433.')
+        self.parse_failures = self.registry.counter(
+                                'rtl433_parse_failures_total',
+                                'Lines that were not valid JSON.')
+        self.batch_rows = self.registry.histogram('rtl433_batch_rows',
+                                                  'Rows per committed batch.',
+                                                  self.BATCH_BUCKETS)
+        self.commit_seconds = self.registry.histogram(
+                                'rtl433_commit_seconds',
+                                'Time to commit a batch.',
+                                self.COMMIT_BUCKETS)
+        self._last = (time.monotonic(), 0, 0)
+        self._writer = None
+        self._queue = None
+
+    def watch(self, writer, dedup, deadband=None, queue=None, journal=None,
+              gaps=None, retention=None, latest=None, capture=None,
+              parser=None):
+        ''' Adds the metrics the pipeline's stages already count. They are
+            only read when the metrics are rendered.
+        '''
+        self._writer = writer
+        self._queue = queue
+        registry = self.registry
+        registry.counter('rtl433_rows_written_total', 'Rows committed.',
+                         lambda: writer.rows)
+        registry.counter('rtl433_commit_failures_total',
+                         'Batches that failed to commit and were kept.',
+                         lambda: writer.failures)
+        registry.counter('rtl433_dedup_dropped_total',
+                         'Repeated transmissions dropped.',
+                         lambda: dedup.suppressed)
+        if deadband is not None:
+            registry.counter('rtl433_deadband_skipped_total',
+                             'Readings skipped as unchanged.',
+                             lambda: deadband.skipped)
+        registry.gauge('rtl433_writer_buffered_rows',
+                       'Rows waiting in the batchWriter.',
+                       lambda: len(writer))
+        if queue is not None:
+            registry.gauge('rtl433_queue_depth',
+                           'Lines waiting for the parser.', queue.qsize)
+        if journal is not None:
+            registry.counter('rtl433_spilled_total',
+                             'Lines spilled to the journal.',
+                             lambda: journal.spilled)
+            registry.gauge('rtl433_spill_pending',
+                           'Lines in the journal still to be written.',
+                           lambda: journal.pending)
+        if gaps is not None:
+            registry.counter('rtl433_restarts_total',
+                             'Times rtl_433 was restarted.',
+                             lambda: sum(gap.restarts for gap in gaps))
+            registry.counter('rtl433_gap_seconds_total',
+                             'Seconds without data because of restarts.',
+                             lambda: sum(gap.seconds for gap in gaps))
+        if retention is not None:
+            registry.counter('rtl433_retention_deleted_total',
+                             'Expired rows deleted.',
+                             lambda: retention.deleted)
+            registry.counter('rtl433_retention_vacuumed_pages_total',
+                             'Free pages handed back by incremental_vacuum.',
+                             lambda: retention.vacuumed)
+            registry.counter('rtl433_retention_seconds_total',
+                             'Time spent pruning and vacuuming.',
+                             lambda: retention.seconds)
+        if latest is not None:
+            registry.gauge('rtl433_latest_subscribers',
+                           'Clients subscribed to new readings.',
+                           latest.subscribers)
+        if capture is not None:
+            registry.counter('rtl433_capture_lines_total',
+                             'Lines written to the raw capture.',
+                             lambda: capture.lines)
+            registry.counter('rtl433_capture_dropped_total',
+                             'Lines the raw capture had no room for.',
+                             lambda: capture.dropped)
+        if parser is not None:
+            registry.counter('rtl433_filtered_total',
+                             'Lines dropped for their model before decoding.',
+                             lambda: parser.filtered)
+
+    def report(self):
+        ''' Returns a stats line with the rates since the last one.
+        '''
+        now = time.monotonic()
+        rows = self._writer.rows if self._writer is not None else 0
+        then, lines, written = self._last
+        seconds = max(now - then, 1e-9)
+        self._last = (now, self.lines.value, rows)
+        commits = self.commit_seconds
+        return ("metrics: {:.1f} lines/s, {:.1f} rows/s, {} parse failures, "
+                "queue {}, {:.1f} ms mean commit".format(
+                    (self.lines.value - lines) / seconds,
+                    (rows - written) / seconds,
+                    self.parse_failures.value,
+                    self._queue.qsize() if self._queue is not None else 0,
+                    commits.sum / commits.count * 1000 if commits.count
+                    else 0))
+
+class batchWriter(object):
+    ''' Buffers readings and hands them to database.write_many in a single
+        transaction once batch_size rows have accumulated or flush_interval
+        milliseconds have passed since the oldest buffered row, whichever
+        comes first.
+
+        With auto_flush=False, add() only buffers and the caller decides
+        when to take() a batch and commit() it, e.g. on another thread.
+
+        If metrics is a pipelineMetrics, each commit's size and time are
+        recorded in it. If retention is a retentionPolicy it is run after
+        each commit, on the same connection. If latest is a latestCache it
+        is given each committed batch.
+
+        A batch that can't be written, e.g. because another process has
+        held the lock for longer than the busy timeout, is kept, and the
+        writer waits backoff seconds, doubling up to max_backoff, before
+        it is due again.
+    '''
+
+    def __init__(self, database, batch_size=100, flush_interval=1000,
+                 latency=None, auto_flush=True, metrics=None, retention=None,
+                 latest=None, backoff=0.5, max_backoff=30.0):
+        self.database = database
+        self.metrics = metrics
+        self.retention = retention
+        self.latest = latest
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.latency = latency
+        self.auto_flush = auto_flush
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rows = 0
+        self.failures = 0
+        self._rows = []
+        self._timestamps = []
+        self._read_times = []
+        self._oldest = None
+        # Rows that have been taken but not yet committed or put back.
+        self._taken = 0
+        # The delay after the last failed commit, and when to try again.
+        self._delay = None
+        self._retry_at = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def settled(self):
+        ''' True if nothing is buffered or being committed, so everything
+            added so far is in the database.
+        '''
+        return not self._rows and not self._taken
+
+    def add(self, json_data, read_time=None):
+        ''' Buffers json_data, flushing if the batch is full or overdue.
+            read_time is the time.monotonic() at which the line was read,
+            used for the latency stats and, if given, for the row's date.
+        '''
+        if not self._rows:
+            self._oldest = time.monotonic()
+        self._rows.append(json_data)
+        self._timestamps.append(epochMillis() if read_time is None
+                                else monotonicToMillis(read_time))
+        self._read_times.append(read_time)
+        if self.auto_flush and (self.full() or self.due()):
+            self.flush()
+
+    def waiting(self):
+        ''' True while waiting to try a failed commit again.
+        '''
+        return (self._retry_at is not None
+                and time.monotonic() < self._retry_at)
+
+    def full(self):
+        ''' True if batch_size rows are buffered, and the writer isn't
+            waiting().
+        '''
+        return len(self._rows) >= self.batch_size and not self.waiting()
+
+    def due(self):
+        ''' True if there are buffered rows older than flush_interval, or
+            that failed to commit and have waited long enough.
+        '''
+        if not self._rows:
+            return False
+        if self._retry_at is not None:
+            return not self.waiting()
+        age = (time.monotonic() - self._oldest) * 1000
+        return age >= self.flush_interval
+
+    def timeout(self, idle):
+        ''' Returns how long, in seconds, the consumer can block before
+            the buffered rows are due. idle is returned if nothing is
+            buffered.
+        '''
+        if not self._rows:
+            return idle
+        if self._retry_at is not None:
+            return max(0.0, min(idle, self._retry_at - time.monotonic()))
+        age = time.monotonic() - self._oldest
+        return max(0.0, min(idle, self.flush_interval / 1000 - age))
+
+    def take(self):
+        ''' Empties the buffer and returns its contents as a batch for
+            commit().
+        '''
+        batch = (self._rows, self._timestamps, self._read_times)
+        self._taken += len(self._rows)
+        self._rows = []
+        self._timestamps = []
+        self._read_times = []
+        self._oldest = None
+        return batch
+
+    def restore(self, batch):
+        ''' Puts a batch from take() back in front of anything buffered
+            since.
+        '''
+        rows, timestamps, read_times = batch
+        self._taken -= len(rows)
+        self._rows = rows + self._rows
+        self._timestamps = timestamps + self._timestamps
+        self._read_times = read_times + self._read_times
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def commit(self, batch):
+        ''' Writes a batch from take() to the database. Returns True once
+            it is written. If it can't be, it is put back with restore()
+            and False is returned, and the writer is waiting() for a while.
+        '''
+        rows, timestamps, read_times = batch
+        if not rows:
+            return True
+        start = time.perf_counter()
+        try:
+            self.database.write_many(rows, timestamps)
+        except Exception as error:
+            self.restore(batch)
+            self.failures += 1
+            self._delay = (self.backoff if self._delay is None
+                           else min(self._delay * 2, self.max_backoff))
+            self._retry_at = time.monotonic() + self._delay
+            sys.stderr.write("commit failed: {}, retrying in {:g} s\n"
+                             .format(error, self._delay))
+            return False
+        except BaseException:
+            # Interrupted, e.g. by SIGTERM, and rolled back. Whatever is
+            # left to be written is written with this batch.
+            self.restore(batch)
+            raise
+        self._taken -= len(rows)
+        self._delay = None
+        self._retry_at = None
+        self.rows += len(rows)
+        try:
+            if self.latest is not None:
+                self.latest.update(rows, timestamps)
+            if self.metrics is not None:
+                self.metrics.commit_seconds.observe(time.perf_counter()
+                                                    - start)
+                self.metrics.batch_rows.observe(len(rows))
+
+            if self.latency is not None:
+                committed = time.monotonic()
+                for read_time in read_times:
+                    if read_time is not None:
+                        self.latency.record(committed - read_time)
+
+            if self.retention is not None:
+                self.retention.run(self.database)
+        finally:
+            # However the rest went, the migration is taken a step further,
+            # so that it can't be held up by something it would fix.
+            if not self.database.migrated:
+                try:
+                    self.database.migrate_step()
+                except Exception as error:
+                    # The batch is committed, and the step is tried again
+                    # after the next one.
+                    sys.stderr.write("migration step failed: {}\n"
+                                     .format(error))
+        return True
+
+    def flush(self):
+        ''' Writes any buffered rows to the database. Returns False if
+            they are still buffered, see commit().
+        '''
+        if not self._rows:
+            return True
+        return self.commit(self.take())
+
+# Open PID files, by path, whose locks this process holds.
+_PID_LOCKS = {}
 
 def createPID(PIDFILE, pid_id):
     ''' Creates a temporary PID file to track if processing is running.
+
+        The file is locked with fcntl.flock and kept open until deletePID.
+        alreadyRunningError is raised if someone else holds the lock. A
+        file left behind by a crash isn't locked, as the lock goes with
+        the process, so it doesn't stop the next start.
     '''
-    pidfile = PIDFILE 
+    while True:
+        fd = os.open(PIDFILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise alreadyRunningError
+        # deletePID unlinks the file before it lets go of the lock, so
+        # what was opened may no longer be PIDFILE, and someone else may
+        # hold the lock on the one that is.
+        opened = os.fstat(fd)
+        try:
+            current = os.stat(PIDFILE)
+        except FileNotFoundError:
+            current = None
+        if (current is not None and (current.st_dev, current.st_ino)
+                == (opened.st_dev, opened.st_ino)):
+            break
+        os.close(fd)
+    os.ftruncate(fd, 0)
+    os.write(fd, str(pid_id).encode())
 
-    if os.path.isfile(pidfile):
-        raise alreadyRunningError    
-    f = open(pidfile, 'w')
-    f.write(str(pid_id))
-    f.close()
+    # A lock on a file that has since been deleted.
+    stale = _PID_LOCKS.pop(PIDFILE, None)
+    if stale is not None:
+        os.close(stale)
+    _PID_LOCKS[PIDFILE] = fd
 
 
 def deletePID(PIDFILE):
-    ''' Deletes the pidfile once the program exits.
+    ''' Deletes the pidfile once the program exits, then releases its
+        lock.
     '''
     os.unlink(PIDFILE)
+    fd = _PID_LOCKS.pop(PIDFILE, None)
+    if fd is not None:
+        os.close(fd)
 
-def startSubProcess(rtl_path, database, debug=False, PIDFILE='/tmp/rtl_433_2sqlite.pid'):
-    ''' Example of how to consume standard output and standard error of
-        a subprocess asynchronously without risk on deadlocking.
+def drainStderr(stderr_queue):
+    ''' Passes anything rtl_433 wrote to stderr on to our stderr.
     '''
+    while True:
+        try:
+            line = stderr_queue.get_nowait()
+        except Queue.Empty:
+            return
+        sys.stderr.write("rtl_433: " + line.decode("utf-8", "replace"))
 
-    pid = str(os.getpid())
-    createPID(PIDFILE, pid)
-
+def rtlCommand(rtl_path, debug=False, protocols=(39,), args=()):
+    ''' Returns the command line used to start rtl_433. protocols are the
+        decoders passed with -R, if it is empty rtl_433 uses its defaults.
+        args are any other rtl_433 options, e.g. ["-f", "868M", "-d", "1"].
+    '''
     if debug == False:
-        command = [rtl_path, "-R", "39","-F", "json"]
+        command = [rtl_path]
+        for protocol in protocols:
+            command.extend(["-R", str(protocol)])
+        command.extend(args)
+        command.extend(["-F", "json"])
         print("\nStarting RTL433\n")
 
     if debug == True:
@@ -193,88 +1924,797 @@ def startSubProcess(rtl_path, database, debug=False, PIDFILE='/tmp/rtl_433_2sqli
         # cant just run the shell script because it doesn't output json
         command = ['/home/ciaran/Code/rtl_433_tests/rtl_433_test.sh']
         print("\nStarting RTL433 - Debug Mode\n")
+
+    return command
+
+def consumeLines(readers, stdout_queue, writer, dedup, deadband=None,
+                 stderr_queue=None, report_interval=None, metrics=None,
+                 parser=None, recorded=False):
+    ''' The consumer loop of the thread engine. Takes stamped lines from
+        stdout_queue, parses them with parser, a rtl_433_parse.lineParser,
+        and passes them through dedup and deadband to writer, until every
+        reader is at EOF. Returns the number of lines taken. If
+        stdout_queue is a spillQueue its journal is checkpointed as lines
+        are committed. Lines and parse failures are counted in metrics, a
+        pipelineMetrics.
+
+        dedup and deadband go by when each line was read, not when it is
+        taken, so a backlog from the spill journal isn't run together.
+        With recorded they go by each reading's time field instead, where
+        it has one, for a replay that reads lines quicker than they were
+        recorded.
+    '''
+    if metrics is None:
+        metrics = pipelineMetrics()
+    if parser is None:
+        parser = rtl_433_parse.lineParser()
+    spill = isinstance(stdout_queue, spillQueue)
+    # Block on stdout until a line arrives, the batch is due or it is time
+    # to look at stderr and the stats again.
+    lines = metrics.lines.value
+    last_report = time.monotonic()
+
+    #print('Starting reader loop')    
+    # Every reader's eof() is called each time round, a receiverProcess
+    # restarts rtl_433 from it.
+    while not all([reader.eof() for reader in readers]):
+        if writer.waiting():
+            # Leave lines on stdout_queue, where they are spilled once it
+            # is full, rather than buffering them while the database can't
+            # be written.
+            time.sleep(writer.timeout(IDLE_TIMEOUT))
+            line = None
+        else:
+            try:
+                read_time, line, receiver = stdout_queue.get(
+                                        timeout=writer.timeout(IDLE_TIMEOUT))
+            except Queue.Empty:
+                line = None
+
+        if line is not None:
+            # A chunked asyncFileReader puts each read's lines as a list.
+            batch = line if isinstance(line, list) else [line]
+            metrics.lines.inc(len(batch))
+            failures = parser.failures
+            read_millis = monotonicToMillis(read_time)
+            for data in parser.parse(batch):
+                heard, millis = read_time, read_millis
+                if recorded:
+                    seconds = parseTime(str(data.get('time', '')))
+                    if seconds is not None:
+                        heard, millis = seconds, int(seconds * 1000)
+                if dedup.admit(data, heard) and (
+                        deadband is None or deadband.admit(data, millis)):
+                    if receiver is not None:
+                        data['receiver'] = receiver
+                    writer.add(data, read_time)
+            metrics.parse_failures.inc(parser.failures - failures)
+
+        if writer.due():
+            writer.flush()
+
+        # Whatever has been taken from the spill journal is committed once
+        # the writer has settled.
+        if spill and writer.settled():
+            stdout_queue.checkpoint()
+
+        if stderr_queue is not None:
+            drainStderr(stderr_queue)
+
+        if (report_interval is not None
+                and time.monotonic() - last_report >= report_interval):
+            print(writer.latency.report())
+            print(dedup.report())
+            if deadband is not None:
+                print(deadband.report())
+            if writer.retention is not None:
+                print(writer.retention.report())
+            print(parser.report())
+            if spill:
+                print(stdout_queue.journal.report())
+            print(metrics.report())
+            last_report = time.monotonic()
     
-    # Launch the command as subprocess.
-    process = subprocess.Popen(command, 
-                               stdout=subprocess.PIPE, 
-                               stderr=subprocess.PIPE)
-    # print('subprocess pid: ', process.pid)
-    createPID('/tmp/rtl_433.pid', process.pid)
+   # print('Finished looping')
+    # Nothing that has been read is dropped, so keep trying until it is
+    # written.
+    while not writer.flush():
+        time.sleep(writer.timeout(IDLE_TIMEOUT))
+    if spill and writer.settled():
+        stdout_queue.checkpoint()
+    if stderr_queue is not None:
+        drainStderr(stderr_queue)
+    return metrics.lines.value - lines
 
-    # Launch the asynchronous readers of the process' stdout and stderr.
+def parseTime(value):
+    ''' Returns an rtl_433 time field in seconds, or None if it isn't
+        understood. rtl_433 gives "@1.5s", relative to the start of a
+        recording, or local time as "2017-10-01 12:00:00".
+    '''
+    try:
+        if value.startswith('@') and value.endswith('s'):
+            return float(value[1:-1])
+        if '.' in value:
+            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f').timestamp()
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()
+    except ValueError:
+        return None
+
+class pacedFile(object):
+    ''' Wraps a file of captured rtl_433 JSON lines so that readline()
+        gives each line at the pace it was recorded, from its time field,
+        sped up by speed. Lines without a usable time are given at once.
+    '''
+
+    TIME = re.compile(rb'"time"\s*:\s*"([^"]*)"')
+
+    def __init__(self, fd, speed=1.0):
+        self._fd = fd
+        self.speed = speed
+        self._start = None
+
+    def readline(self):
+        ''' Reads a line, sleeping until it is due.
+        '''
+        line = self._fd.readline()
+        match = self.TIME.search(line)
+        recorded = match and parseTime(match.group(1).decode("utf-8"))
+        if recorded is not None:
+            if self._start is None:
+                self._start = (recorded, time.monotonic())
+            due = self._start[1] + (recorded - self._start[0]) / self.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return line
+
+def replay(path, database, pace=False, speed=1.0, batch_size=100,
+           flush_interval=1000, dedup_window=2000, deadband=None,
+           chunk_size=None, parser=None):
+    ''' Feeds a file of captured rtl_433 JSON lines, which may be a
+        compressed segment from a rtl_433_capture.captureWriter, through
+        the same asyncFileReader, consumeLines and batchWriter as
+        startSubProcess, as fast as possible or, if pace is True, at the
+        recorded pace (see pacedFile). Returns a dict of
+            lines, rows, parse_failures, seconds, lines_per_s, rows_per_s,
+            p50_ms, p99_ms, peak_rss_kb
+        where p50 and p99 are of the time from a line being read to its
+        row being committed. chunk_size is passed to the asyncFileReader,
+        and only used for an uncompressed capture that isn't paced. parser
+        is passed to consumeLines.
+
+        As fast as possible, repeats are told apart by the recorded time
+        of each line rather than when it was read.
+    '''
+    latency = latencyStats(samples=None)
+    metrics = pipelineMetrics()
+    writer = batchWriter(database, batch_size, flush_interval, latency,
+                         metrics=metrics)
+    dedup = dedupCache(dedup_window)
     stdout_queue = Queue.Queue()
-    stdout_reader = asyncFileReader(process.stdout, stdout_queue)
-    stdout_reader.start()
+    with rtl_433_capture.openCapture(path) as capture:
+        if pace:
+            capture = pacedFile(capture, speed)
+        # Only a plain file's fileno() gives its lines.
+        if pace or not isinstance(getattr(capture, 'raw', None), io.FileIO):
+            chunk_size = None
+        reader = asyncFileReader(capture, stdout_queue, stamp=True,
+                                 chunk_size=chunk_size)
+        start = time.perf_counter()
+        reader.start()
+        lines = consumeLines([reader], stdout_queue, writer, dedup, deadband,
+                             metrics=metrics, parser=parser,
+                             recorded=not pace)
+        seconds = time.perf_counter() - start
+        reader.join()
+    database.close()
+
+    return {'lines' : lines,
+            'rows' : writer.rows,
+            'parse_failures' : metrics.parse_failures.value,
+            'seconds' : seconds,
+            'lines_per_s' : lines / seconds,
+            'rows_per_s' : writer.rows / seconds,
+            'p50_ms' : latency.percentile(50) * 1000,
+            'p99_ms' : latency.percentile(99) * 1000,
+            'peak_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def startSubProcess(rtl_path, database, debug=False, PIDFILE='/tmp/rtl_433_2sqlite.pid',
+                    batch_size=100, flush_interval=1000, report_interval=60,
+                    protocols=(39,), dedup_window=2000, deadband=None,
+                    queue_size=10000, spill_path=None, metrics_address=None,
+                    restart=False, backoff=1.0, max_backoff=60.0,
+                    retention=None, latest_address=None, capture=None,
+                    chunk_size=None, parser=None):
+    ''' Example of how to consume standard output and standard error of
+        a subprocess asynchronously without risk on deadlocking.
+
+        protocols are the rtl_433 decoders to enable, see rtlCommand.
+
+        Repeated transmissions are dropped by a dedupCache with a window of
+        dedup_window milliseconds, 0 keeps them all. If deadband is a
+        deadbandFilter, only readings it lets through are stored.
+
+        Readings are written through a batchWriter, see batch_size and
+        flush_interval (milliseconds). Every report_interval seconds a line
+        with the read to commit latency is printed, None turns it off. If
+        retention is a retentionPolicy, expired rows are deleted between
+        batches.
+
+        At most queue_size lines wait in memory, the rest are spilled to a
+        spillJournal at spill_path (database.db_path + '-spill' if None).
+        Lines left in it from the last run are written first.
+
+        If metrics_address, 'host:port' or a Unix socket path, is given the
+        pipelineMetrics are served there in the Prometheus text format. If
+        latest_address, a Unix socket path, is given the newest reading of
+        each sensor is served there, see latestCache and rtl_433_latest.py.
+
+        If capture is a rtl_433_capture.captureWriter, everything rtl_433
+        writes to stdout is kept in it. It is closed on the way out.
+
+        With chunk_size, rtl_433's stdout is read that many bytes at a time
+        rather than a line at a time, see asyncFileReader. It saves a
+        queue operation per line when rtl_433 is busy.
+
+        Lines are parsed by parser, a rtl_433_parse.lineParser, which can
+        keep only some models and pick the JSON decoder. The default keeps
+        everything, with orjson if it is installed.
+
+        restart, backoff and max_backoff restart rtl_433 when it exits,
+        see startReceivers().
+
+        This is startReceivers() with one receiver, whose rows aren't
+        tagged.
+    '''
+    startReceivers([receiver(None, rtlCommand(rtl_path, debug, protocols))],
+                   database, batch_size, flush_interval, report_interval,
+                   dedup_window, deadband, queue_size, spill_path,
+                   metrics_address, pidfiles=[(PIDFILE, '/tmp/rtl_433.pid')],
+                   restart=restart, backoff=backoff, max_backoff=max_backoff,
+                   retention=retention, latest_address=latest_address,
+                   capture=capture, chunk_size=chunk_size, parser=parser)
+
+def serveLatest(database, address):
+    ''' Returns a latestCache loaded from database and the server for it
+        on the Unix socket address, or (None, None) if address is None.
+    '''
+    if address is None:
+        return None, None
+    latest = latestCache()
+    latest.load(database)
+    return latest, rtl_433_latest.serve(latest, address)
+
+# One rtl_433 for startReceivers to run. name is put in sensor_data.receiver
+# for the rows it hears and in its PID file names, command is its command
+# line, see rtlCommand.
+receiver = collections.namedtuple('receiver', ('name', 'command'))
+
+def receiverPIDs(name, pid_dir='/tmp'):
+    ''' Returns the (logger, rtl_433) PID files for the receiver name.
+    '''
+    return (os.path.join(pid_dir, 'rtl_433_2sqlite-{}.pid'.format(name)),
+            os.path.join(pid_dir, 'rtl_433-{}.pid'.format(name)))
+
+class restartBackoff(object):
+    ''' The delays, in seconds, before restarting rtl_433. The first is
+        initial, each run shorter than healthy seconds doubles the next,
+        up to maximum, and a run at least that long resets it.
+    '''
+
+    def __init__(self, initial=1.0, maximum=60.0, healthy=60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.healthy = healthy
+        self._next = initial
+
+    def delay(self, ran_for):
+        ''' Returns the delay after a run of ran_for seconds.
+        '''
+        if ran_for >= self.healthy:
+            self._next = self.initial
+        delay = self._next
+        self._next = min(self._next * 2, self.maximum)
+        return delay
+
+class gapTimer(object):
+    ''' Counts restarts of rtl_433 and adds up the seconds without data
+        they cost, from the end of one run's output to the first line of
+        the next.
+    '''
+
+    def __init__(self):
+        self.restarts = 0
+        self.seconds = 0.0
+        self._since = None
+
+    def ended(self, when):
+        ''' Output stopped at time.monotonic() when.
+        '''
+        if self._since is None:
+            self._since = when
+
+    def read(self, when):
+        ''' A line was read at time.monotonic() when.
+        '''
+        if self._since is not None:
+            self.seconds += when - self._since
+            self._since = None
+
+class receiverProcess(object):
+    ''' One receiver's rtl_433 and the asyncFileReaders on its stdout and
+        stderr, for startReceivers. With a restartBackoff, rtl_433 is
+        started again whenever it exits, and gaps adds up the time lost.
+
+        It stands in for its readers in consumeLines, so eof() is where an
+        exit is noticed and the restart made.
+    '''
+
+    def __init__(self, rtl, rtl_pid, stdout_queue, stderr_queue,
+                 backoff=None, capture=None, chunk_size=None):
+        self.rtl = rtl
+        self.capture = capture
+        self.chunk_size = chunk_size
+        self.rtl_pid = rtl_pid
+        self.stdout_queue = stdout_queue
+        self.stderr_queue = stderr_queue
+        self.backoff = backoff
+        self.gaps = gapTimer()
+        self.process = None
+        self._readers = []
+        self._started = None
+        self._due = None
+
+    def start(self):
+        ''' Launches rtl_433 and its readers.
+        '''
+        self.process = subprocess.Popen(self.rtl.command,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        createPID(self.rtl_pid, self.process.pid)
+        self._readers = [asyncFileReader(self.process.stdout,
+                                         self.stdout_queue, self.capture,
+                                         stamp=True, receiver=self.rtl.name,
+                                         chunk_size=self.chunk_size),
+                         asyncFileReader(self.process.stderr,
+                                         self.stderr_queue)]
+        for reader in self._readers:
+            reader.start()
+        self._started = time.monotonic()
+        self._due = None
+
+    def _reap(self):
+        ''' Releases the pipes and PID file of an rtl_433 whose output has
+            ended and returns its exit code.
+        '''
+        for reader in self._readers:
+            # Not started if start() was interrupted.
+            if reader.ident is not None:
+                reader.join()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        code = self.process.wait()
+        deletePID(self.rtl_pid)
+        self.process = None
+        return code
 
+    def eof(self):
+        ''' True once rtl_433 has exited for good and its output has been
+            taken. An rtl_433 that exits while there is a backoff is
+            restarted once the delay is up, and until then this is False.
+        '''
+        now = time.monotonic()
+        if self.process is not None:
+            stdout_reader = self._readers[0]
+            if stdout_reader.first_read is not None:
+                self.gaps.read(stdout_reader.first_read)
+            if any(reader.is_alive() for reader in self._readers):
+                return False
+            self.gaps.ended(stdout_reader.ended)
+            code = self._reap()
+            if self.backoff is None:
+                return self.stdout_queue.empty()
+            delay = self.backoff.delay(now - self._started)
+            sys.stderr.write("rtl_433 {}exited with {}, restarting in {:g} s\n"
+                             .format(self.rtl.name + " " if self.rtl.name
+                                     else "", code, delay))
+            self._due = now + delay
+            return False
+
+        if self._due is None:
+            return self.stdout_queue.empty()
+        if now >= self._due:
+            self.start()
+            self.gaps.restarts += 1
+        return False
+
+    def stop(self):
+        ''' Stops rtl_433, if it is running, and its readers.
+        '''
+        self._due = None
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+        for reader in self._readers:
+            reader.stop()
+        self._reap()
+
+def startReceivers(receivers, database, batch_size=100, flush_interval=1000,
+                   report_interval=60, dedup_window=2000, deadband=None,
+                   queue_size=10000, spill_path=None, metrics_address=None,
+                   pid_dir='/tmp', pidfiles=None, restart=False, backoff=1.0,
+                   max_backoff=60.0, retention=None, latest_address=None,
+                   capture=None, chunk_size=None, parser=None):
+    ''' Runs several rtl_433, e.g. one per dongle, each with its own pair of
+        asyncFileReaders, and writes what they all hear through a single
+        batchWriter, so there is one stream of transactions. Returns once
+        every one of them has exited.
+
+        Each row is tagged with the name of its receiver. A receiver is
+        locked by PID files named after it in pid_dir, see receiverPIDs, so
+        a second logger can run other receivers but not the same ones.
+        pidfiles overrides them with a (logger, rtl_433) pair per receiver.
+
+        If restart is True an rtl_433 that exits is started again, after
+        backoff seconds doubling up to max_backoff, see restartBackoff, and
+        this only returns on KeyboardInterrupt. The writer, its connection
+        and anything buffered carry on across restarts.
+
+        The other arguments are as for startSubProcess.
+    '''
+    if pidfiles is None:
+        names = [rtl.name for rtl in receivers]
+        if None in names or len(set(names)) != len(names):
+            raise ValueError("receivers need unique names")
+        pidfiles = [receiverPIDs(name, pid_dir) for name in names]
+
+    pid = str(os.getpid())
+    locked = []
+    try:
+        for logger_pid, rtl_pid in pidfiles:
+            createPID(logger_pid, pid)
+            locked.append(logger_pid)
+    except alreadyRunningError:
+        for logger_pid in locked:
+            deletePID(logger_pid)
+        raise
+
+    # Every receiver's lines go on the one stdout_queue.
+    journal = spillJournal(spill_path or database.db_path + '-spill')
+    stdout_queue = spillQueue(journal, queue_size)
     stderr_queue = Queue.Queue()
-    stderr_reader = asyncFileReader(process.stderr, stderr_queue)
-    stderr_reader.start()
-   
+    processes = [receiverProcess(rtl, rtl_pid, stdout_queue, stderr_queue,
+                                 restartBackoff(backoff, max_backoff)
+                                 if restart else None, capture, chunk_size)
+                 for rtl, (logger_pid, rtl_pid) in zip(receivers, pidfiles)]
+
     # do queue loop, entering data to database
-    # Check the queues if we received some output until there is nothing more 
-    # to get.
-   
-    # print(stderr_queue.empty())
-    # print(stderr_queue.get())
-    # print(stderr_queue.get())
-    # print(stderr_queue.get())
-    # print(stderr_reader.eof())
-    # print(stderr_queue.empty())
-    
-    #print('Starting reader loop')    
-    while not stdout_reader.eof() or not stderr_reader.eof(): 
-        # Show what we received from standard output.
-        #print('a')
-        while not stdout_queue.empty():     # Whilst we have data.
-            #print('b')
-            while not stderr_queue.empty(): # Whilst we have no errors
-                #print('Starting loop')
-                line = stdout_queue.get()
-                #print(line)
+    latency = latencyStats()
+    metrics = pipelineMetrics()
+    latest, latest_server = serveLatest(database, latest_address)
+    writer = batchWriter(database, batch_size, flush_interval, latency,
+                         metrics=metrics, retention=retention, latest=latest)
+    dedup = dedupCache(dedup_window)
+    if parser is None:
+        parser = rtl_433_parse.lineParser()
+    metrics.watch(writer, dedup, deadband, stdout_queue, journal,
+                  [process.gaps for process in processes], retention, latest,
+                  capture, parser)
+    server = None
+    if metrics_address is not None:
+        server = rtl_433_metrics.serve(metrics.registry, metrics_address)
+    try:
+        for process in processes:
+            process.start()
+        consumeLines(processes, stdout_queue, writer, dedup, deadband,
+                     stderr_queue, report_interval, metrics, parser)
+    except KeyboardInterrupt:
+        # Stop reading, but write what has already been read.
+        for process in processes:
+            process.stop()
+        consumeLines(processes, stdout_queue, writer, dedup, deadband,
+                     stderr_queue, None, metrics, parser)
+    finally:
+        for process in processes:
+            process.stop()
+        for running in (server, latest_server):
+            if running is not None:
+                running.shutdown()
+                running.server_close()
+
+        try:
+            database.close()
+        except:
+             pass
+
+        journal.close()
+        if capture is not None:
+            capture.close()
+
+        for logger_pid, rtl_pid in pidfiles:
+            deletePID(logger_pid)
+
+async def _readStdout(stream, queue, dedup, deadband=None, parser=None,
+                      journal=None, metrics=None, gaps=None, capture=None):
+    ''' Reads lines from an asyncio stream, until EOF, parses them with
+        parser, a rtl_433_parse.lineParser, and puts
+        (json_data, read_time) on queue, unless dedup says they are
+        repeats or deadband that they haven't changed. The first line and
+        EOF are reported to gaps, a gapTimer.
+
+        If journal is a spillJournal, lines that don't fit on queue are
+        appended to it instead of waiting for room. Lines and parse
+        failures are counted in metrics, a pipelineMetrics. Every line is
+        written to capture, a rtl_433_capture.captureWriter, if given.
+    '''
+    if metrics is None:
+        metrics = pipelineMetrics()
+    if gaps is None:
+        gaps = gapTimer()
+    if parser is None:
+        parser = rtl_433_parse.lineParser()
+    first = True
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        read_time = time.monotonic()
+        if first:
+            gaps.read(read_time)
+            first = False
+        if capture is not None:
+            capture.write(line)
+        metrics.lines.inc()
+        failures = parser.failures
+        for data in parser.parse([line]):
+            if dedup.admit(data, read_time) and (
+                    deadband is None
+                    or deadband.admit(data, monotonicToMillis(read_time))):
+                # Once anything is spilled, newer lines follow it into the
+                # journal until it is drained, to keep them in order.
+                if journal is not None and (journal.pending or queue.full()):
+                    journal.append(monotonicToMillis(read_time), line)
+                else:
+                    await queue.put((data, read_time))
+        metrics.parse_failures.inc(parser.failures - failures)
+    gaps.ended(time.monotonic())
+
+async def _readStderr(stream):
+    ''' Passes anything rtl_433 writes to stderr on to our stderr.
+    '''
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        sys.stderr.write("rtl_433: " + line.decode("utf-8", "replace"))
+
+async def _commitBatch(writer, executor, journal=None):
+    ''' Commits what writer has buffered on executor, then checkpoints
+        journal if writer has settled. Returns False if it couldn't be
+        written, see batchWriter.commit().
+    '''
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(executor, writer.commit, writer.take()):
+        return False
+    if journal is not None and writer.settled():
+        journal.checkpoint()
+    return True
+
+async def _writeBatches(queue, writer, executor, report_interval, dedup,
+                        deadband=None, journal=None, metrics=None,
+                        parser=None):
+    ''' Collects parsed readings from queue into batches and commits them
+        on executor, so the event loop keeps reading while sqlite syncs.
+        Lines spilled to journal are taken once queue is empty, and parsed
+        with parser. They may have been spilled by the thread engine, so
+        garbled lines are counted in metrics and skipped. Returns when None
+        is taken from the queue and journal is drained.
+
+        While writer is waiting() to retry a failed commit nothing more is
+        taken, so the reader spills to journal once queue is full.
+    '''
+    if parser is None:
+        parser = rtl_433_parse.lineParser()
+    last_report = time.monotonic()
+    finished = False
+    while True:
+        if writer.waiting():
+            await asyncio.sleep(writer.timeout(IDLE_TIMEOUT))
+            continue
+        try:
+            # Only pay for a timeout when there is nothing waiting.
+            item = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            if journal is not None and journal.pending:
+                millis, line, receiver = journal.read()
+                failures = parser.failures
+                item = False
+                for data in parser.parse([line]):
+                    if receiver is not None:
+                        data['receiver'] = receiver
+                    item = (data, millisToMonotonic(millis))
+                if metrics is not None:
+                    metrics.parse_failures.inc(parser.failures - failures)
+            elif finished:
+                break
+            else:
                 try:
-                    data = json.loads(line.decode("utf-8"))
-                    #print(data)
-                    database.write(data) 
-                except json.decoder.JSONDecodeError:
-                    # Garbled data from RTL_433
-                    #print('Garbeled data')
-                    pass
-
-        # Sleep a bit before asking the readers again.
-        #print('Starting sleeping')
-        time.sleep(15)
-        #print('Finished sleeping')
-    
-   # print('Finished looping')
-    # Let's be tidy and join the threads we've started.
+                    item = await asyncio.wait_for(queue.get(),
+                                                  writer.timeout(IDLE_TIMEOUT))
+                except asyncio.TimeoutError:
+                    item = False
+        if item is None:
+            finished = True
+        elif item:
+            writer.add(*item)
+
+        if writer.full() or writer.due():
+            await _commitBatch(writer, executor, journal)
+
+        if (report_interval is not None
+                and time.monotonic() - last_report >= report_interval):
+            print(writer.latency.report())
+            print(dedup.report())
+            if deadband is not None:
+                print(deadband.report())
+            if writer.retention is not None:
+                print(writer.retention.report())
+            print(parser.report())
+            if journal is not None:
+                print(journal.report())
+            if metrics is not None:
+                print(metrics.report())
+            last_report = time.monotonic()
+
+    while not await _commitBatch(writer, executor, journal):
+        await asyncio.sleep(writer.timeout(IDLE_TIMEOUT))
+
+async def _runProcess(command, queue, dedup, deadband, journal, metrics,
+                      gaps, capture=None, parser=None):
+    ''' Runs command once, reading its output onto queue, see _readStdout,
+        and returns its exit code.
+    '''
+    process = await asyncio.create_subprocess_exec(
+                        *command,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE)
+    createPID('/tmp/rtl_433.pid', process.pid)
+    try:
+        await asyncio.gather(_readStdout(process.stdout, queue, dedup,
+                                         deadband, parser, journal=journal,
+                                         metrics=metrics, gaps=gaps,
+                                         capture=capture),
+                             _readStderr(process.stderr))
+        return await process.wait()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        deletePID('/tmp/rtl_433.pid')
+
+async def asyncIngest(command, database, batch_size=100, flush_interval=1000,
+                      report_interval=60, dedup_window=2000, deadband=None,
+                      queue_size=10000, journal=None, metrics=None,
+                      backoff=None, retention=None, latest=None,
+                      capture=None, parser=None):
+    ''' Runs command and writes its JSON output to database, all on the
+        running event loop. sqlite is only touched from a single worker
+        thread, as a connection can't be shared between threads.
+
+        At most queue_size readings wait in memory. With a spillJournal
+        the rest are spilled to it, without one the reader waits for room.
+        Progress is recorded in metrics, a pipelineMetrics.
+
+        With a restartBackoff, command is run again whenever it exits and
+        this only returns when it is cancelled. The writer carries on
+        across restarts, and if it fails, reading stops and its error is
+        raised. A retentionPolicy is run on the worker thread
+        after each commit, and a latestCache updated. Lines are written to
+        capture, a rtl_433_capture.captureWriter, if given, and parsed by
+        parser, a rtl_433_parse.lineParser.
+    '''
+    if metrics is None:
+        metrics = pipelineMetrics()
+    if parser is None:
+        parser = rtl_433_parse.lineParser()
+    queue = asyncio.Queue(maxsize=queue_size)
+    writer = batchWriter(database, batch_size, flush_interval,
+                         latencyStats(), auto_flush=False, metrics=metrics,
+                         retention=retention, latest=latest)
+    dedup = dedupCache(dedup_window)
+    gaps = gapTimer()
+    metrics.watch(writer, dedup, deadband, queue, journal, [gaps], retention,
+                  latest, capture, parser)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.get_running_loop()
+    writing = asyncio.ensure_future(_writeBatches(queue, writer, executor,
+                                                  report_interval, dedup,
+                                                  deadband, journal, metrics,
+                                                  parser))
+    running = None
+    try:
+        while True:
+            started = time.monotonic()
+            running = asyncio.ensure_future(
+                            _runProcess(command, queue, dedup, deadband,
+                                        journal, metrics, gaps, capture,
+                                        parser))
+            await asyncio.wait([running, writing],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if writing.done():
+                # The writer only returns once None is queued, so it has
+                # failed, and what is read now would never be written.
+                writing.result()
+            code = running.result()
+            if backoff is None:
+                break
+            delay = backoff.delay(time.monotonic() - started)
+            sys.stderr.write("rtl_433 exited with {}, restarting in {:g} s\n"
+                             .format(code, delay))
+            await asyncio.wait([writing], timeout=delay)
+            if writing.done():
+                writing.result()
+            gaps.restarts += 1
+        await queue.put(None)
+        await writing
+    finally:
+        if running is not None and not running.done():
+            running.cancel()
+            await asyncio.wait([running])
+        if not writing.done():
+            # Cancelled, write what has already been read. A commit it was
+            # waiting for carries on, and may put its batch back, so let
+            # it finish first.
+            writing.cancel()
+            await loop.run_in_executor(executor, lambda: None)
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item:
+                    writer.add(*item)
+            await _commitBatch(writer, executor, journal)
+        await loop.run_in_executor(executor, database.close)
+        executor.shutdown()
+
+def startAsyncSubProcess(rtl_path, database, debug=False,
+                         PIDFILE='/tmp/rtl_433_2sqlite.pid', batch_size=100,
+                         flush_interval=1000, report_interval=60,
+                         protocols=(39,), dedup_window=2000, deadband=None,
+                         queue_size=10000, spill_path=None,
+                         metrics_address=None, restart=False, backoff=1.0,
+                         max_backoff=60.0, retention=None,
+                         latest_address=None, capture=None, chunk_size=None,
+                         parser=None):
+    ''' The asyncio engine. Takes the same arguments as startSubProcess,
+        but reads rtl_433 with asyncio streams instead of a pair of
+        asyncFileReader threads. chunk_size isn't used, the streams
+        already read in chunks.
+    '''
+    createPID(PIDFILE, str(os.getpid()))
+    journal = spillJournal(spill_path or database.db_path + '-spill')
+    metrics = pipelineMetrics()
+    server = None
+    if metrics_address is not None:
+        server = rtl_433_metrics.serve(metrics.registry, metrics_address)
+    latest, latest_server = serveLatest(database, latest_address)
     try:
-        #print('Trying to close DB')
-        database.close()
-        #print('DB closed')
-    except:
-         pass
-        #print('Failed to close DB')
-
-    #print('Tying threads')
-    #print('Tying stdout')
-    stdout_reader.stop()
-    stdout_reader.join(1)
-    #print(stdout_reader.isAlive())
-    #print('Tying stderr')
-    stderr_reader.stop()
-    stderr_reader.join(1)
-
-    #print('Closing subprocessses')
-    # Close subprocess' file descriptors.
-    #print('Closing Stdout')
-    process.stdout.close()
-    #print(stdout_reader.isAlive())
-    stdout_reader.join()
-    #print(stdout_reader.isAlive())
-    #print('Closing StdErr')
-    process.stderr.close()
-    stdout_reader.join()
-    #print('Finished cosing subprocesses')
-
-    #print('Deleting PID file')
-    deletePID(PIDFILE)
+        asyncio.run(asyncIngest(rtlCommand(rtl_path, debug, protocols),
+                                database, batch_size, flush_interval,
+                                report_interval, dedup_window, deadband,
+                                queue_size, journal, metrics,
+                                restartBackoff(backoff, max_backoff)
+                                if restart else None, retention, latest,
+                                capture, parser))
+    finally:
+        for running in (server, latest_server):
+            if running is not None:
+                running.shutdown()
+                running.server_close()
+        journal.close()
+        if capture is not None:
+            capture.close()
+        deletePID(PIDFILE)
+
+# Ingestion engines that can be chosen in start_logger.py.
+ENGINES = {'thread' : startSubProcess,
+           'asyncio' : startAsyncSubProcess}
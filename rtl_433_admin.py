@@ -0,0 +1,196 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Maintenance commands for a database written by rtl_433_2sqlite.py. They
+# are safe to run while the logger is running, each works in small
+# transactions, apart from vacuum. Run with --help for the commands.
+#
+#   ./rtl_433_admin.py /media/piDrive/db/temperature_sensor/temperaturedb.sqlite backfill-rollups
+#
+# Ciarán Mooney 2017
+
+import argparse
+from datetime import datetime
+import sqlite3 as sq
+import time
+
+import rtl_433_2sqlite
+import rtl_433_export
+
+def pause(started):
+    ''' Waits as long as a chunk that began at time.monotonic() started
+        took, so the logger can get the write lock between chunks. sqlite
+        doesn't queue for it, and a waiter that retries while we hold it
+        each time would time out.
+    '''
+    time.sleep(time.monotonic() - started)
+
+def backfill_rollups(database, args):
+    ''' Adds rows written before the rollup tables existed to them.
+    '''
+    if not database.migrated:
+        # The rollups are moved to new ids by the migration.
+        print("the database needs migrating, which backfills the rollups")
+        migrate(database, args)
+        return
+    start = time.monotonic()
+    last = None
+    chunk = time.monotonic()
+    for last in database.backfill_rollups(args.chunk_size):
+        print("backfilled up to id {} ({:.0f} s)".format(
+              last, time.monotonic() - start))
+        pause(chunk)
+        chunk = time.monotonic()
+    if last is None:
+        print("rollups are up to date")
+
+def prune(database, args):
+    ''' Deletes readings older than --days, then frees the space they used.
+    '''
+    retention = rtl_433_2sqlite.retentionPolicy(
+                    int(args.days * rtl_433_2sqlite.DAY),
+                    chunk_size=args.chunk_size)
+    start = time.monotonic()
+    total = 0
+    while True:
+        deleted = database.prune(retention)
+        total += deleted
+        if deleted < args.chunk_size:
+            break
+        print("deleted {} rows ({:.0f} s)".format(total,
+                                                  time.monotonic() - start))
+    print("deleted {} rows, freed {} pages".format(
+          total, database.incremental_vacuum()))
+
+def vacuum(database, args):
+    ''' Rebuilds the database with auto_vacuum=INCREMENTAL, so retention can
+        free space as it goes. Locks the database until it is done, stop
+        the logger first.
+    '''
+    database.connect()
+    database.cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    database.cur.execute('VACUUM')
+    print("auto_vacuum is now {}".format(
+          database.cur.execute('PRAGMA auto_vacuum').fetchone()[0]))
+
+def pack_io(database, args):
+    ''' Packs the io text of rows written before it was stored packed and
+        reports how much smaller the column and the file are.
+    '''
+    def sizes():
+        database.connect()
+        io_bytes = database.cur.execute('SELECT TOTAL(length(io)) '
+                                        'FROM sensor_data').fetchone()[0]
+        pages = database.cur.execute('PRAGMA page_count').fetchone()[0]
+        free = database.cur.execute('PRAGMA freelist_count').fetchone()[0]
+        page_size = database.cur.execute('PRAGMA page_size').fetchone()[0]
+        database.close()
+        return int(io_bytes), (pages - free) * page_size
+
+    io_before, used_before = sizes()
+    start = time.monotonic()
+    chunk = time.monotonic()
+    for last in database.pack_io(args.chunk_size):
+        print("packed up to id {} ({:.0f} s)".format(
+              last, time.monotonic() - start))
+        pause(chunk)
+        chunk = time.monotonic()
+    database.incremental_vacuum()
+    database.close()
+    io_after, used_after = sizes()
+    print("io: {} -> {} bytes, {:.0f}% smaller".format(
+          io_before, io_after,
+          100 * (1 - io_after / io_before) if io_before else 0))
+    print("pages in use: {} -> {} bytes, {:.0f}% smaller".format(
+          used_before, used_after,
+          100 * (1 - used_after / used_before) if used_before else 0))
+    print("run vacuum, with the logger stopped, to hand the space in "
+          "half empty pages back")
+
+def migrate(database, args):
+    ''' Brings the database up to the current schema version. The logger
+        does this too, a chunk after each of its batches, this does it
+        with larger chunks and a pause after each.
+    '''
+    start = time.monotonic()
+    print("schema version {}".format(database.version))
+    while True:
+        chunk = time.monotonic()
+        if database.migrate_step(args.chunk_size):
+            break
+        print("schema version {}, migrating ({:.0f} s)".format(
+              database.version, time.monotonic() - start))
+        pause(chunk)
+    print("schema version {}, up to date".format(database.version))
+
+def export(database, args):
+    ''' Writes date, sensorID and temperature_C to a .parquet, .arrow or
+        .npy file, streaming them in chunks.
+    '''
+    start = time.monotonic()
+    pool = database.read_pool(size=1)
+    try:
+        rows = rtl_433_export.export(pool, args.out, args.start, args.end,
+                                     args.sensor, args.chunk_size,
+                                     args.incremental)
+    finally:
+        pool.close()
+    print("exported {} rows to {} ({:.0f} s)".format(
+          rows, args.out, time.monotonic() - start))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                    description='Maintenance for rtl_433_2sqlite databases.')
+    parser.add_argument('db', help="database file")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    backfill = commands.add_parser('backfill-rollups',
+                                   help=backfill_rollups.__doc__)
+    backfill.add_argument('--chunk-size', type=int, default=50000,
+                          help="rows per transaction")
+    backfill.set_defaults(func=backfill_rollups)
+
+    pruning = commands.add_parser('prune', help=prune.__doc__)
+    pruning.add_argument('--days', type=float, default=90,
+                         help="days of readings to keep")
+    pruning.add_argument('--chunk-size', type=int, default=5000,
+                         help="rows per transaction")
+    pruning.set_defaults(func=prune)
+
+    vacuuming = commands.add_parser('vacuum', help=vacuum.__doc__)
+    vacuuming.set_defaults(func=vacuum)
+
+    packing = commands.add_parser('pack-io', help=pack_io.__doc__)
+    packing.add_argument('--chunk-size', type=int, default=50000,
+                         help="rows per transaction")
+    packing.set_defaults(func=pack_io)
+
+    migrating = commands.add_parser('migrate', help=migrate.__doc__)
+    migrating.add_argument('--chunk-size', type=int, default=50000,
+                           help="rows per transaction")
+    migrating.set_defaults(func=migrate)
+
+    exporting = commands.add_parser('export', help=export.__doc__)
+    exporting.add_argument('out', help="file to write, its extension is "
+                                       "the format")
+    exporting.add_argument('--start', type=datetime.fromisoformat,
+                           help="first local date and time, e.g. 2017-10-01")
+    exporting.add_argument('--end', type=datetime.fromisoformat,
+                           help="local date and time to stop before")
+    exporting.add_argument('--sensor', type=int, action='append',
+                           help="sensorID to export, can be repeated")
+    exporting.add_argument('--chunk-size', type=int, default=10000,
+                           help="rows read and written at a time")
+    exporting.add_argument('--incremental', metavar='STATE',
+                           help="only export rows added since the last "
+                                "export that used the STATE file")
+    exporting.set_defaults(func=export)
+
+    args = parser.parse_args(argv)
+    database = rtl_433_2sqlite.initDatabase(sq, args.db)
+    args.func(database, args)
+    database.close()
+
+if __name__ == '__main__':
+    main()
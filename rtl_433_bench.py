@@ -0,0 +1,428 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for rtl_433_2sqlite. Each benchmark is a subcommand, run with
+# --help for the options. Results are printed to stdout.
+#
+#   ./rtl_433_bench.py writer --rows 2000 --db /media/piDrive/bench.sqlite
+#
+# Ciarán Mooney 2017
+
+import argparse
+import json
+import os
+import queue as Queue
+import resource
+import sqlite3 as sq
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import rtl_433_2sqlite
+import rtl_433_parse
+import rtl_433_query
+
+SAMPLE = {"time" : "@0.000000s", "model" : "WG-PB12V1",
+          "id" : 8, "temperature_C" : 20.900,
+          "io" : "111111110011001001100001011010001111111101001100"}
+
+def fresh_database(path):
+    ''' Removes any database at path and returns a new initDatabase.
+    '''
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+    return rtl_433_2sqlite.initDatabase(sq, path)
+
+def report(name, rows, seconds):
+    ''' Prints a single result line.
+    '''
+    print("{:<24} {:>9} rows {:>9.3f} s {:>11.1f} rows/s".format(
+          name, rows, seconds, rows / seconds))
+
+def bench_writer(args):
+    ''' Rows/s for the original per-row write() against the batchWriter.
+    '''
+    database = fresh_database(args.db)
+    start = time.perf_counter()
+    for _ in range(args.rows):
+        database.write(SAMPLE)
+    report("write (per row)", args.rows, time.perf_counter() - start)
+
+    database = fresh_database(args.db)
+    writer = rtl_433_2sqlite.batchWriter(database, args.batch_size,
+                                         args.flush_interval)
+    start = time.perf_counter()
+    for _ in range(args.rows):
+        writer.add(SAMPLE)
+    writer.flush()
+    report("batchWriter ({})".format(args.batch_size), args.rows,
+           time.perf_counter() - start)
+    database.close()
+
+FAKE_RTL_433 = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fake_rtl_433.py')
+
+def fake_environment(**options):
+    ''' Sets FAKE_RTL_433_* so the engines, which only pass rtl_433 options,
+        run fake_rtl_433.py with these ones.
+    '''
+    for name, value in options.items():
+        os.environ['FAKE_RTL_433_' + name.upper()] = str(value)
+
+def bench_engines(args):
+    ''' Throughput, CPU% and context switches of the thread and asyncio
+        engines reading the same fake_rtl_433.py output.
+    '''
+    directory = tempfile.mkdtemp()
+    fake_environment(count=args.rows, rate=args.rate, sensors=args.sensors)
+    print("{:<8} {:>9} {:>9} {:>11} {:>6} {:>9}".format(
+          "engine", "rows", "seconds", "rows/s", "CPU%", "ctx sw"))
+    for name in args.engine:
+        database = fresh_database(args.db)
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        rtl_433_2sqlite.ENGINES[name](FAKE_RTL_433, database,
+                                      PIDFILE=os.path.join(directory, 'pid'),
+                                      batch_size=args.batch_size,
+                                      report_interval=None,
+                                      dedup_window=0,
+                                      chunk_size=args.chunk_size)
+        seconds = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (after.ru_utime - before.ru_utime
+               + after.ru_stime - before.ru_stime)
+        switches = (after.ru_nvcsw - before.ru_nvcsw
+                    + after.ru_nivcsw - before.ru_nivcsw)
+        database.connect()
+        database.cur.execute("SELECT COUNT(*) FROM sensor_data")
+        rows = database.cur.fetchone()[0]
+        database.close()
+        print("{:<8} {:>9} {:>9.3f} {:>11.1f} {:>6.1f} {:>9}".format(
+              name, rows, seconds, rows / seconds, 100 * cpu / seconds,
+              switches))
+
+def synthetic_rows(first, count, sensors, interval=60000):
+    ''' Yields sensor_data rows for INSERT, sensors readings every interval
+        milliseconds, carrying on from row first.
+    '''
+    for n in range(first, first + count):
+        yield (n // sensors * interval, n % sensors, 20.0 + (n % 100) / 10,
+               SAMPLE['io'], SAMPLE['model'], None, None, None, None, None)
+
+def time_query(function, repeat):
+    ''' Returns the mean time, in milliseconds, of repeat calls.
+    '''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+def bench_query(args):
+    ''' Query latency as a synthetic table grows to --rows, measured each
+        time it grows tenfold.
+    '''
+    database = fresh_database(args.db)
+    pool = database.read_pool(size=1)
+    query = rtl_433_query.sensorQuery(pool)
+    print("{:>10} {:>11} {:>11} {:>13}".format(
+          "rows", "latest ms", "24h ms", "latest_all ms"))
+    written = 0
+    size = 10000
+    while written < args.rows:
+        size = min(size, args.rows)
+        database.connect()
+        with database.db:
+            database.cur.executemany(database.INSERT,
+                                     synthetic_rows(written, size - written,
+                                                    args.sensors))
+        database.close()
+        written = size
+        size *= 10
+
+        end = written // args.sensors * 60000
+        sensor = args.sensors // 2
+        print("{:>10} {:>11.3f} {:>11.3f} {:>13.3f}".format(
+              written,
+              time_query(lambda: query.latest(sensor), args.repeat),
+              time_query(lambda: query.range(sensor, end - 86400000, end),
+                         args.repeat),
+              time_query(query.latest_all, args.repeat)))
+    pool.close()
+
+def bench_replay(args):
+    ''' Replays captured rtl_433 JSON through the real reader, parser and
+        writer and reports throughput, latency and peak memory.
+    '''
+    database = fresh_database(args.db)
+    stats = rtl_433_2sqlite.replay(args.capture, database, args.pace,
+                                   args.speed, args.batch_size,
+                                   dedup_window=args.dedup_window,
+                                   chunk_size=args.chunk_size)
+    print("lines       {lines:>10}\n"
+          "rows        {rows:>10}\n"
+          "parse fails {parse_failures:>10}\n"
+          "seconds     {seconds:>10.3f}\n"
+          "lines/s     {lines_per_s:>10.1f}\n"
+          "rows/s      {rows_per_s:>10.1f}\n"
+          "p50 ms      {p50_ms:>10.1f}\n"
+          "p99 ms      {p99_ms:>10.1f}\n"
+          "peak RSS kB {peak_rss_kb:>10}".format(**stats))
+
+def reader_run(data, chunk_size):
+    ''' Feeds data through a pipe to an asyncFileReader and takes what it
+        puts on its queue, as consumeLines does. Returns (lines, queue
+        operations, seconds).
+    '''
+    read_fd, write_fd = os.pipe()
+    pipe = open(read_fd, 'rb')
+    stdout_queue = Queue.Queue()
+    reader = rtl_433_2sqlite.asyncFileReader(pipe, stdout_queue, stamp=True,
+                                             chunk_size=chunk_size)
+
+    def feed():
+        with open(write_fd, 'wb') as out:
+            out.write(data)
+    feeder = threading.Thread(target=feed)
+
+    lines = gets = 0
+    start = time.perf_counter()
+    feeder.start()
+    reader.start()
+    while not reader.eof():
+        try:
+            _, line, _ = stdout_queue.get(timeout=0.1)
+        except Queue.Empty:
+            continue
+        gets += 1
+        lines += len(line) if isinstance(line, list) else 1
+    seconds = time.perf_counter() - start
+    feeder.join()
+    reader.join()
+    pipe.close()
+    return lines, gets, seconds
+
+def bench_reader(args):
+    ''' Lines/s from a pipe to the consumer for the readline reader against
+        the chunked one, without parsing or writing.
+    '''
+    line = (json.dumps(SAMPLE) + '\n').encode('utf-8')
+    data = line * args.lines
+    print("{:<24} {:>9} {:>9} {:>9} {:>12}".format(
+          "reader", "lines", "gets", "seconds", "lines/s"))
+    for chunk_size in [None] + args.chunk_size:
+        lines, gets, seconds = reader_run(data, chunk_size)
+        print("{:<24} {:>9} {:>9} {:>9.3f} {:>12.1f}".format(
+              "readline" if chunk_size is None
+              else "chunked {}".format(chunk_size),
+              lines, gets, seconds, lines / seconds))
+
+def bench_parser(args):
+    ''' Lines/s per core for each JSON backend, a line at a time as the
+        reader used to give them and in batches as the chunked reader
+        does, with and without the model pre-filter.
+    '''
+    # A mix of wanted readings, other models and garbled lines.
+    other = dict(SAMPLE, model="Acurite-Tower", id=1234)
+    lines = []
+    for n in range(args.lines):
+        if n % 100 == 99:
+            lines.append(b'{"time" : "@0.0s", "model" : "WG-PB\n')
+        elif n % 2:
+            lines.append((json.dumps(other) + '\n').encode('utf-8'))
+        else:
+            lines.append((json.dumps(SAMPLE) + '\n').encode('utf-8'))
+    batches = [lines[n:n + args.batch_size]
+               for n in range(0, len(lines), args.batch_size)]
+    print("{:<8} {:<8} {:<10} {:>9} {:>12}".format(
+          "backend", "models", "batches", "readings", "lines/s/core"))
+    for backend in rtl_433_parse.BACKENDS:
+        try:
+            rtl_433_parse.loader(backend)
+        except RuntimeError:
+            print("{:<8} not installed".format(backend))
+            continue
+        for models in (None, [SAMPLE['model']]):
+            for batched in (False, True):
+                parser = rtl_433_parse.lineParser(models, backend)
+                readings = 0
+                # CPU time, so it is per core whatever else is running.
+                start = time.process_time()
+                if batched:
+                    for batch in batches:
+                        readings += len(parser.parse(batch))
+                else:
+                    for line in lines:
+                        readings += len(parser.parse([line]))
+                seconds = time.process_time() - start
+                print("{:<8} {:<8} {:<10} {:>9} {:>12.0f}".format(
+                      backend, "some" if models else "all",
+                      args.batch_size if batched else "no", readings,
+                      len(lines) / seconds))
+
+def queue_growth(samples):
+    ''' Returns the least squares slope, in lines/s, of (seconds, depth)
+        samples.
+    '''
+    count = len(samples)
+    mean_t = sum(t for t, _ in samples) / count
+    mean_d = sum(d for _, d in samples) / count
+    spread = sum((t - mean_t) ** 2 for t, _ in samples)
+    if not spread:
+        return 0.0
+    return sum((t - mean_t) * (d - mean_d) for t, d in samples) / spread
+
+def stress_run(args, rate):
+    ''' Runs fake_rtl_433.py at rate packets/s for args.duration seconds into
+        the thread engine's consumer, sampling the stdout queue depth.
+        Returns (rows, p99_ms, peak depth, growth in lines/s).
+    '''
+    database = fresh_database(args.db)
+    latency = rtl_433_2sqlite.latencyStats(samples=None)
+    writer = rtl_433_2sqlite.batchWriter(database, args.batch_size,
+                                         latency=latency)
+    dedup = rtl_433_2sqlite.dedupCache(args.dedup_window)
+    process = subprocess.Popen([sys.executable, FAKE_RTL_433,
+                                '--rate', str(rate),
+                                '--duration', str(args.duration),
+                                '--sensors', str(args.sensors),
+                                '--repeats', str(args.repeats),
+                                '--garble', str(args.garble)],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    stdout_queue = Queue.Queue()
+    reader = rtl_433_2sqlite.asyncFileReader(process.stdout, stdout_queue,
+                                             stamp=True)
+
+    samples = []
+    done = threading.Event()
+    def sample():
+        start = time.monotonic()
+        while not done.wait(0.1):
+            samples.append((time.monotonic() - start, stdout_queue.qsize()))
+    sampler = threading.Thread(target=sample)
+
+    reader.start()
+    sampler.start()
+    rtl_433_2sqlite.consumeLines([reader], stdout_queue, writer, dedup)
+    done.set()
+    sampler.join()
+    reader.join()
+    process.wait()
+    process.stdout.close()
+    database.close()
+
+    # Only the producing part of the run says whether the consumer keeps up,
+    # after it the queue can only drain.
+    producing = [s for s in samples if s[0] <= args.duration] or [(0, 0)]
+    return (writer.rows, latency.percentile(99) * 1000,
+            max(d for _, d in samples) if samples else 0,
+            queue_growth(producing))
+
+def bench_stress(args):
+    ''' Raises the fake_rtl_433.py rate until the stdout queue grows
+        without bound, the throughput at which the logger can't keep up.
+    '''
+    print("{:>9} {:>9} {:>9} {:>10} {:>12}".format(
+          "rate", "rows", "p99 ms", "max depth", "growth/s"))
+    rate = args.start
+    while rate <= args.max_rate:
+        rows, p99, depth, growth = stress_run(args, rate)
+        lines = rate * args.repeats
+        print("{:>9.0f} {:>9} {:>9.1f} {:>10} {:>12.1f}".format(
+              lines, rows, p99, depth, growth))
+        # A queue that grows by more than a tenth of the offered lines is
+        # only ever going to get longer.
+        if growth > lines * 0.1:
+            print("saturated at about {:.0f} lines/s".format(lines))
+            return
+        rate *= args.factor
+    print("kept up to {:.0f} lines/s".format(args.max_rate * args.repeats))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for rtl_433_2sqlite.')
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(),
+                                                     'rtl_433_bench.sqlite'),
+                        help="database file, put it on the drive you log to")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    writer = commands.add_parser('writer', help=bench_writer.__doc__)
+    writer.add_argument('--rows', type=int, default=2000)
+    writer.add_argument('--batch-size', type=int, default=100)
+    writer.add_argument('--flush-interval', type=int, default=1000)
+    writer.set_defaults(func=bench_writer)
+
+    engines = commands.add_parser('engines', help=bench_engines.__doc__)
+    engines.add_argument('--rows', type=int, default=20000)
+    engines.add_argument('--rate', type=float, default=0,
+                         help="lines/s from fake_rtl_433.py, 0 for flat out")
+    engines.add_argument('--sensors', type=int, default=10)
+    engines.add_argument('--batch-size', type=int, default=100)
+    engines.add_argument('--engine', action='append',
+                         choices=sorted(rtl_433_2sqlite.ENGINES),
+                         help="engine to run, may be repeated (default all)")
+    engines.add_argument('--chunk-size', type=int,
+                         help="thread engine read size, default a line at a "
+                              "time")
+    engines.set_defaults(func=bench_engines)
+
+    query = commands.add_parser('query', help=bench_query.__doc__)
+    query.add_argument('--rows', type=int, default=10000000)
+    query.add_argument('--sensors', type=int, default=20)
+    query.add_argument('--repeat', type=int, default=100)
+    query.set_defaults(func=bench_query)
+
+    replay = commands.add_parser('replay', help=bench_replay.__doc__)
+    replay.add_argument('capture', help="file of rtl_433 -F json lines")
+    replay.add_argument('--pace', action='store_true',
+                        help="replay at the recorded pace, from the time field")
+    replay.add_argument('--speed', type=float, default=1.0,
+                        help="with --pace, replay this many times faster")
+    replay.add_argument('--batch-size', type=int, default=100)
+    replay.add_argument('--dedup-window', type=int, default=2000)
+    replay.add_argument('--chunk-size', type=int,
+                        help="read the capture this many bytes at a time")
+    replay.set_defaults(func=bench_replay)
+
+    reader = commands.add_parser('reader', help=bench_reader.__doc__)
+    reader.add_argument('--lines', type=int, default=200000)
+    reader.add_argument('--chunk-size', type=int, action='append',
+                        help="chunked reader buffer, may be repeated "
+                             "(default 4096 and 65536)")
+    reader.set_defaults(func=bench_reader)
+
+    parse = commands.add_parser('parser', help=bench_parser.__doc__)
+    parse.add_argument('--lines', type=int, default=200000)
+    parse.add_argument('--batch-size', type=int, default=400,
+                       help="lines per batch, about a 64 KiB read")
+    parse.set_defaults(func=bench_parser)
+
+    stress = commands.add_parser('stress', help=bench_stress.__doc__)
+    stress.add_argument('--start', type=float, default=500,
+                        help="first rate, packets/s")
+    stress.add_argument('--factor', type=float, default=2)
+    stress.add_argument('--max-rate', type=float, default=64000)
+    stress.add_argument('--duration', type=float, default=5,
+                        help="seconds at each rate")
+    stress.add_argument('--sensors', type=int, default=50)
+    stress.add_argument('--repeats', type=int, default=1,
+                        help="lines per packet")
+    stress.add_argument('--garble', type=float, default=0)
+    stress.add_argument('--batch-size', type=int, default=100)
+    stress.add_argument('--dedup-window', type=int, default=2000)
+    stress.set_defaults(func=bench_stress)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'engine', False) is None:
+        args.engine = ['thread', 'asyncio']
+    if args.command == 'reader' and args.chunk_size is None:
+        args.chunk_size = [4096, 65536]
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
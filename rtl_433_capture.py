@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# A raw capture of what rtl_433 writes, for forensics and for feeding back
+# through rtl_433_bench.py replay. Lines are handed to a captureWriter,
+# which appends them to a file from its own thread, so the readers never
+# wait on the disk:
+#
+#   capture = rtl_433_capture.captureWriter('/media/piDrive/capture.json',
+#                                           max_bytes=64 << 20,
+#                                           compress='gzip')
+#   capture.write(line)
+#   capture.close()
+#
+# The file is rotated, renamed with the UTC time, once it reaches max_bytes
+# or max_seconds, and the old segment compressed with gzip, or zstd if the
+# zstandard package is installed.
+#
+# Ciarán Mooney 2017
+
+import gzip
+import io
+import os
+import queue as Queue
+import shutil
+import threading
+import time
+
+# Extension for compressed segments.
+EXTENSIONS = {'gzip' : '.gz', 'zstd' : '.zst'}
+
+def compressFile(path, compress):
+    ''' Compresses path to path plus its EXTENSIONS and removes it.
+    '''
+    target = path + EXTENSIONS[compress]
+    with open(path, 'rb') as source:
+        if compress == 'gzip':
+            with gzip.open(target + '.tmp', 'wb') as out:
+                shutil.copyfileobj(source, out, 1 << 20)
+        else:
+            import zstandard
+            with open(target + '.tmp', 'wb') as out:
+                zstandard.ZstdCompressor().copy_stream(source, out)
+    os.replace(target + '.tmp', target)
+    os.remove(path)
+
+def lineCount(data):
+    ''' The number of lines in data, bytes or str, counting a last one
+        with no newline.
+    '''
+    newline = '\n' if isinstance(data, str) else b'\n'
+    return data.count(newline) + (not data.endswith(newline))
+
+def openCapture(path):
+    ''' Opens a capture, or a rotated segment of one, compressed or not,
+        for reading lines as bytes.
+    '''
+    if path.endswith(EXTENSIONS['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(EXTENSIONS['zstd']):
+        import zstandard
+        return io.BufferedReader(
+                    zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                               closefd=True))
+    return open(path, 'rb')
+
+class captureWriter(threading.Thread):
+    ''' Appends lines to path from its own thread. write() only puts a line
+        on a queue of at most backlog lines. If the disk is so slow that
+        it fills, lines are dropped and counted rather than holding up the
+        caller. Buffered lines are flushed every flush_interval seconds.
+
+        path is rotated once it holds max_bytes, or has been open for
+        max_seconds, whichever comes first, None for no limit. Rotated
+        segments are compressed with compress, 'gzip', 'zstd' or None, on
+        a thread of their own, one at a time.
+    '''
+
+    def __init__(self, path, max_bytes=64 << 20, max_seconds=None,
+                 compress=None, backlog=10000, buffer_size=1 << 16,
+                 flush_interval=1.0):
+        if compress not in (None,) + tuple(EXTENSIONS):
+            raise ValueError("compress must be None, 'gzip' or 'zstd'")
+        if compress == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("zstd capture needs zstandard, "
+                                   "pip install zstandard, or use gzip")
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.lines = 0
+        self.dropped = 0
+        self.rotations = 0
+        self._queue = Queue.Queue(backlog)
+        self._file = None
+        self._compressor = None
+        self.start()
+
+    def write(self, line):
+        ''' Queues line, bytes or str, to be written. Never blocks. line
+            can be several lines, e.g. a chunked asyncFileReader's read,
+            which are then counted as one item of the backlog.
+        '''
+        try:
+            self._queue.put_nowait(line)
+        except Queue.Full:
+            self.dropped += lineCount(line)
+
+    def _open(self):
+        self._file = open(self.path, 'ab', buffering=self.buffer_size)
+        self._size = self._file.tell()
+        self._opened = time.monotonic()
+
+    def _due(self):
+        ''' True if the file should be rotated.
+        '''
+        return ((self.max_bytes is not None and self._size >= self.max_bytes)
+                or (self.max_seconds is not None
+                    and time.monotonic() - self._opened >= self.max_seconds))
+
+    def rotate(self):
+        ''' Closes the file and renames it with the time, then compresses
+            it if asked. Only called from the capture thread.
+        '''
+        self._file.close()
+        self._file = None
+        # To the microsecond, so that segments sort in the order written.
+        now = time.time()
+        stamp = '{}.{:06d}Z'.format(
+                    time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)),
+                    int(now % 1 * 1000000))
+        segment = '{}.{}'.format(self.path, stamp)
+        n = 1
+        while os.path.exists(segment) or os.path.exists(
+                segment + EXTENSIONS.get(self.compress, '')):
+            segment = '{}.{}-{}'.format(self.path, stamp, n)
+            n += 1
+        os.replace(self.path, segment)
+        self.rotations += 1
+        if self.compress is not None:
+            if self._compressor is not None:
+                self._compressor.join()
+            self._compressor = threading.Thread(target=compressFile,
+                                                args=(segment, self.compress),
+                                                daemon=True)
+            self._compressor.start()
+
+    def run(self):
+        self._open()
+        last_flush = time.monotonic()
+        while True:
+            try:
+                line = self._queue.get(timeout=self.flush_interval)
+            except Queue.Empty:
+                line = False
+            if line is None:
+                break
+            if line:
+                if isinstance(line, str):
+                    line = line.encode('utf-8')
+                if self._file is None:
+                    self._open()
+                self._file.write(line)
+                self._size += len(line)
+                self.lines += lineCount(line)
+            if self._file is not None and self._due():
+                if self._size:
+                    self.rotate()
+                else:
+                    self._opened = time.monotonic()
+            elif (self._file is not None
+                    and time.monotonic() - last_flush >= self.flush_interval):
+                self._file.flush()
+                last_flush = time.monotonic()
+        if self._file is not None:
+            self._file.close()
+        if self._compressor is not None:
+            self._compressor.join()
+
+    def close(self):
+        ''' Writes what is queued, closes the file and waits for any
+            compression to finish.
+        '''
+        if not self.is_alive():
+            return
+        self._queue.put(None)
+        self.join()
+
+    def report(self):
+        ''' Returns a one line summary of the counters.
+        '''
+        return "capture: {} lines, {} dropped, {} rotations".format(
+                    self.lines, self.dropped, self.rotations)
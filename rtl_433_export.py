@@ -0,0 +1,205 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Streams sensor_data out of a database written by rtl_433_2sqlite.py into
+# files analysis tools read directly: Parquet or Arrow, which need pyarrow,
+# or a NumPy .npy structured array, which needs nothing. Rows are read with
+# fetchmany() and written a chunk at a time, so memory use doesn't depend
+# on the size of the table.
+#
+#   pool = rtl_433_2sqlite.initDatabase(sq, DB_FILE).read_pool(size=1)
+#   rtl_433_export.export(pool, 'readings.parquet', sensors=[8])
+#
+# or from the command line, see rtl_433_admin.py export --help.
+#
+# Ciarán Mooney 2017
+
+import ast
+import json
+import os
+import struct
+
+import rtl_433_query
+
+# The columns exported, date is epoch milliseconds, UTC.
+COLUMNS = ('date', 'sensorID', 'temperature_C')
+
+def fetchChunks(pool, start=None, end=None, sensors=None, after_id=None,
+                chunk_size=10000):
+    ''' Yields lists of up to chunk_size (id, date, sensorID, temperature_C)
+        rows in id order, which is the order they were written. start and
+        end limit the dates, start included, see rtl_433_query.toMillis.
+        sensors is a list of sensorIDs, after_id skips rows up to it.
+
+        The rows come from one read transaction, so they are a consistent
+        snapshot however long the export takes.
+    '''
+    where = []
+    parameters = []
+    if start is not None:
+        where.append('date >= ?')
+        parameters.append(rtl_433_query.toMillis(start))
+    if end is not None:
+        where.append('date < ?')
+        parameters.append(rtl_433_query.toMillis(end))
+    if sensors is not None:
+        sensors = list(sensors)
+        where.append('sensorID IN ({})'.format(', '.join('?' * len(sensors))))
+        parameters.extend(sensors)
+    if after_id is not None:
+        where.append('id > ?')
+        parameters.append(after_id)
+    sql = 'SELECT id, {} FROM sensor_data'.format(', '.join(COLUMNS))
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY id'
+
+    with pool.connection() as db:
+        cursor = db.execute(sql, parameters)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+class npyWriter(object):
+    ''' Writes rows to a .npy file as a structured array of DTYPE, read with
+        numpy.load(). The header is written first with room for any shape
+        and filled in by close(). NULL sensorIDs are written as -1 and NULL
+        temperatures as NaN.
+    '''
+
+    DTYPE = [('date', '<M8[ms]'), ('sensorID', '<i8'),
+             ('temperature_C', '<f8')]
+    RECORD = struct.Struct('<qqd')
+    MAGIC = b'\x93NUMPY\x01\x00'
+    # Magic, header length and header, a multiple of 64 as numpy wants.
+    HEADER_SIZE = 192
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.count = 0
+        self._header()
+
+    def _header(self):
+        header = repr({'descr' : self.DTYPE, 'fortran_order' : False,
+                       'shape' : (self.count,)})
+        size = self.HEADER_SIZE - len(self.MAGIC) - 2
+        self.file.seek(0)
+        self.file.write(self.MAGIC + struct.pack('<H', size)
+                        + header.ljust(size - 1).encode('latin1') + b'\n')
+
+    def write(self, rows):
+        ''' Writes a chunk of (date, sensorID, temperature_C) rows.
+        '''
+        pack = self.RECORD.pack
+        nan = float('nan')
+        self.file.write(b''.join(pack(date,
+                                      -1 if sensor is None else sensor,
+                                      nan if temperature is None
+                                      else temperature)
+                                 for date, sensor, temperature in rows))
+        self.count += len(rows)
+
+    def close(self):
+        self._header()
+        self.file.close()
+
+def readNpy(path):
+    ''' Returns the dtype description and rows of a file written by
+        npyWriter, for reading one without numpy.
+    '''
+    with open(path, 'rb') as npy:
+        npy.seek(len(npyWriter.MAGIC))
+        size, = struct.unpack('<H', npy.read(2))
+        header = ast.literal_eval(npy.read(size).decode('latin1'))
+        rows = list(npyWriter.RECORD.iter_unpack(npy.read()))
+    return header['descr'], rows
+
+class arrowWriter(object):
+    ''' Writes rows to a Parquet file, one row group per chunk, or to an
+        Arrow IPC file, one record batch per chunk. Needs pyarrow.
+    '''
+
+    def __init__(self, path, parquet=True):
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError("exporting to Parquet or Arrow needs pyarrow, "
+                               "pip install pyarrow, or export to .npy")
+        self.pa = pyarrow
+        self.count = 0
+        self.schema = pyarrow.schema([
+                        ('date', pyarrow.timestamp('ms', tz='UTC')),
+                        ('sensorID', pyarrow.int64()),
+                        ('temperature_C', pyarrow.float64())])
+        if parquet:
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+        ''' Writes a chunk of (date, sensorID, temperature_C) rows.
+        '''
+        columns = list(zip(*rows))
+        self.writer.write_table(self.pa.table(
+            [self.pa.array(column, type=field.type)
+             for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+        self.count += len(rows)
+
+    def close(self):
+        self.writer.close()
+
+# Writer for each file extension.
+FORMATS = {'.parquet' : lambda path: arrowWriter(path, parquet=True),
+           '.arrow' : lambda path: arrowWriter(path, parquet=False),
+           '.feather' : lambda path: arrowWriter(path, parquet=False),
+           '.npy' : npyWriter}
+
+def loadState(state_path):
+    ''' Returns the last id exported according to state_path, or None if
+        nothing has been.
+    '''
+    try:
+        with open(state_path) as state:
+            return json.load(state)['last_id']
+    except FileNotFoundError:
+        return None
+
+def saveState(state_path, last_id):
+    ''' Records last_id in state_path, replacing it atomically.
+    '''
+    with open(state_path + '.tmp', 'w') as state:
+        json.dump({'last_id' : last_id}, state)
+    os.replace(state_path + '.tmp', state_path)
+
+def export(pool, path, start=None, end=None, sensors=None, chunk_size=10000,
+           state_path=None):
+    ''' Writes the rows of sensor_data matching start, end and sensors, see
+        fetchChunks, to path in the format given by its extension, see
+        FORMATS. Returns the number of rows written.
+
+        With state_path only rows added since the last export with the
+        same state_path are written, and the last id written is saved in
+        it once the file is complete.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError("can't export to {}, use one of {}".format(
+                            extension, ', '.join(sorted(FORMATS))))
+    after_id = loadState(state_path) if state_path is not None else None
+    last_id = after_id
+    writer = FORMATS[extension](path)
+    try:
+        for rows in fetchChunks(pool, start, end, sensors, after_id,
+                                chunk_size):
+            last_id = rows[-1][0]
+            writer.write([row[1:] for row in rows])
+    finally:
+        writer.close()
+    if state_path is not None and last_id is not None:
+        saveState(state_path, last_id)
+    return writer.count
@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Serves the logger's rtl_433_2sqlite.latestCache on a Unix socket, so that
+# programs such as the heating controller can have the newest reading of
+# each sensor without reading the database. Each request is a line, and
+# each answer a line of JSON:
+#
+#   latest <sensorID>         the newest reading of the sensor, or null
+#   all                       the newest reading of every sensor
+#   subscribe [sensorID ...]  each reading of those sensors, or all of them,
+#                             as it is written, until the socket is closed
+#
+# A reading is an object with the keys of latestCache.FIELDS, date is epoch
+# milliseconds. latestClient does the talking in Python:
+#
+#   client = rtl_433_latest.latestClient('/tmp/rtl_433_latest.sock')
+#   client.latest(8)['temperature_C']
+#
+# Ciarán Mooney 2017
+
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import rtl_433_metrics
+
+class latestHandler(socketserver.StreamRequestHandler):
+    ''' Answers requests on one connection until it is closed.
+    '''
+
+    def send(self, answer):
+        self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+
+    def handle(self):
+        cache = self.server.cache
+        try:
+            for line in self.rfile:
+                words = line.decode('utf-8', 'replace').split()
+                if not words:
+                    continue
+                try:
+                    sensors = [int(word) for word in words[1:]]
+                except ValueError:
+                    self.send({'error' : 'sensorIDs are integers'})
+                    continue
+                if words[0] == 'latest' and len(sensors) == 1:
+                    self.send(cache.get(sensors[0]))
+                elif words[0] == 'all' and not sensors:
+                    self.send(cache.all())
+                elif words[0] == 'subscribe':
+                    self.subscribe(cache, sensors or None)
+                    return
+                else:
+                    self.send({'error' : 'unknown request {!r}'.format(
+                                            line.decode('utf-8', 'replace')
+                                                .strip())})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def subscribe(self, cache, sensors):
+        ''' Sends readings as the cache is updated. Ends when the client
+            goes away, falls too far behind or the server is closed.
+        '''
+        updates = cache.subscribe(sensors)
+        try:
+            while True:
+                reading = updates.get()
+                if reading is None:
+                    return
+                self.send(reading)
+        finally:
+            cache.unsubscribe(updates)
+
+class latestServer(rtl_433_metrics.unixServer):
+    ''' Ends the subscriptions when it is closed.
+    '''
+
+    def server_close(self):
+        self.cache.close()
+        rtl_433_metrics.unixServer.server_close(self)
+
+def serve(cache, path):
+    ''' Serves cache, a latestCache, on the Unix socket path from a daemon
+        thread. Returns the server, call shutdown() and server_close() on
+        it to stop.
+    '''
+    # A socket left behind by a crash.
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    server = latestServer(path, latestHandler)
+    server.cache = cache
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+class latestClient(object):
+    ''' A connection to a latestCache served by serve(). Keep it open
+        between requests, each is then one round trip over the socket.
+    '''
+
+    def __init__(self, path, timeout=5.0):
+        self.socket = socket.socket(socket.AF_UNIX)
+        self.socket.settimeout(timeout)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rwb')
+
+    def _request(self, line):
+        self.file.write(line.encode('utf-8') + b'\n')
+        self.file.flush()
+        answer = json.loads(self.file.readline().decode('utf-8'))
+        if isinstance(answer, dict) and 'error' in answer:
+            raise ValueError(answer['error'])
+        return answer
+
+    def latest(self, sensor):
+        ''' Returns the newest reading of sensor, or None.
+        '''
+        return self._request('latest {:d}'.format(sensor))
+
+    def all(self):
+        ''' Returns the newest reading of every sensor.
+        '''
+        return self._request('all')
+
+    def subscribe(self, sensors=()):
+        ''' Yields each reading of sensors, or every sensor if none are
+            given, as it is written. Blocks waiting for them, with no
+            timeout. The connection can't be used for anything else after.
+        '''
+        self.socket.settimeout(None)
+        self.file.write('subscribe {}\n'.format(
+                            ' '.join(str(int(s)) for s in sensors))
+                        .encode('utf-8'))
+        self.file.flush()
+        for line in self.file:
+            yield json.loads(line.decode('utf-8'))
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
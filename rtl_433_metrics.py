@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# A small metrics registry for rtl_433_2sqlite, rendered in the Prometheus
+# text format and served over HTTP on a local port or a Unix socket.
+#
+#   registry = rtl_433_metrics.registry()
+#   lines = registry.counter('rtl433_lines_read_total', 'Lines read.')
+#   lines.inc()
+#   server = rtl_433_metrics.serve(registry, '127.0.0.1:9433')
+#
+# Updates are a plain add on an attribute, with no locking, so they are cheap
+# enough to leave on. Each metric should only be updated from one thread, a
+# scrape may see a histogram part way through an observe().
+#
+# Ciarán Mooney 2017
+
+import bisect
+import collections
+import contextlib
+import http.server
+import os
+import socketserver
+import threading
+
+class counter(object):
+    ''' A count that only goes up. If function is given it is called for
+        the value instead, for things that already keep a count.
+    '''
+
+    TYPE = 'counter'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+    def samples(self, name):
+        return [(name, self.get())]
+
+class gauge(counter):
+    ''' A value that goes up and down, set() or read from function.
+    '''
+
+    TYPE = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+class histogram(object):
+    ''' Counts observations into buckets, given as their upper bounds.
+    '''
+
+    TYPE = 'histogram'
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            samples.append(('{}_bucket{{le="{}"}}'.format(name, bound), total))
+        samples.append((name + '_sum', self.sum))
+        samples.append((name + '_count', self.count))
+        return samples
+
+class registry(object):
+    ''' Holds named metrics and renders them. Adding a metric with a name
+        that is already registered replaces it.
+    '''
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+
+    def _add(self, name, help, metric):
+        self.metrics[name] = (help, metric)
+        return metric
+
+    def counter(self, name, help, function=None):
+        return self._add(name, help, counter(function))
+
+    def gauge(self, name, help, function=None):
+        return self._add(name, help, gauge(function))
+
+    def histogram(self, name, help, buckets):
+        return self._add(name, help, histogram(buckets))
+
+    def get(self, name):
+        ''' Returns the value of the counter or gauge name.
+        '''
+        return self.metrics[name][1].get()
+
+    def render(self):
+        ''' Returns every metric in the Prometheus text format.
+        '''
+        lines = []
+        for name, (help, metric) in self.metrics.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, metric.TYPE))
+            for sample, value in metric.samples(name):
+                lines.append('{} {}'.format(sample, value))
+        return '\n'.join(lines) + '\n'
+
+class metricsHandler(http.server.BaseHTTPRequestHandler):
+    ''' Answers any GET with the server's registry.
+    '''
+
+    def do_GET(self):
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return 'local'
+
+    def log_message(self, format, *args):
+        pass
+
+class tcpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class unixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.server_address)
+
+def serve(registry, address):
+    ''' Serves registry on address, 'host:port' or the path of a Unix
+        socket, from a daemon thread. Returns the server, call shutdown()
+        and server_close() on it to stop.
+    '''
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = tcpServer((host, int(port)), metricsHandler)
+    else:
+        # A socket left behind by a crash.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(address)
+        server = unixServer(address, metricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
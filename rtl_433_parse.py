@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# The parser stage between the readers and the writer. A lineParser turns
+# batches of raw rtl_433 -F json lines, as bytes, into readings:
+#
+#   parser = rtl_433_parse.lineParser(models=['WG-PB12V1'], backend='orjson')
+#   readings = parser.parse(lines)
+#
+# Lines from models that aren't wanted are dropped by looking for the model
+# names in the raw bytes, without decoding them. A batch is decoded with as
+# few calls as it can, as JSON arrays, and only the lines around a garbled
+# one in it are decoded a line at a time.
+#
+# Ciarán Mooney 2017
+
+import bisect
+import itertools
+import json
+
+# JSON decoders that take bytes. orjson is a lot quicker but optional.
+BACKENDS = ('json', 'orjson')
+
+def loader(backend=None):
+    ''' Returns the loads() of backend, 'json' or 'orjson'. None is orjson
+        if it is installed, or json.
+    '''
+    if backend not in (None,) + BACKENDS:
+        raise ValueError("backend must be None, 'json' or 'orjson'")
+    if backend != 'json':
+        try:
+            import orjson
+            return orjson.loads
+        except ImportError:
+            if backend == 'orjson':
+                raise RuntimeError("the orjson backend needs orjson, "
+                                   "pip install orjson, or use json")
+    return json.loads
+
+class lineParser(object):
+    ''' Parses lists of lines into the readings, dicts, that dedupCache,
+        deadbandFilter and batchWriter take.
+
+        If models is given only readings with one of those models are
+        kept. A line is only decoded if one of the names is in it, in
+        quotes, and the decoded model checked, so a name that turns up in
+        another field costs a decode but isn't kept. Lines dropped for
+        their model are counted in filtered.
+
+        Lines that aren't JSON, or are JSON but not an object, are counted
+        in failures.
+    '''
+
+    def __init__(self, models=None, backend=None):
+        self.loads = loader(backend)
+        self.backend = 'orjson' if self.loads is not json.loads else 'json'
+        self.models = frozenset(models) if models else None
+        self._names = tuple(b'"' + model.encode('utf-8') + b'"'
+                            for model in self.models or ())
+        self.lines = 0
+        self.filtered = 0
+        self.failures = 0
+
+    def _wanted(self, line):
+        for name in self._names:
+            if name in line:
+                return True
+        return False
+
+    # Batches smaller than this are decoded a line at a time.
+    SMALLEST_BATCH = 8
+
+    def _decode(self, lines):
+        ''' Decodes lines a window at a time, each in one go if its lines
+            are all objects. If not, the window is cut back to the lines
+            before the one the decoder stopped at and the one before it,
+            which may be the one left open, and tried again. Once those are
+            the first, they are decoded on their own and the next window
+            starts after them, half the size. A window that decodes in one
+            go doubles the next, so a run of garbled lines costs about the
+            same per line as decoding them one at a time. Returns the
+            objects.
+        '''
+        loads = self.loads
+        readings = []
+        start = 0
+        window = len(lines)
+        while start < len(lines):
+            batch = lines[start:start + window]
+            if len(batch) < self.SMALLEST_BATCH:
+                readings.extend(self._decodeEach(batch))
+                start += len(batch)
+                window *= 2
+                continue
+            try:
+                decoded = loads(b'[' + b','.join(batch) + b']')
+            except ValueError as error:
+                decoded = None
+                pos = getattr(error, 'pos', None)
+            else:
+                pos = None
+            # A garbled line may still join up with its neighbours.
+            if (decoded is not None and len(decoded) == len(batch)
+                    and all(type(data) is dict for data in decoded)):
+                readings.extend(decoded)
+                start += len(batch)
+                window *= 2
+                continue
+            if pos is None:
+                window = len(batch) // 2
+                continue
+            # Where each line ends in the array, after its comma.
+            ends = list(itertools.accumulate(len(line) + 1 for line in batch))
+            bad = min(bisect.bisect_right(ends, pos), len(batch) - 1)
+            first = max(bad - 1, 0)
+            if first:
+                window = first
+            else:
+                readings.extend(self._decodeEach(batch[:bad + 1]))
+                start += bad + 1
+                window = len(batch) // 2
+        return readings
+
+    def _decodeEach(self, lines):
+        ''' Decodes lines a line at a time.
+        '''
+        loads = self.loads
+        readings = []
+        for line in lines:
+            try:
+                data = loads(line)
+            except ValueError:
+                # Garbled data from RTL_433, or not UTF-8.
+                self.failures += 1
+                continue
+            if type(data) is dict:
+                readings.append(data)
+            else:
+                self.failures += 1
+        return readings
+
+    def parse(self, lines):
+        ''' Returns the wanted readings in lines, a list of bytes, in order.
+        '''
+        self.lines += len(lines)
+        if self.models is None:
+            return self._decode(lines)
+        failures = self.failures
+        wanted = [line for line in lines if self._wanted(line)]
+        readings = [data for data in self._decode(wanted)
+                    if data.get('model') in self.models]
+        self.filtered += (len(lines) - len(readings)
+                          - (self.failures - failures))
+        return readings
+
+    def report(self):
+        ''' Returns a one line summary of the counters.
+        '''
+        return "parser: {} lines, {} filtered, {} failures, {}".format(
+                    self.lines, self.filtered, self.failures, self.backend)
@@ -0,0 +1,352 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Time-partitioned storage for rtl_433_2sqlite. Readings are written to one
+# database file per month (or day, week or year), next to the path given:
+#
+#   /media/piDrive/db/temperaturedb.sqlite  ->  temperaturedb-2017-10.sqlite
+#
+# so the file being written stays small, and old data is dropped by deleting
+# old files, see dropPartitions() and partitionedDatabase.prune().
+# partitionQuery answers the same queries as sensorQuery by ATTACHing only
+# the files that cover the times asked for.
+#
+#   database = rtl_433_partition.partitionedDatabase(sq, DB_FILE, 'month')
+#   query = rtl_433_partition.partitionQuery(sq, DB_FILE, 'month')
+#   query.range(8, start, end)
+#
+# Ciarán Mooney 2017
+
+import contextlib
+from datetime import datetime, timedelta, timezone
+import glob
+import itertools
+import os
+import re
+import urllib.parse
+
+import rtl_433_2sqlite
+import rtl_433_query
+
+# How each period is written in partition file names. The names sort in time
+# order.
+PERIODS = {'day' : '%Y-%m-%d',
+           'week' : '%G-W%V',
+           'month' : '%Y-%m',
+           'year' : '%Y'}
+
+# Most partitions ATTACHed to one connection, sqlite's default limit.
+ATTACH_LIMIT = 10
+
+def partitionStart(millis, period='month'):
+    ''' Returns the start, in epoch milliseconds, of the UTC period holding
+        millis.
+    '''
+    when = datetime.fromtimestamp(millis / 1000, timezone.utc)
+    start = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'week':
+        start -= timedelta(days=start.weekday())
+    elif period == 'month':
+        start = start.replace(day=1)
+    elif period == 'year':
+        start = start.replace(month=1, day=1)
+    elif period != 'day':
+        raise ValueError("period must be one of {}".format(sorted(PERIODS)))
+    return int(start.timestamp() * 1000)
+
+def nextPartition(start, period='month'):
+    ''' Returns the start of the partition after the one starting at start.
+    '''
+    when = datetime.fromtimestamp(start / 1000, timezone.utc)
+    if period == 'day':
+        when += timedelta(days=1)
+    elif period == 'week':
+        when += timedelta(days=7)
+    elif period == 'month':
+        when = when.replace(year=when.year + when.month // 12,
+                            month=when.month % 12 + 1)
+    else:
+        when = when.replace(year=when.year + 1)
+    return int(when.timestamp() * 1000)
+
+def partitionPath(db_path, start, period='month'):
+    ''' Returns the file for the partition of db_path starting at start.
+    '''
+    base, extension = os.path.splitext(db_path)
+    when = datetime.fromtimestamp(start / 1000, timezone.utc)
+    return '{}-{}{}'.format(base, when.strftime(PERIODS[period]), extension)
+
+def _nameStart(name, period):
+    ''' Returns the start of the partition called name, or None if it isn't
+        one.
+    '''
+    try:
+        if period == 'week':
+            when = datetime.strptime(name + '-1', '%G-W%V-%u')
+        else:
+            when = datetime.strptime(name, PERIODS[period])
+    except ValueError:
+        return None
+    return int(when.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def partitions(db_path, period='month', start=None, end=None):
+    ''' Returns [(start, path)] of the partitions of db_path that exist,
+        oldest first. With start and end only those holding times from
+        start up to, but not including, end are returned.
+    '''
+    base, extension = os.path.splitext(db_path)
+    pattern = re.compile(re.escape(base) + '-(.+)' + re.escape(extension)
+                         + '$')
+    found = []
+    for path in glob.glob(glob.escape(base) + '-*' + extension):
+        match = pattern.match(path)
+        first = _nameStart(match.group(1), period) if match else None
+        if first is None:
+            continue
+        if end is not None and first >= end:
+            continue
+        if start is not None and nextPartition(first, period) <= start:
+            continue
+        found.append((first, path))
+    return sorted(found)
+
+def dropPartitions(db_path, before, period='month'):
+    ''' Deletes the partitions of db_path that only hold times before
+        before, with their -wal and -shm files. Returns the paths deleted.
+    '''
+    dropped = []
+    for start, path in partitions(db_path, period):
+        if nextPartition(start, period) > rtl_433_query.toMillis(before):
+            break
+        for suffix in ('', '-wal', '-shm'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path + suffix)
+        dropped.append(path)
+    return dropped
+
+class attachedPartitions(object):
+    ''' Stands in for a readPool, so that a sensorQuery can be run over
+        several partitions. Each connection ATTACHes paths read-only and
+        has TEMP views named after the tables, over all of them. ids are
+        only unique within a partition, so latest_all() needs one path.
+    '''
+
+    TABLES = ('sensor_data', 'rollup_minute', 'rollup_hour', 'rollup_day')
+
+    def __init__(self, sq, paths, busy_timeout=5000):
+        if not 0 < len(paths) <= ATTACH_LIMIT:
+            raise ValueError("between 1 and {} partitions can be attached"
+                             .format(ATTACH_LIMIT))
+        self.sq = sq
+        self.paths = paths
+        self.busy_timeout = busy_timeout
+
+    @contextlib.contextmanager
+    def connection(self):
+        ''' Context manager that opens a connection with the partitions
+            attached, and closes it afterwards.
+        '''
+        db = self.sq.connect('file::memory:', uri=True)
+        try:
+            db.execute('PRAGMA busy_timeout = {}'.format(self.busy_timeout))
+            for n, path in enumerate(self.paths):
+                db.execute('ATTACH DATABASE ? AS p{}'.format(n),
+                           ('file:{}?mode=ro'.format(urllib.parse.quote(path)),))
+            for table in self.TABLES:
+                db.execute('CREATE TEMP VIEW {} AS {}'.format(table,
+                           ' UNION ALL '.join('SELECT * FROM p{}.{}'
+                                              .format(n, table)
+                                              for n in range(len(self.paths)))))
+            yield db
+        finally:
+            db.close()
+
+    def close(self):
+        pass
+
+class partitionedDatabase(object):
+    ''' Writes readings into one initDatabase per period, named by
+        partitionPath, moving on to the next file when a reading's date
+        falls in the next period. It has the parts of initDatabase that
+        batchWriter, the engines and deadbandFilter use.
+
+        options are passed on to each initDatabase.
+    '''
+
+    def __init__(self, sq, db_path, period='month', **options):
+        if period not in PERIODS:
+            raise ValueError("period must be one of {}".format(sorted(PERIODS)))
+        self.sq = sq
+        self.db_path = db_path
+        self.period = period
+        self.options = options
+        self._database = None
+        self._start = None
+        self._end = None
+
+    def partition(self, millis):
+        ''' Returns the initDatabase for the partition holding millis, making
+            it the current one.
+        '''
+        if self._database is None or not self._start <= millis < self._end:
+            start = partitionStart(millis, self.period)
+            if self._database is not None:
+                self._database.close()
+            self._database = rtl_433_2sqlite.initDatabase(
+                                self.sq,
+                                partitionPath(self.db_path, start,
+                                              self.period),
+                                **self.options)
+            self._start = start
+            self._end = nextPartition(start, self.period)
+        return self._database
+
+    def write(self, json_data):
+        ''' Writes json_data to the current partition.
+        '''
+        self.partition(rtl_433_2sqlite.epochMillis()).write(json_data)
+
+    def write_many(self, rows, timestamps=None):
+        ''' As initDatabase.write_many, with each row going to the partition
+            for its timestamp. A batch only spans partitions at a rotation,
+            or when spilled lines are written late.
+        '''
+        if not rows:
+            return
+        if timestamps is None:
+            timestamps = [rtl_433_2sqlite.epochMillis()] * len(rows)
+        start = 0
+        while start < len(rows):
+            database = self.partition(timestamps[start])
+            end = start + 1
+            while (end < len(rows)
+                   and self._start <= timestamps[end] < self._end):
+                end += 1
+            database.write_many(rows[start:end], timestamps[start:end])
+            start = end
+
+    def read_pool(self, size=4):
+        ''' Returns a readPool on the newest partition, which is what
+            deadbandFilter.load wants. Use partitionQuery to read them all.
+        '''
+        newest = partitions(self.db_path, self.period)
+        if newest:
+            start = newest[-1][0]
+        else:
+            start = partitionStart(rtl_433_2sqlite.epochMillis(), self.period)
+        return self.partition(start).read_pool(size)
+
+    def prune(self, retention, now=None):
+        ''' Deletes the partitions, up to the current one, that only hold
+            rows older than the longest time retention keeps any for.
+            Shorter times for some sensors or models only take effect when
+            their partition goes. Returns 0, as no rows are deleted.
+        '''
+        if now is None:
+            now = rtl_433_2sqlite.epochMillis()
+        keeps = ([retention.keep] + list(retention.sensors.values())
+                 + list(retention.models.values()))
+        if None not in keeps:
+            before = now - max(keeps)
+            if self._start is not None:
+                before = min(before, self._start)
+            dropPartitions(self.db_path, before, self.period)
+        return 0
+
+    @property
+    def migrated(self):
+        ''' As initDatabase.migrated, for the current partition.
+        '''
+        return self._database is None or self._database.migrated
+
+    def migrate_step(self, chunk_size=5000):
+        ''' As initDatabase.migrate_step, on the current partition. Older
+            ones are migrated when they are next written to.
+        '''
+        if self._database is None:
+            return True
+        return self._database.migrate_step(chunk_size)
+
+    def incremental_vacuum(self, pages=None):
+        ''' Nothing to vacuum, prune() deletes whole files.
+        '''
+        return 0
+
+    def close(self):
+        ''' Closes the current partition's connection.
+        '''
+        if self._database is not None:
+            self._database.close()
+
+class partitionQuery(rtl_433_query.sensorQuery):
+    ''' sensorQuery over the partitions of db_path. Each query only
+        ATTACHes the partitions that cover its times.
+    '''
+
+    def __init__(self, sq, db_path, period='month'):
+        rtl_433_query.sensorQuery.__init__(self, None)
+        self.sq = sq
+        self.db_path = db_path
+        self.period = period
+
+    def _queries(self, start=None, end=None):
+        ''' Yields a sensorQuery for each group of up to ATTACH_LIMIT
+            partitions covering start to end, oldest first.
+        '''
+        paths = [path for first, path in partitions(self.db_path, self.period,
+                                                    start, end)]
+        for n in range(0, len(paths), ATTACH_LIMIT):
+            yield rtl_433_query.sensorQuery(
+                        attachedPartitions(self.sq, paths[n:n + ATTACH_LIMIT]))
+
+    def _newest(self, end=None):
+        ''' Yields a sensorQuery for each partition, up to end, newest
+            first, so a search can stop at the first that has an answer.
+        '''
+        for first, path in reversed(partitions(self.db_path, self.period,
+                                               end=end)):
+            yield rtl_433_query.sensorQuery(attachedPartitions(self.sq,
+                                                               [path]))
+
+    def latest(self, sensor):
+        for query in self._newest():
+            found = query.latest(sensor)
+            if found is not None:
+                return found
+        return None
+    latest.__doc__ = rtl_433_query.sensorQuery.latest.__doc__
+
+    def range(self, sensor, start, end):
+        start = rtl_433_query.toMillis(start)
+        end = rtl_433_query.toMillis(end)
+        return list(itertools.chain.from_iterable(
+                        query.range(sensor, start, end)
+                        for query in self._queries(start, end)))
+    range.__doc__ = rtl_433_query.sensorQuery.range.__doc__
+
+    def value_at(self, sensor, when):
+        when = rtl_433_query.toMillis(when)
+        for query in self._newest(when + 1):
+            found = query.value_at(sensor, when)
+            if found is not None:
+                return found
+        return None
+    value_at.__doc__ = rtl_433_query.sensorQuery.value_at.__doc__
+
+    def rollup(self, sensor, start, end, period='hour'):
+        start = rtl_433_query.toMillis(start)
+        end = rtl_433_query.toMillis(end)
+        return list(itertools.chain.from_iterable(
+                        query.rollup(sensor, start, end, period)
+                        for query in self._queries(start, end)))
+    rollup.__doc__ = rtl_433_query.sensorQuery.rollup.__doc__
+
+    def latest_all(self):
+        ''' Returns the most recent reading for every sensor, ordered by
+            sensorID, looking back through the partitions.
+        '''
+        latest = {}
+        for query in self._newest():
+            for found in query.latest_all():
+                latest.setdefault(found.sensorID, found)
+        return [latest[sensor] for sensor in sorted(latest)]
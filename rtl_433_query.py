@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Queries for reading sensor_data back out of a database written by
+# rtl_433_2sqlite.py. Every query is answered from the (sensorID, date)
+# index, so it costs the same however big the table gets.
+#
+#   pool = rtl_433_2sqlite.initDatabase(sq, DB_FILE).read_pool()
+#   query = rtl_433_query.sensorQuery(pool)
+#   query.latest(8)
+#
+# Ciarán Mooney 2017
+
+import collections
+from datetime import datetime
+import struct
+
+COLUMNS = ('id', 'date', 'sensorID', 'temperature_C', 'io', 'model',
+           'channel', 'humidity', 'battery', 'extra', 'receiver')
+
+# One row of sensor_data, date is epoch milliseconds and io is unpacked.
+reading = collections.namedtuple('reading', COLUMNS)
+
+# The length, in bits, at the start of a packed io.
+IO_LENGTH = struct.Struct('>H')
+
+# One bucket of a rollup table, bucket is its start in epoch milliseconds.
+rollup = collections.namedtuple('rollup', ('bucket', 'count', 'minimum',
+                                           'mean', 'maximum'))
+
+# The rollup table for each period.
+ROLLUP_TABLES = {'minute' : 'rollup_minute',
+                 'hour' : 'rollup_hour',
+                 'day' : 'rollup_day'}
+
+def toMillis(when):
+    ''' Returns when as epoch milliseconds. when may be a datetime, naive
+        ones are taken as local time, or a number that is already epoch
+        milliseconds.
+    '''
+    if isinstance(when, datetime):
+        return int(round(when.timestamp() * 1000))
+    return int(when)
+
+def unpackIO(io):
+    ''' Returns the bit string packed by rtl_433_2sqlite.packIO(). Text,
+        from before io was packed or that wasn't bits, and None are
+        returned as they are.
+    '''
+    if not isinstance(io, bytes):
+        return io
+    length, = IO_LENGTH.unpack_from(io)
+    return format(int.from_bytes(io[IO_LENGTH.size:], 'big'),
+                  '0{}b'.format(length))
+
+class sensorQuery(object):
+    ''' Time-series queries on sensor_data, run on connections from a
+        rtl_433_2sqlite.readPool.
+    '''
+
+    SELECT = 'SELECT {} FROM sensor_data'.format(', '.join(COLUMNS))
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def _fetch(self, sql, parameters=()):
+        ''' Runs sql and returns the rows as readings.
+        '''
+        with self.pool.connection() as db:
+            rows = db.execute(sql, parameters).fetchall()
+        return [reading(*row[:4], unpackIO(row[4]), *row[5:])
+                for row in rows]
+
+    def latest(self, sensor):
+        ''' Returns the most recent reading for sensor, or None.
+        '''
+        rows = self._fetch(self.SELECT + ''' WHERE sensorID = ?
+                                             ORDER BY date DESC LIMIT 1''',
+                           (sensor,))
+        return rows[0] if rows else None
+
+    def range(self, sensor, start, end):
+        ''' Returns the readings for sensor from start up to, but not
+            including, end, oldest first. See toMillis() for the times.
+        '''
+        return self._fetch(self.SELECT + ''' WHERE sensorID = ?
+                                             AND date >= ? AND date < ?
+                                             ORDER BY date''',
+                           (sensor, toMillis(start), toMillis(end)))
+
+    def value_at(self, sensor, when):
+        ''' Returns the reading in force for sensor at when, the newest one
+            at or before it, or None. With deadbandFilter storage a reading
+            holds until the next stored one.
+        '''
+        rows = self._fetch(self.SELECT + ''' WHERE sensorID = ? AND date <= ?
+                                             ORDER BY date DESC LIMIT 1''',
+                           (sensor, toMillis(when)))
+        return rows[0] if rows else None
+
+    def step(self, sensor, start, end):
+        ''' Returns the readings for sensor as a step function over start
+            to end: the reading in force at start, if there is one, then
+            those in range(). Each holds until the next.
+        '''
+        readings = self.range(sensor, start, end)
+        if not readings or readings[0].date > toMillis(start):
+            first = self.value_at(sensor, start)
+            if first is not None:
+                readings.insert(0, first)
+        return readings
+
+    def rollup(self, sensor, start, end, period='hour'):
+        ''' Returns the temperature_C min/mean/max for sensor per minute,
+            hour or day, for the buckets starting from start up to, but not
+            including, end, oldest first.
+        '''
+        with self.pool.connection() as db:
+            rows = db.execute('''SELECT bucket, count, minimum,
+                                         total / count, maximum
+                                  FROM {} WHERE sensorID = ?
+                                  AND bucket >= ? AND bucket < ?
+                                  ORDER BY bucket'''
+                              .format(ROLLUP_TABLES[period]),
+                              (sensor, toMillis(start), toMillis(end)))
+            return [rollup(*row) for row in rows.fetchall()]
+
+    def latest_all(self):
+        ''' Returns the most recent reading for every sensor, ordered by
+            sensorID.
+
+            The sensors are found by stepping through the index one
+            sensorID at a time rather than scanning it with GROUP BY.
+        '''
+        columns = ', '.join('sensor_data.' + column for column in COLUMNS)
+        return self._fetch('''WITH RECURSIVE sensors(sensorID) AS (
+                                  SELECT MIN(sensorID) FROM sensor_data
+                                  UNION ALL
+                                  SELECT (SELECT MIN(sensorID)
+                                          FROM sensor_data
+                                          WHERE sensorID > sensors.sensorID)
+                                  FROM sensors
+                                  WHERE sensors.sensorID IS NOT NULL)
+                              SELECT {} FROM sensors
+                              JOIN sensor_data ON sensor_data.id = (
+                                  SELECT id FROM sensor_data AS latest
+                                  WHERE latest.sensorID = sensors.sensorID
+                                  ORDER BY latest.date DESC LIMIT 1)
+                              ORDER BY sensor_data.sensorID'''
+                           .format(columns))
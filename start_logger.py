@@ -6,16 +6,88 @@
 # Ciarán Mooney 2017
 
 import rtl_433_2sqlite as to_sqlite # cannot have 2sqlite, invalid syntax
+import rtl_433_capture
+import rtl_433_parse
+import rtl_433_partition
+import signal
 import sqlite3 as sq
 
 # BEGIN CONFIG
 DB_FILE = "/tmp/tempdb.sqlite"
+PARTITION = None # e.g. "month" for a DB_FILE per month, tempdb-2017-10.sqlite
 RTL433 = "/home/ciaran/Code/rtl_433/build/src/rtl_433"
 DEBUG = False
+PROTOCOLS = [39] # rtl_433 -R decoders, empty for rtl_433's defaults
+MODELS = None # e.g. ["WG-PB12V1"], only store these models, None for all
+JSON_BACKEND = None # "json" or "orjson", None for orjson if it is installed
+DEDUP_WINDOW = 2000 # ms, repeats of a packet inside this are dropped
+DEADBAND = None # e.g. 0.1 (°C) to only store readings that have changed
+HEARTBEAT = 600000 # ms, with DEADBAND a reading is stored at least this often
+QUEUE_SIZE = 10000 # lines held in memory, the rest spill to DB_FILE + "-spill"
+READ_CHUNK = 65536 # bytes read from rtl_433 at a time, None for a line at a time
+METRICS = None # e.g. "127.0.0.1:9433" or "/tmp/rtl_433_2sqlite.sock"
+LATEST = None # e.g. "/tmp/rtl_433_latest.sock", newest readings, no db reads
+CAPTURE = None # e.g. "/media/piDrive/capture.json", raw rtl_433 output
+CAPTURE_MB = 64 # rotate the capture at this size
+CAPTURE_COMPRESS = "gzip" # rotated segments, "gzip", "zstd" or None
+# Several dongles, each {name : extra rtl_433 options}, e.g.
+# {"433" : ["-d", "0", "-f", "433.92M"], "868" : ["-d", "1", "-f", "868M"]}.
+# Rows are tagged with the name. None runs one rtl_433 with ENGINE.
+RECEIVERS = None
+RESTART = True # start rtl_433 again if it exits, waiting BACKOFF s doubling
+BACKOFF = 1.0  # up to MAX_BACKOFF s between attempts
+MAX_BACKOFF = 60.0
+RETENTION = None # days of readings to keep, e.g. 90, None keeps them all
+RETENTION_SENSORS = {} # {sensorID : days}, overrides RETENTION
+RETENTION_MODELS = {}  # {model : days}, e.g. {"Acurite-Tower" : 30}
+ENGINE = "thread" # or "asyncio", see rtl_433_2sqlite.ENGINES
 TESTS = "/home/ciaran/Code/rtl_433_tests/"
 # END CONFIG
 
+def days(value):
+    ''' Returns days in milliseconds, None is for ever.
+    '''
+    return None if value is None else int(value * to_sqlite.DAY)
+
 if __name__ == '__main__':
-    db = to_sqlite.initDatabase(sq, DB_FILE)
-    to_sqlite.startSubProcess(RTL433, db, DEBUG)
+    # Stop the way Ctrl-C does, so what has been read is written first.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if PARTITION:
+        db = rtl_433_partition.partitionedDatabase(sq, DB_FILE, PARTITION)
+    else:
+        db = to_sqlite.initDatabase(sq, DB_FILE)
+    deadband = None
+    if DEADBAND is not None:
+        deadband = to_sqlite.deadbandFilter(DEADBAND, heartbeat=HEARTBEAT)
+        deadband.load(db)
+    retention = None
+    if RETENTION is not None or RETENTION_SENSORS or RETENTION_MODELS:
+        retention = to_sqlite.retentionPolicy(
+                        days(RETENTION),
+                        dict((k, days(v)) for k, v in RETENTION_SENSORS.items()),
+                        dict((k, days(v)) for k, v in RETENTION_MODELS.items()))
+    parser = rtl_433_parse.lineParser(MODELS, JSON_BACKEND)
+    capture = None
+    if CAPTURE is not None:
+        capture = rtl_433_capture.captureWriter(CAPTURE, CAPTURE_MB << 20,
+                                                compress=CAPTURE_COMPRESS)
+    if RECEIVERS:
+        receivers = [to_sqlite.receiver(name, to_sqlite.rtlCommand(
+                                                RTL433, DEBUG, PROTOCOLS, args))
+                     for name, args in sorted(RECEIVERS.items())]
+        to_sqlite.startReceivers(receivers, db, dedup_window=DEDUP_WINDOW,
+                                 deadband=deadband, queue_size=QUEUE_SIZE,
+                                 metrics_address=METRICS, restart=RESTART,
+                                 backoff=BACKOFF, max_backoff=MAX_BACKOFF,
+                                 retention=retention, latest_address=LATEST,
+                                 capture=capture, chunk_size=READ_CHUNK,
+                                 parser=parser)
+    else:
+        to_sqlite.ENGINES[ENGINE](RTL433, db, DEBUG, protocols=PROTOCOLS,
+                                  dedup_window=DEDUP_WINDOW, deadband=deadband,
+                                  queue_size=QUEUE_SIZE, metrics_address=METRICS,
+                                  restart=RESTART, backoff=BACKOFF,
+                                  max_backoff=MAX_BACKOFF, retention=retention,
+                                  latest_address=LATEST, capture=capture,
+                                  chunk_size=READ_CHUNK, parser=parser)
     print("Closing down")
@@ -5,13 +5,23 @@
 # Ciarán Mooney 2017
 
 import unittest
+from unittest.mock import DEFAULT
 from unittest.mock import Mock
 from unittest.mock import patch
 from unittest.mock import mock_open
 
 from datetime import datetime
 import sqlite3 as sq
+import asyncio
+import contextlib
+import fcntl
+import io
 import os
+import subprocess
+import sys
+import _thread
+import threading
+import time
 import psutil
 
 import queue as Queue
@@ -19,6 +29,7 @@ import json
 from json.decoder import JSONDecodeError
 
 import rtl_433_2sqlite
+import rtl_433_query
 
 class CallableExhausted(Exception):
     '''
@@ -41,6 +52,16 @@ class ErrorAfter(object):
             return True
         return False 
 
+def fakeProcess(stdout_lines, stderr_lines=()):
+    ''' Returns a stand in for subprocess.Popen() whose stdout and stderr
+        pipes give the lines and then EOF.
+    '''
+    process = Mock()
+    process.pid = 77777
+    process.stdout = io.BytesIO(b''.join(stdout_lines))
+    process.stderr = io.BytesIO(b''.join(stderr_lines))
+    return process
+
 class TestDatabaseInit(unittest.TestCase):
     ''' Tests that the database is created as expected and it's methods all
         behave as expected.
@@ -80,7 +101,7 @@ class TestDatabaseInit(unittest.TestCase):
                                             WHERE type='table' AND 
                                             name='current_id';''')
         table = self.db.cur.fetchone()
-        self.assertEqual(table, ('current_id',))
+        self.assertEqual(table, None)
     
     def test_init_table_headers(self):
         ''' Tests that when a database is initialised that the tables have the
@@ -93,15 +114,123 @@ class TestDatabaseInit(unittest.TestCase):
         self.assertEqual(headers[2][1], 'sensorID')
         self.assertEqual(headers[3][1], 'temperature_C')
         self.assertEqual(headers[4][1], 'io')
+        self.assertEqual([header[1] for header in headers[5:]],
+                         ['model', 'channel', 'humidity', 'battery', 'extra',
+                          'receiver'])
     
     def test_init_table_max_id(self):
-        ''' Tests that when a database is initialised that the max ID is 
-            correct. 
+        ''' Tests that when a database is initialised that id is the rowid
+            and that there is no max ID yet.
         '''
-        self.db.cur.execute('''SELECT * FROM current_id;''')
-        table = self.db.cur.fetchone()
-        self.assertEqual(0, table[0])
+        self.db.cur.execute('''PRAGMA table_info('sensor_data');''')
+        headers = self.db.cur.fetchall()
+        self.assertEqual(headers[0][2], 'INTEGER')
+        self.assertEqual(headers[0][5], 1)
+        self.assertEqual(self.db.get_max_id(), None)
         
+    def test_convert_dates(self):
+        ''' Tests that a rowid database with text dates is converted to
+            epoch milliseconds and indexed, a chunk at a time, while rows
+            are being written.
+        '''
+        self.db.close()
+        os.remove(self.db_path)
+        old = sq.connect(self.db_path)
+        old.execute('''CREATE TABLE sensor_data  
+                       (id INTEGER PRIMARY KEY, date text, sensorID int, 
+                        temperature_C float, io text)''')
+        old.executemany("INSERT INTO sensor_data VALUES (?, ?, 8, 20.0, '1')",
+                        [(n, '2017-10-01 12:00:00') for n in range(1, 6)])
+        old.commit()
+        old.close()
+
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.assertEqual(self.db.version, 3)
+        self.assertFalse(self.db.migrated)
+        steps = 0
+        while not self.db.migrate_step(chunk_size=2):
+            self.db.write_many([{"id" : 9, "temperature_C" : 10.0,
+                                 "io" : "10"}], [1000 + steps])
+            steps += 1
+        self.assertGreater(steps, 3)
+        self.assertEqual(self.db.schema_version(),
+                         self.db.SCHEMA_VERSION)
+        self.db.connect()
+        self.db.cur.execute("SELECT id, date, typeof(date), io FROM sensor_data"
+                            " WHERE id = 5")
+        expected = round(datetime(2017, 10, 1, 12).timestamp() * 1000)
+        self.assertEqual(self.db.cur.fetchone(),
+                         (5, expected, 'integer', rtl_433_2sqlite.packIO('1')))
+        self.db.cur.execute("SELECT date FROM sensor_data WHERE sensorID = 9")
+        self.assertEqual([row[0] for row in self.db.cur.fetchall()],
+                         [1000 + n for n in range(steps)])
+        self.db.cur.execute('''EXPLAIN QUERY PLAN SELECT * FROM sensor_data
+                               WHERE sensorID = 8 ORDER BY date DESC LIMIT 1''')
+        self.assertIn('sensor_data_sensor_date', str(self.db.cur.fetchall()))
+        self.db.cur.execute("SELECT name FROM sqlite_master WHERE type='table'"
+                            " AND name LIKE 'sensor_data_%'")
+        self.assertEqual(self.db.cur.fetchall(), [])
+        self.db.cur.execute('SELECT count FROM rollup_minute WHERE sensorID = 8')
+        self.assertEqual(self.db.cur.fetchall(), [(5,)])
+
+    def test_schema_version(self):
+        ''' Tests that a new database starts at SCHEMA_VERSION and that
+            reopening one runs nothing.
+        '''
+        self.assertEqual(self.db.schema_version(), self.db.SCHEMA_VERSION)
+        self.assertTrue(self.db.migrated)
+        self.db.close()
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.assertTrue(self.db.migrate_step())
+
+    def test_rollups(self):
+        ''' Tests that each batch updates the rollup buckets it touches.
+        '''
+        rows = [{"id" : 8, "temperature_C" : t} for t in (20.0, 22.0, 21.0)]
+        rows.append({"id" : 8, "humidity" : 50})
+        self.db.write_many(rows[:2], [0, 30000])
+        self.db.write_many(rows[2:], [61000, 62000])
+        self.db.cur.execute('SELECT * FROM rollup_minute ORDER BY bucket')
+        self.assertEqual(self.db.cur.fetchall(),
+                         [(8, 0, 2, 42.0, 20.0, 22.0),
+                          (8, 60000, 1, 21.0, 21.0, 21.0)])
+        self.db.cur.execute('SELECT * FROM rollup_hour')
+        self.assertEqual(self.db.cur.fetchall(), [(8, 0, 3, 63.0, 20.0, 22.0)])
+
+    def test_backfill_rollups(self):
+        ''' Tests that rows from before the rollups existed are added in
+            chunks, and that newer rows aren't counted twice.
+        '''
+        self.db.close()
+        os.remove(self.db_path)
+        old = sq.connect(self.db_path)
+        old.execute('''CREATE TABLE sensor_data  
+                       (id INTEGER PRIMARY KEY, date integer, sensorID int, 
+                        temperature_C float, io text)''')
+        old.executemany("INSERT INTO sensor_data VALUES (?, ?, 8, ?, '1')",
+                        [(n, n * 1000, 20.0 + n) for n in range(5)])
+        old.commit()
+        old.close()
+
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.db.write_many([{"id" : 8, "temperature_C" : 10.0}], [5000])
+        self.assertEqual(list(self.db.backfill_rollups(chunk_size=2)),
+                         [1, 3, 4])
+        self.assertEqual(list(self.db.backfill_rollups()), [])
+        self.db.connect()
+        self.db.cur.execute('SELECT * FROM rollup_minute')
+        self.assertEqual(self.db.cur.fetchall(), [(8, 0, 6, 120.0, 10.0, 24.0)])
+
+    def test_pragmas(self):
+        ''' Tests that connect() sets up WAL and the configured pragmas.
+        '''
+        self.db.cur.execute('PRAGMA journal_mode')
+        self.assertEqual(self.db.cur.fetchone()[0], 'wal')
+        self.db.cur.execute('PRAGMA synchronous')
+        self.assertEqual(self.db.cur.fetchone()[0], 1) # NORMAL
+        self.db.cur.execute('PRAGMA busy_timeout')
+        self.assertEqual(self.db.cur.fetchone()[0], 5000)
+
     @patch.object(sq, 'connect')
     def test_close(self, mock_connect):
         '''
@@ -126,37 +255,29 @@ class TestDatabaseInit(unittest.TestCase):
     def test_write(self):
         '''
         '''
-        with patch('rtl_433_2sqlite.datetime') as mock_timestamp:
-            n = datetime.now()
-            mock_timestamp.now.return_value = n
-            mock_timestamp.side_effect = lambda * args, **kw: datetime.now(*args, **kw)
-            assert rtl_433_2sqlite.datetime.now() == n
+        with patch('rtl_433_2sqlite.time.time') as mock_timestamp:
+            mock_timestamp.return_value = 1507000000.1234
 
             test_json = {"time" : "@0.000000s", "model" : "WG-PB12V1", 
                          "id" : 8, "temperature_C" : 20.900, 
                          "io" : "111111110011001001100001011010001111111101001100"}
             
-            # Test that id starts at zero. 
-            self.db.cur.execute('''SELECT * FROM current_id;''')
-            table = self.db.cur.fetchone()
-            self.assertEqual(0, table[0])
-            
             # Check that data is written.
             self.db.write(test_json)
             self.db.connect()
             self.db.cur.execute("SELECT * FROM sensor_data")
             data = self.db.cur.fetchall()[0]
-            self.assertEqual(data[0], 0)
-            self.assertEqual(data[1], str(n))
+            self.assertEqual(data[0], 1)
+            self.assertEqual(data[1], 1507000000123)
             self.assertEqual(data[2], 8)
             self.assertEqual(data[3], 20.9)
-            self.assertEqual(data[4], 
+            self.assertEqual(len(data[4]), 8)
+            self.assertEqual(rtl_433_query.unpackIO(data[4]),
                          '111111110011001001100001011010001111111101001100')
 
             # Check that the id incremented.    
-            self.db.cur.execute('''SELECT * FROM current_id;''')
-            table = self.db.cur.fetchone()
-            self.assertEqual(1, table[0])
+            self.db.write(test_json)
+            self.assertEqual(self.db.get_max_id(), 2)
 
     def test_get_max_id(self):
         '''
@@ -165,24 +286,869 @@ class TestDatabaseInit(unittest.TestCase):
                      "id" : 8, "temperature_C" : 20.900, 
                      "io" : "111111110011001001100001011010001111111101001100"}
             
-        # Test that id starts at zero. 
-        self.db.cur.execute('''SELECT * FROM current_id;''')
-        table = self.db.cur.fetchone()
-        self.assertEqual(0, table[0])
+        # Test that there is no id yet. 
+        self.assertEqual(self.db.get_max_id(), None)
             
         self.db.write(test_json)
 
         # Check that the id incremented.    
+        self.assertEqual(self.db.get_max_id(), 1)
+
+    def test_write_many(self):
+        ''' Tests that write_many stores every row in one go and leaves the
+            connection open for the next batch.
+        '''
+        test_json = {"time" : "@0.000000s", "model" : "WG-PB12V1", 
+                     "id" : 8, "temperature_C" : 20.900, 
+                     "io" : "111111110011001001100001011010001111111101001100"}
+        self.db.close()
+        self.db.write_many([test_json, test_json, test_json], [10, 20, 30])
+        self.assertIsNotNone(self.db.db)
+        self.db.write_many([test_json])
+
+        self.db.cur.execute("SELECT id, date FROM sensor_data ORDER BY id")
+        data = self.db.cur.fetchall()
+        self.assertEqual([row[0] for row in data], [1, 2, 3, 4])
+        self.assertEqual([row[1] for row in data][:3], [10, 20, 30])
+
+    def test_write_other_models(self):
+        ''' Tests that readings without temperature or io are stored rather
+            than raising KeyError, with unknown keys kept in extra.
+        '''
+        humidity_json = {"time" : "2017-10-01 12:00:00", "model" : "LaCrosse-TX141THBv2",
+                         "id" : 141, "channel" : 1, "battery" : "LOW",
+                         "humidity" : 52, "test" : "No"}
+        self.db.write(humidity_json)
         self.db.connect()
-        self.db.cur.execute('''SELECT * FROM current_id;''')
-        table = self.db.cur.fetchone()
-        self.assertEqual(1, table[0])
+        self.db.cur.execute('''SELECT sensorID, temperature_C, io, model,
+                                      channel, humidity, battery, extra
+                               FROM sensor_data''')
+        self.assertEqual(self.db.cur.fetchone(),
+                         (141, None, None, 'LaCrosse-TX141THBv2', 1, 52.0, 0,
+                          '{"test": "No"}'))
+
+    def test_pack_io(self):
+        ''' Text io from before it was packed is packed in chunks, and
+            anything that isn't bits is left alone.
+        '''
+        self.db.write_many([{"id" : 8, "io" : "1100"}])
+        self.db.cur.executemany('''INSERT INTO sensor_data (sensorID, io)
+                                   VALUES (8, ?)''',
+                                [('1111',), ('f00d',), (None,), ('0',),
+                                 ('',)])
+        self.db.db.commit()
+        self.db.close()
+        self.assertEqual(list(self.db.pack_io(chunk_size=1)), [2, 5])
+        self.db.connect()
+        self.db.cur.execute('SELECT io FROM sensor_data ORDER BY id')
+        rows = [row[0] for row in self.db.cur.fetchall()]
+        self.assertEqual([type(io) for io in rows],
+                         [bytes, bytes, str, type(None), bytes, str])
+        self.assertEqual([rtl_433_query.unpackIO(io) for io in rows],
+                         ['1100', '1111', 'f00d', None, '0', ''])
+        self.assertEqual(list(self.db.pack_io()), [])
 
     def testNewMaxID(self):
-        ''' 
+        ''' Tests that a database with the old current_id table is migrated
+            online, keeping its ids and carrying on after them, and giving
+            repeated ids and rows written meanwhile new ones.
+        '''
+        self.db.close()
+        os.remove(self.db_path)
+        old = sq.connect(self.db_path)
+        old.execute('''CREATE TABLE sensor_data  
+                       (id integer, date text, sensorID int, 
+                        temperature_C float, io text)''')
+        old.execute('CREATE TABLE current_id (max_id int)')
+        dates = ['2017-10-01 12:00:00.250000', '2017-10-01 12:01:00',
+                 '2017-10-01 12:02:00.500000']
+        old.executemany('INSERT INTO sensor_data VALUES (?,?,?,?,?)',
+                        [(0, dates[0], 8, 20.0, '1'), (1, dates[1], 8, 20.5, '1'),
+                         (1, dates[2], 8, 21.0, '1')])
+        old.execute('INSERT INTO current_id VALUES (2)')
+        old.commit()
+        old.close()
+
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.db.connect()
+        self.db.cur.execute('''SELECT name FROM sqlite_master 
+                               WHERE name='current_id';''')
+        self.assertEqual(self.db.cur.fetchone(), None)
+        self.db.write({"id" : 8, "temperature_C" : 21.5, "io" : "1"})
+        while not self.db.migrate_step(chunk_size=2):
+            pass
+        self.db.connect()
+        self.db.cur.execute("SELECT id, date FROM sensor_data ORDER BY id")
+        data = self.db.cur.fetchall()
+        self.assertEqual([row[0] for row in data], [0, 1, 2, 3])
+        # Local time strings become UTC epoch milliseconds.
+        expected = [round(datetime.strptime(date[:19], '%Y-%m-%d %H:%M:%S')
+                          .timestamp() * 1000) for date in dates]
+        self.assertEqual([row[1] for row in data][:3],
+                         [expected[0] + 250, expected[1], expected[2] + 500])
+        self.db.cur.execute('''SELECT name FROM sqlite_master 
+                               WHERE name='current_id';''')
+        self.assertEqual(self.db.cur.fetchone(), None)
+        self.db.cur.execute("SELECT model FROM sensor_data ORDER BY id")
+        self.assertEqual([row[0] for row in self.db.cur.fetchall()],
+                         [None, None, None, None])
+        # The old rows are backfilled and the new one isn't counted twice.
+        self.db.cur.execute("SELECT SUM(count) FROM rollup_day")
+        self.assertEqual(self.db.cur.fetchone()[0], 4)
+
+    def testConcurrentMigrations(self):
+        ''' Several processes can migrate the same database at once, while
+            it is written to.
+        '''
+        self.db.close()
+        os.remove(self.db_path)
+        old = sq.connect(self.db_path)
+        old.execute('''CREATE TABLE sensor_data  
+                       (id integer, date text, sensorID int, 
+                        temperature_C float, io text)''')
+        old.execute('CREATE TABLE current_id (max_id int)')
+        old.executemany('INSERT INTO sensor_data VALUES (?,?,?,?,?)',
+                        [(n, '2017-10-01 12:00:00', 8, 20.0, '1')
+                         for n in range(3000)])
+        old.commit()
+        old.close()
+
+        databases = [rtl_433_2sqlite.initDatabase(sq, self.db_path)
+                     for _ in range(3)]
+        errors = []
+        def migrate(database):
+            try:
+                while not database.migrate_step(chunk_size=50):
+                    database.write_many([{"id" : 3, "temperature_C" : 1.0}])
+            except Exception as error:
+                errors.append(error)
+            finally:
+                database.close()
+        threads = [threading.Thread(target=migrate, args=(database,))
+                   for database in databases]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.assertTrue(self.db.migrate_step())
+        self.db.connect()
+        self.db.cur.execute('''SELECT COUNT(*), COUNT(DISTINCT id),
+                                      SUM(typeof(date) = 'integer')
+                               FROM sensor_data''')
+        rows, ids, dates = self.db.cur.fetchone()
+        self.assertEqual((ids, dates), (rows, rows))
+        self.db.cur.execute("SELECT SUM(count) FROM rollup_day")
+        self.assertEqual(self.db.cur.fetchone()[0], rows)
+
+
+class TestReadPool(unittest.TestCase):
+    ''' Tests the readPool class.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_pool_db.sqlite'
+        try:
+            os.remove(self.db_path)
+        except FileNotFoundError:
+            pass
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.pool = self.db.read_pool(size=2)
+
+    def tearDown(self):
+        '''
+        '''
+        self.pool.close()
+        self.db.close()
+        os.remove(self.db_path)
+
+    def testReadOnly(self):
+        ''' Pooled connections can't write and are reused.
+        '''
+        with self.pool.connection() as db:
+            first = db
+            with self.assertRaises(sq.OperationalError):
+                db.execute("DELETE FROM sensor_data")
+        with self.pool.connection() as db:
+            self.assertIs(db, first)
+
+    def testReadWhileWriting(self):
+        ''' Readers keep getting answers, and the writer never sees a locked
+            database, while batches are committed as fast as possible.
+        '''
+        test_json = {"model" : "WG-PB12V1", "id" : 8, "temperature_C" : 20.9,
+                     "io" : "111111110011001001100001011010001111111101001100"}
+        errors = []
+        counts = []
+        stop = threading.Event()
+
+        def write():
+            try:
+                while not stop.is_set():
+                    self.db.write_many([test_json] * 50)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                self.db.close()
+
+        def read():
+            try:
+                while not stop.is_set():
+                    with self.pool.connection() as db:
+                        counts.append(db.execute(
+                            "SELECT COUNT(*) FROM sensor_data").fetchone()[0])
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=write),
+                   threading.Thread(target=read),
+                   threading.Thread(target=read)]
+        for thread in threads:
+            thread.start()
+        time.sleep(1)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertGreater(len(counts), 10)
+        self.assertGreater(max(counts), 0)
+
+class TestFieldExtractors(unittest.TestCase):
+    ''' Tests the per-model field extractors.
+    '''
+
+    def testDefault(self):
+        ''' The original sensor fills the original columns and leaves no
+            extra.
+        '''
+        extractors = rtl_433_2sqlite.fieldExtractors()
+        test_json = {"time" : "@0.000000s", "model" : "WG-PB12V1", 
+                     "id" : 8, "temperature_C" : 20.900, 
+                     "io" : "111111110011001001100001011010001111111101001100"}
+        self.assertEqual(extractors.extract(test_json),
+                         (8, 20.9,
+                          rtl_433_2sqlite.packIO(
+                          '111111110011001001100001011010001111111101001100'),
+                          'WG-PB12V1', None, None, None, None, None))
+
+    def testFahrenheitAndBatteryOk(self):
+        ''' temperature_F is converted and battery_ok is used as it is.
+        '''
+        extractors = rtl_433_2sqlite.fieldExtractors()
+        row = extractors.extract({"model" : "Acurite-Tower", "id" : 3,
+                                  "temperature_F" : 212.0, "battery_ok" : 1})
+        self.assertEqual(row[1], 100.0)
+        self.assertEqual(row[6], 1)
+        self.assertEqual(row[7], None)
+
+    def testModelOverride(self):
+        ''' A registered model uses its own getters, others the default.
+        '''
+        overrides = {'Foo' : {'sensorID' : (lambda json_data: 
+                                            json_data['rid'], ('rid',))}}
+        extractors = rtl_433_2sqlite.fieldExtractors(overrides)
+        self.assertEqual(extractors.extract({"model" : "Foo", "rid" : 5})[0], 5)
+        row = extractors.extract({"model" : "Bar", "rid" : 5})
+        self.assertEqual(row[0], None)
+        self.assertEqual(row[8], '{"rid": 5}')
+
+    def testCommand(self):
+        ''' Each protocol gets its own -R.
+        '''
+        self.assertEqual(rtl_433_2sqlite.rtlCommand('rtl_433', protocols=(39, 40)),
+                         ['rtl_433', '-R', '39', '-R', '40', '-F', 'json'])
+        self.assertEqual(rtl_433_2sqlite.rtlCommand('rtl_433', protocols=()),
+                         ['rtl_433', '-F', 'json'])
+        self.assertEqual(rtl_433_2sqlite.rtlCommand('rtl_433', protocols=(39,),
+                                                    args=['-f', '868M']),
+                         ['rtl_433', '-R', '39', '-f', '868M', '-F', 'json'])
+
+class TestDedupCache(unittest.TestCase):
+    ''' Tests the dedupCache class.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.reading = {"time" : "@0.000000s", "model" : "WG-PB12V1",
+                        "id" : 8, "temperature_C" : 20.9, "io" : "1111"}
+        self.dedup = rtl_433_2sqlite.dedupCache(window=2000, size=2)
+
+    def testWindow(self):
+        ''' Copies inside the window are dropped, the window runs from the
+            first copy.
+        '''
+        self.assertTrue(self.dedup.admit(self.reading, now=10.0))
+        self.assertFalse(self.dedup.admit(self.reading, now=10.5))
+        self.assertFalse(self.dedup.admit(self.reading, now=11.9))
+        self.assertTrue(self.dedup.admit(self.reading, now=12.0))
+        self.assertEqual((self.dedup.passed, self.dedup.suppressed), (2, 2))
+
+    def testDifferentReadings(self):
+        ''' A different io, or a model without io that changes, is new.
+        '''
+        other = dict(self.reading, io="0000")
+        self.assertTrue(self.dedup.admit(self.reading, now=10.0))
+        self.assertTrue(self.dedup.admit(other, now=10.1))
+        humidity = {"time" : "1", "model" : "LaCrosse", "id" : 1, "humidity" : 50}
+        self.assertTrue(self.dedup.admit(humidity, now=10.2))
+        self.assertFalse(self.dedup.admit(dict(humidity, time="2"), now=10.3))
+        self.assertTrue(self.dedup.admit(dict(humidity, humidity=51), now=10.4))
+
+    def testEviction(self):
+        ''' Only size keys are kept, least recently seen go first.
+        '''
+        self.dedup.admit(self.reading, now=10.0)
+        self.dedup.admit(dict(self.reading, id=1), now=10.0)
+        self.dedup.admit(dict(self.reading, id=2), now=10.0)
+        self.assertTrue(self.dedup.admit(self.reading, now=10.1))
+
+class TestDeadbandFilter(unittest.TestCase):
+    ''' Tests the deadbandFilter class.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.deadband = rtl_433_2sqlite.deadbandFilter(threshold=0.1,
+                                                       thresholds={3 : 1.0},
+                                                       heartbeat=60000)
+
+    def reading(self, sensor, temperature, **fields):
+        '''
+        '''
+        return dict({"model" : "WG-PB12V1", "id" : sensor,
+                     "temperature_C" : temperature}, **fields)
+
+    def testThreshold(self):
+        ''' Small moves are skipped, per sensor thresholds are used.
+        '''
+        self.assertTrue(self.deadband.admit(self.reading(8, 20.0), now=0))
+        self.assertFalse(self.deadband.admit(self.reading(8, 20.1), now=1))
+        self.assertTrue(self.deadband.admit(self.reading(8, 20.2), now=2))
+        self.assertTrue(self.deadband.admit(self.reading(3, 20.0), now=3))
+        self.assertFalse(self.deadband.admit(self.reading(3, 20.9), now=4))
+        self.assertEqual((self.deadband.stored, self.deadband.skipped), (3, 2))
+
+    def testHeartbeatAndOtherFields(self):
+        ''' A reading is stored after heartbeat, or if the battery changes.
+        '''
+        self.deadband.admit(self.reading(8, 20.0, battery="OK"), now=0)
+        self.assertFalse(self.deadband.admit(self.reading(8, 20.0, battery="OK"),
+                                             now=59999))
+        self.assertTrue(self.deadband.admit(self.reading(8, 20.0, battery="LOW"),
+                                            now=59999))
+        self.assertTrue(self.deadband.admit(self.reading(8, 20.0, battery="LOW"),
+                                            now=120000))
+
+    def testLoad(self):
+        ''' The last stored values are reloaded from the database.
+        '''
+        db_path = '/tmp/test_deadband_db.sqlite'
+        try:
+            os.remove(db_path)
+        except FileNotFoundError:
+            pass
+        database = rtl_433_2sqlite.initDatabase(sq, db_path)
+        database.write_many([self.reading(8, 20.0, battery="OK")], [1000])
+        database.close()
+        self.deadband.load(database)
+        os.remove(db_path)
+        self.assertFalse(self.deadband.admit(self.reading(8, 20.05, battery="OK"),
+                                             now=2000))
+        self.assertTrue(self.deadband.admit(self.reading(8, 20.05), now=61000))
+
+class TestBatchWriter(unittest.TestCase):
+    ''' Tests the batchWriter class.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.mock_database = Mock()
+        self.writer = rtl_433_2sqlite.batchWriter(self.mock_database,
+                                                  batch_size=3,
+                                                  flush_interval=1000)
+
+    def testFlushOnBatchSize(self):
+        ''' Rows are only written once batch_size have accumulated.
+        '''
+        self.writer.add({'id' : 1})
+        self.writer.add({'id' : 2})
+        self.assertFalse(self.mock_database.write_many.called)
+        self.writer.add({'id' : 3})
+        self.assertEqual(self.mock_database.write_many.call_count, 1)
+        rows = self.mock_database.write_many.call_args[0][0]
+        self.assertEqual(rows, [{'id' : 1}, {'id' : 2}, {'id' : 3}])
+        self.assertEqual(len(self.writer), 0)
+
+    @patch('rtl_433_2sqlite.time.monotonic')
+    def testFlushOnInterval(self, mock_monotonic):
+        ''' A part filled batch is written once flush_interval has passed.
+        '''
+        mock_monotonic.return_value = 100.0
+        self.writer.add({'id' : 1})
+        self.assertFalse(self.writer.due())
+        mock_monotonic.return_value = 101.0
+        self.assertTrue(self.writer.due())
+        self.writer.add({'id' : 2})
+        self.assertEqual(self.mock_database.write_many.call_count, 1)
+
+    def testMetrics(self):
+        ''' Each commit's size and time are recorded.
+        '''
+        metrics = rtl_433_2sqlite.pipelineMetrics()
+        writer = rtl_433_2sqlite.batchWriter(self.mock_database, batch_size=2,
+                                             metrics=metrics)
+        metrics.watch(writer, rtl_433_2sqlite.dedupCache())
+        for n in range(5):
+            writer.add({'id' : n})
+        writer.flush()
+        self.assertEqual(metrics.batch_rows.count, 3)
+        self.assertEqual(metrics.batch_rows.sum, 5)
+        self.assertEqual(metrics.commit_seconds.count, 3)
+        self.assertEqual(metrics.registry.get('rtl433_rows_written_total'), 5)
+        self.assertIn('rtl433_batch_rows_bucket{le="2"} 3',
+                      metrics.registry.render())
+
+    def testFlushEmpty(self):
+        ''' Flushing with nothing buffered doesn't touch the database.
+        '''
+        self.writer.flush()
+        self.assertFalse(self.mock_database.write_many.called)
+
+    @patch('rtl_433_2sqlite.time.monotonic')
+    def testFailedCommit(self, mock_monotonic):
+        ''' A batch that fails to commit is kept, ahead of rows added
+            since, and tried again after a backoff that doubles.
+        '''
+        mock_monotonic.return_value = 100.0
+        self.mock_database.write_many.side_effect = [
+                sq.OperationalError('database is locked'),
+                sq.OperationalError('database is locked'), None]
+        with patch('sys.stderr', new=io.StringIO()) as stderr:
+            for n in range(4):
+                self.writer.add({'id' : n})
+            self.assertFalse(self.writer.flush())
+        self.assertIn('retrying in 0.5 s', stderr.getvalue())
+        self.assertEqual(len(self.writer), 4)
+        self.assertEqual(self.writer.failures, 2)
+        self.assertTrue(self.writer.waiting())
+        self.assertFalse(self.writer.full() or self.writer.due())
+        self.assertEqual(self.writer.timeout(5), 1.0)
+        mock_monotonic.return_value = 101.0
+        self.assertTrue(self.writer.due())
+        self.assertTrue(self.writer.flush())
+        rows = self.mock_database.write_many.call_args[0][0]
+        self.assertEqual(rows, [{'id' : n} for n in range(4)])
+        self.assertEqual(self.writer.rows, 4)
+        self.assertFalse(self.writer.waiting())
+
+class TestRetention(unittest.TestCase):
+    ''' Tests retentionPolicy and initDatabase.prune().
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_retention_db.sqlite'
+        self.tearDown()
+        self.database = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        rows = []
+        timestamps = []
+        # A reading a day for ten days from three sensors, 3 and 4 are
+        # the same model.
+        for day in range(10):
+            for sensor, model in ((3, "WG-PB12V1"), (4, "WG-PB12V1"),
+                                  (5, "Acurite-Tower")):
+                rows.append({"model" : model, "id" : sensor,
+                             "temperature_C" : 20.0, "pad" : "x" * 2000})
+                timestamps.append(day * rtl_433_2sqlite.DAY)
+        self.database.write_many(rows, timestamps)
+        self.now = 10 * rtl_433_2sqlite.DAY
+
+    def tearDown(self):
+        '''
+        '''
+        for suffix in ('', '-wal', '-shm'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.db_path + suffix)
+
+    def count(self, sensor):
+        return self.database.cur.execute('''SELECT COUNT(*) FROM sensor_data
+                                            WHERE sensorID = ?''',
+                                         (sensor,)).fetchone()[0]
+
+    def testNewDatabaseIsIncremental(self):
+        '''
+        '''
+        self.assertEqual(self.database.cur.execute('PRAGMA auto_vacuum')
+                                          .fetchone()[0], 2)
+
+    def testSensorsAndModels(self):
+        ''' A sensor's keep wins over its model's, which wins over keep.
+        '''
+        retention = rtl_433_2sqlite.retentionPolicy(
+                        keep=5 * rtl_433_2sqlite.DAY,
+                        sensors={4 : None},
+                        models={"WG-PB12V1" : 2 * rtl_433_2sqlite.DAY})
+        self.assertEqual(self.database.prune(retention, self.now), 13)
+        self.assertEqual(self.count(3), 2)
+        self.assertEqual(self.count(4), 10)
+        self.assertEqual(self.count(5), 5)
+
+    def testChunks(self):
+        ''' At most chunk_size rows go at a time, and the space comes back.
+        '''
+        retention = rtl_433_2sqlite.retentionPolicy(
+                        keep=rtl_433_2sqlite.DAY, chunk_size=4)
+        deleted = []
+        while not deleted or deleted[-1] == 4:
+            deleted.append(self.database.prune(retention, self.now))
+        self.assertEqual(deleted, [4] * 6 + [3])
+        self.assertEqual(self.count(5), 1)
+        self.assertGreater(self.database.incremental_vacuum(), 0)
+        self.assertEqual(self.database.cur.execute('PRAGMA freelist_count')
+                                          .fetchone()[0], 0)
+
+    def testRun(self):
+        ''' A backlog is worked off a chunk per run, then it waits interval.
+        '''
+        retention = rtl_433_2sqlite.retentionPolicy(
+                        keep=9 * rtl_433_2sqlite.DAY, chunk_size=2,
+                        interval=60000)
+        metrics = rtl_433_2sqlite.pipelineMetrics()
+        metrics.watch(Mock(), rtl_433_2sqlite.dedupCache(),
+                      retention=retention)
+        self.assertEqual(retention.run(self.database, self.now), 2)
+        self.assertEqual(retention.run(self.database, self.now), 1)
+        self.assertEqual(self.database.cur.execute('''SELECT MIN(date)
+                                                      FROM sensor_data''')
+                                          .fetchone()[0], rtl_433_2sqlite.DAY)
+        with patch.object(self.database, 'prune') as prune:
+            retention.run(self.database, self.now + 59999)
+            self.assertFalse(prune.called)
+        self.assertEqual(metrics.registry.get(
+                            'rtl433_retention_deleted_total'), 3)
+
+    def testWriterRunsRetention(self):
+        '''
+        '''
+        retention = Mock()
+        writer = rtl_433_2sqlite.batchWriter(Mock(), retention=retention)
+        writer.add({'id' : 1})
+        writer.flush()
+        retention.run.assert_called_once_with(writer.database)
+
+class TestLatestCache(unittest.TestCase):
+    ''' Tests the latestCache class.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.cache = rtl_433_2sqlite.latestCache(backlog=2)
+
+    def testUpdate(self):
+        ''' Older readings, from the spill journal, don't replace newer.
+        '''
+        self.cache.update([{"model" : "WG-PB12V1", "id" : 8,
+                            "temperature_C" : 20.5, "receiver" : "433"},
+                           {"model" : "WG-PB12V1", "id" : 3,
+                            "temperature_F" : 32.0},
+                           {"model" : "WG-PB12V1", "id" : 8,
+                            "temperature_C" : 19.0}], [2000, 2000, 1000])
+        self.assertEqual(self.cache.get(8),
+                         {'date' : 2000, 'sensorID' : 8, 'temperature_C' : 20.5,
+                          'model' : "WG-PB12V1", 'channel' : None,
+                          'humidity' : None, 'battery' : None,
+                          'receiver' : "433"})
+        self.assertEqual([r['sensorID'] for r in self.cache.all()], [3, 8])
+        self.assertEqual(self.cache.all()[0]['temperature_C'], 0.0)
+        self.assertEqual(self.cache.get(99), None)
+
+    def testSubscribe(self):
+        ''' Subscribers only get their sensors, and are dropped once they
+            are backlog behind.
+        '''
+        eight = self.cache.subscribe([8])
+        every = self.cache.subscribe()
+        for date in range(2):
+            self.cache.update([{"id" : 8, "temperature_C" : 20.0},
+                               {"id" : 3, "temperature_C" : 20.0}],
+                              [date, date])
+        self.assertEqual(self.cache.subscribers(), 1)
+        self.assertEqual([every.get_nowait()['sensorID'] for _ in range(2)],
+                         [8, 3])
+        self.assertEqual(every.get_nowait(), None)
+        self.assertEqual([eight.get_nowait()['date'] for _ in range(2)],
+                         [0, 1])
+        self.cache.close()
+        self.assertEqual(eight.get_nowait(), None)
+        self.assertEqual(self.cache.subscribers(), 0)
+
+    def testLoadAndWriter(self):
+        ''' The cache is seeded from the database and updated on commit.
+        '''
+        db_path = '/tmp/test_latest_db.sqlite'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path)
+        database = rtl_433_2sqlite.initDatabase(sq, db_path)
+        database.write_many([{"model" : "WG-PB12V1", "id" : 8,
+                              "temperature_C" : 20.0}], [1000])
+        self.cache.load(database)
+        self.assertEqual(self.cache.get(8)['date'], 1000)
+        writer = rtl_433_2sqlite.batchWriter(database, latest=self.cache)
+        writer.add({"model" : "WG-PB12V1", "id" : 8, "temperature_C" : 21.0})
+        writer.flush()
+        self.assertEqual(self.cache.get(8)['temperature_C'], 21.0)
+        database.close()
+        os.remove(db_path)
+
+    def testOldDatabase(self):
+        ''' A database with text dates, that still needs migrating, seeds
+            nothing and is migrated by the writer's commits.
+        '''
+        db_path = '/tmp/test_latest_db.sqlite'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path)
+        old = sq.connect(db_path)
+        old.execute('''CREATE TABLE sensor_data
+                       (id integer, date text, sensorID int,
+                        temperature_C float, io text)''')
+        old.execute('CREATE TABLE current_id (max_id int)')
+        old.execute("INSERT INTO sensor_data VALUES (0, ?, 8, 20.0, '1')",
+                    ('2017-10-01 12:00:00',))
+        old.execute('INSERT INTO current_id VALUES (1)')
+        old.commit()
+        old.close()
+        database = rtl_433_2sqlite.initDatabase(sq, db_path)
+        self.cache.load(database)
+        self.assertEqual(self.cache.get(8), None)
+        deadband = rtl_433_2sqlite.deadbandFilter()
+        deadband.load(database)
+        self.assertTrue(deadband.admit({"model" : None, "id" : 8,
+                                        "temperature_C" : 20.0}))
+        writer = rtl_433_2sqlite.batchWriter(database, latest=self.cache)
+        for temperature in range(10):
+            writer.add({"model" : "WG-PB12V1", "id" : 8,
+                        "temperature_C" : temperature})
+            writer.flush()
+            self.assertEqual(self.cache.get(8)['temperature_C'], temperature)
+            if database.migrated:
+                break
+        self.assertTrue(database.migrated)
+        self.assertEqual(database.version, database.SCHEMA_VERSION)
+        database.close()
+        os.remove(db_path)
+
+class TestSpillQueue(unittest.TestCase):
+    ''' Tests the spillJournal and spillQueue classes.
+    '''
+
+    def setUp(self):
         '''
-        self.assertTrue(False)
+        '''
+        self.path = '/tmp/test_spill'
+        self.tearDown()
+
+    def tearDown(self):
+        '''
+        '''
+        for path in (self.path, self.path + '.offset'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def fill(self, queue, count):
+        ''' Puts count stamped lines on queue.
+        '''
+        for n in range(count):
+            queue.put((time.monotonic(), b'line %d\n' % n, None))
+
+    def testSpillInOrder(self):
+        ''' Lines past maxsize go to the journal and everything comes back
+            out in the order it went in.
+        '''
+        journal = rtl_433_2sqlite.spillJournal(self.path)
+        queue = rtl_433_2sqlite.spillQueue(journal, maxsize=3)
+        self.fill(queue, 10)
+        self.assertEqual(len(queue.queue), 3)
+        self.assertEqual(journal.pending, 7)
+        self.assertEqual(queue.qsize(), 10)
+        lines = [queue.get()[1] for _ in range(10)]
+        self.assertEqual(lines, [b'line %d\n' % n for n in range(10)])
+        self.assertTrue(queue.empty())
+
+        queue.checkpoint()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        journal.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def testBatches(self):
+        ''' A list of lines counts as that many against maxsize, and once
+            spilled comes back out a line at a time.
+        '''
+        journal = rtl_433_2sqlite.spillJournal(self.path)
+        queue = rtl_433_2sqlite.spillQueue(journal, maxsize=3)
+        queue.put((time.monotonic(), [b'line 0\n', b'line 1\n'], None))
+        queue.put((time.monotonic(), [b'line 2\n', b'line 3\n'], None))
+        self.fill(queue, 1)
+        self.assertEqual(len(queue.queue), 1)
+        self.assertEqual(journal.pending, 3)
+        self.assertEqual(queue.qsize(), 5)
+        self.assertEqual([queue.get()[1] for _ in range(4)],
+                         [[b'line 0\n', b'line 1\n'], b'line 2\n',
+                          b'line 3\n', b'line 0\n'])
+        self.assertTrue(queue.empty())
+        queue.checkpoint()
+        journal.close()
+
+    def testReplayAtStart(self):
+        ''' Lines not checkpointed are read again when the journal is
+            reopened, and a half written record is dropped.
+        '''
+        journal = rtl_433_2sqlite.spillJournal(self.path)
+        queue = rtl_433_2sqlite.spillQueue(journal, maxsize=0)
+        self.fill(queue, 5)
+        queue.get()
+        queue.checkpoint()
+        queue.get()
+        journal.close()
+        with open(self.path, 'ab') as torn:
+            torn.write(journal.HEADER.pack(0, 0, 100) + b'{"half')
+
+        journal = rtl_433_2sqlite.spillJournal(self.path)
+        self.assertEqual(journal.pending, 4)
+        self.assertEqual([journal.read()[1] for _ in range(4)],
+                         [b'line %d\n' % n for n in range(1, 5)])
+        journal.close()
+
+    @patch('rtl_433_2sqlite.time.monotonic')
+    @patch('rtl_433_2sqlite.time.time')
+    def testSpilledDates(self, mock_time, mock_monotonic):
+        ''' Rows from the journal are dated when they were read, not when
+            they were written.
+        '''
+        # Dates go through time.monotonic() and back, so both are frozen.
+        mock_time.return_value = 1507000000
+        mock_monotonic.return_value = 1000.0
+        db_path = '/tmp/test_spill_db.sqlite'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path)
+        database = rtl_433_2sqlite.initDatabase(sq, db_path)
+        journal = rtl_433_2sqlite.spillJournal(self.path)
+        journal.append(1506000000000, b'{"model" : "WG-PB12V1", "id" : 8, '
+                                      b'"temperature_C" : 20.9}\n')
+        queue = rtl_433_2sqlite.spillQueue(journal)
+        reader = Mock()
+        reader.eof.side_effect = queue.empty
+        writer = rtl_433_2sqlite.batchWriter(database)
+        rtl_433_2sqlite.consumeLines([reader], queue, writer,
+                                     rtl_433_2sqlite.dedupCache(0))
+        database.connect()
+        database.cur.execute("SELECT date, sensorID FROM sensor_data")
+        self.assertEqual(database.cur.fetchall(), [(1506000000000, 8)])
+        database.close()
+        journal.close()
+        os.remove(db_path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def testSpilledRepeats(self):
+        ''' Identical readings spilled a minute apart aren't repeats,
+            though they are taken from the journal together.
+        '''
+        db_path = '/tmp/test_spill_db.sqlite'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path)
+        database = rtl_433_2sqlite.initDatabase(sq, db_path)
+        journal = rtl_433_2sqlite.spillJournal(self.path)
+        for millis in (1506000000000, 1506000060000):
+            journal.append(millis, b'{"model" : "WG-PB12V1", "id" : 8, '
+                                   b'"temperature_C" : 20.9}\n')
+        queue = rtl_433_2sqlite.spillQueue(journal)
+        reader = Mock()
+        reader.eof.side_effect = queue.empty
+        writer = rtl_433_2sqlite.batchWriter(database)
+        rtl_433_2sqlite.consumeLines([reader], queue, writer,
+                                     rtl_433_2sqlite.dedupCache())
+        self.assertEqual(writer.rows, 2)
+        database.close()
+        journal.close()
+        os.remove(db_path)
+
+    def testLockedDatabase(self):
+        ''' Lines aren't lost, or checkpointed, while another process holds
+            the lock for longer than the busy timeout.
+        '''
+        db_path = '/tmp/test_spill_db.sqlite'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path)
+        database = rtl_433_2sqlite.initDatabase(sq, db_path, busy_timeout=10)
+        journal = rtl_433_2sqlite.spillJournal(self.path)
+        for n in range(3):
+            journal.append(1506000000000 + n, b'{"model" : "WG-PB12V1", '
+                                              b'"id" : %d}\n' % n)
+        queue = rtl_433_2sqlite.spillQueue(journal)
+        reader = Mock()
+        reader.eof.side_effect = queue.empty
+        writer = rtl_433_2sqlite.batchWriter(database, flush_interval=0,
+                                             backoff=0.05)
+        locker = sq.connect(db_path, check_same_thread=False)
+        locker.execute('BEGIN IMMEDIATE')
+        timer = threading.Timer(0.3, locker.rollback)
+        timer.start()
+        with patch('sys.stderr', new=io.StringIO()):
+            rtl_433_2sqlite.consumeLines([reader], queue, writer,
+                                         rtl_433_2sqlite.dedupCache())
+        timer.join()
+        locker.close()
+        self.assertGreater(writer.failures, 0)
+        self.assertEqual(writer.rows, 3)
+        database.close()
+        journal.close()
+        self.assertFalse(os.path.exists(self.path))
+        os.remove(db_path)
 
+    def testInterruptedCommit(self):
+        ''' A commit interrupted by SIGTERM keeps its batch, and the journal
+            isn't checkpointed until the batch is written after all.
+        '''
+        db_path = '/tmp/test_spill_db.sqlite'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path)
+        database = rtl_433_2sqlite.initDatabase(sq, db_path)
+        journal = rtl_433_2sqlite.spillJournal(self.path)
+        for n in range(2):
+            journal.append(1506000000000 + n, b'{"model" : "WG-PB12V1", '
+                                              b'"id" : %d}\n' % n)
+        queue = rtl_433_2sqlite.spillQueue(journal)
+        reader = Mock()
+        reader.eof.side_effect = queue.empty
+        writer = rtl_433_2sqlite.batchWriter(database, flush_interval=0)
+        dedup = rtl_433_2sqlite.dedupCache()
+        with patch.object(database, 'write_many', wraps=database.write_many,
+                          side_effect=[KeyboardInterrupt, DEFAULT, DEFAULT]):
+            with self.assertRaises(KeyboardInterrupt):
+                rtl_433_2sqlite.consumeLines([reader], queue, writer, dedup)
+            self.assertEqual(len(writer), 1)
+            # As startReceivers does, write what has already been read.
+            rtl_433_2sqlite.consumeLines([reader], queue, writer, dedup)
+        self.assertEqual(writer.rows, 2)
+        self.assertTrue(writer.settled())
+        database.connect()
+        database.cur.execute("SELECT sensorID FROM sensor_data ORDER BY id")
+        self.assertEqual(database.cur.fetchall(), [(0,), (1,)])
+        database.close()
+        journal.close()
+        self.assertFalse(os.path.exists(self.path))
+        os.remove(db_path)
 
 class TestAsyncFileReader(unittest.TestCase):
     ''' Tests the asyncFileReaderClass.
@@ -209,23 +1175,65 @@ class TestAsyncFileReader(unittest.TestCase):
         expected = [(('hello',),), (('world',),)]
         self.assertEqual(self.test_queue._queue.put.call_args_list, expected)
 
-    @patch('builtins.open')
-    def testRTLDataLogged(self, m_open):
-        ''' Check that when a log file is specified that it actually calls
-            file.write() with data.
+    def testRTLDataLogged(self):
+        ''' Check that when a log file is specified every line is handed to
+            its captureWriter, and that one made from a path is closed at
+            EOF.
         '''
 
         mock_processOut = Mock()
         mock_queueClass = Mock(spec=Queue.Queue())
+        mock_capture = Mock()
         test_queue = rtl_433_2sqlite.asyncFileReader(mock_processOut, mock_queueClass,
-                                                    log_file='/tmp/test.tmp')
+                                                    log_file=mock_capture)
         mock_processOut.readline.side_effect=['hello', 'world','','foo']
         test_queue.run()
-        m_open.assert_called_with('/tmp/test.tmp', 'w')
-        handle = m_open().__enter__()
         expected = [(('hello',),), (('world',),)]
-        self.assertEqual(handle.write.call_args_list, expected)
+        self.assertEqual(mock_capture.write.call_args_list, expected)
+        self.assertFalse(mock_capture.close.called)
+
+        with patch('rtl_433_capture.captureWriter') as m_capture:
+            test_queue = rtl_433_2sqlite.asyncFileReader(mock_processOut,
+                                                        mock_queueClass,
+                                                        log_file='/tmp/test.tmp')
+            mock_processOut.readline.side_effect=['hello', '']
+            test_queue.run()
+        m_capture.assert_called_with('/tmp/test.tmp')
+        m_capture().write.assert_called_with('hello')
+        self.assertTrue(m_capture().close.called)
         
+    def testChunked(self):
+        ''' Lines split across reads, longer than the buffer or with no
+            newline at EOF come out whole, in one list per read, and each
+            read's complete lines go to the capture in one write.
+        '''
+        read_fd, write_fd = os.pipe()
+        queue = Queue.Queue()
+        mock_capture = Mock()
+        with open(read_fd, 'rb') as pipe:
+            reader = rtl_433_2sqlite.asyncFileReader(pipe, queue, mock_capture,
+                                                    stamp=True, receiver='433',
+                                                    chunk_size=8)
+            reader.start()
+            for part in (b'one\ntw', b'o\n', b'a line longer than 8\nla',
+                         b'st'):
+                os.write(write_fd, part)
+                time.sleep(0.01)
+            os.close(write_fd)
+            reader.join()
+        items = []
+        while not queue.empty():
+            items.append(queue.get())
+        lines = [line for _, batch, _ in items for line in batch]
+        self.assertEqual(lines, [b'one\n', b'two\n',
+                                 b'a line longer than 8\n', b'last'])
+        self.assertTrue(all(isinstance(batch, list) and receiver == '433'
+                            for _, batch, receiver in items))
+        self.assertEqual(b''.join(c[0][0] for c in
+                                  mock_capture.write.call_args_list),
+                         b''.join(lines))
+        self.assertTrue(reader.eof())
+
 class TestRTL433recordings(unittest.TestCase):
     ''' Tests that the correct data is stored when the recordings from
         RTL 433 tests are used for the WG-PB12v1
@@ -282,6 +1290,61 @@ class TestCreatePID(unittest.TestCase):
 
         with self.assertRaises(rtl_433_2sqlite.alreadyRunningError):
             rtl_433_2sqlite.createPID(self.pidfile, 77778)
+
+    def testStaleFile(self):
+        ''' A PID file left by a crash, so not locked, doesn't stop a start.
+        '''
+        with open(self.pidfile, 'w') as stale:
+            stale.write('12345')
+        rtl_433_2sqlite.createPID(self.pidfile, self.pid_id)
+        with open(self.pidfile, 'r') as open_pidfile:
+            self.assertEqual(int(open_pidfile.readline()), self.pid_id)
+        rtl_433_2sqlite.deletePID(self.pidfile)
+
+    def testLockedByAnotherProcess(self):
+        ''' A PID file locked by a running process can't be taken, and
+            can be once that process has gone.
+        '''
+        script = ('import fcntl, sys, time\n'
+                  'f = open(sys.argv[1], "w")\n'
+                  'fcntl.flock(f, fcntl.LOCK_EX)\n'
+                  'print("locked", flush=True)\n'
+                  'time.sleep(30)\n')
+        holder = subprocess.Popen([sys.executable, '-c', script,
+                                   self.pidfile], stdout=subprocess.PIPE)
+        try:
+            holder.stdout.readline()
+            with self.assertRaises(rtl_433_2sqlite.alreadyRunningError):
+                rtl_433_2sqlite.createPID(self.pidfile, self.pid_id)
+        finally:
+            holder.kill()
+            holder.wait()
+            holder.stdout.close()
+        rtl_433_2sqlite.createPID(self.pidfile, self.pid_id)
+        rtl_433_2sqlite.deletePID(self.pidfile)
+    
+
+    def testDeletedWhileLocking(self):
+        ''' A lock taken on a file that deletePID has just unlinked is let
+            go, and the file that is there now locked instead.
+        '''
+        flock = fcntl.flock
+        calls = []
+        def unlinkFirst(fd, operation):
+            if not calls:
+                os.unlink(self.pidfile)
+            calls.append(fd)
+            flock(fd, operation)
+        with open(self.pidfile, 'w') as old:
+            old.write('12345')
+        with patch('rtl_433_2sqlite.fcntl.flock', side_effect=unlinkFirst):
+            rtl_433_2sqlite.createPID(self.pidfile, self.pid_id)
+        self.assertEqual(len(calls), 2)
+        with open(self.pidfile, 'r') as open_pidfile:
+            self.assertEqual(int(open_pidfile.readline()), self.pid_id)
+        with self.assertRaises(rtl_433_2sqlite.alreadyRunningError):
+            rtl_433_2sqlite.createPID(self.pidfile, 77778)
+        rtl_433_2sqlite.deletePID(self.pidfile)
     
 
 class TestDeletePID(unittest.TestCase):
@@ -344,35 +1407,24 @@ class TestRTL433Errors(unittest.TestCase):
             pass
             #print('rtl_433_2sqlite.pid already deleted')
 
-    @patch.object(rtl_433_2sqlite.initDatabase, 'write')
-    @patch('time.sleep', return_value=None)
-    @patch.object(Queue.Queue, 'empty', side_effect=ErrorAfter(3))
-    @patch.object(Queue.Queue, 'get')
-    @patch.object(rtl_433_2sqlite.asyncFileReader, 'eof', side_effect=ErrorAfter(2))
-    def testBlankResponse(self, mock_eof, mock_get, mock_empty, mock_sleep, 
-                            mock_database):
+    @patch('rtl_433_2sqlite.subprocess.Popen')
+    @patch.object(rtl_433_2sqlite.initDatabase, 'write_many')
+    def testBlankResponse(self, mock_database, mock_popen):
         ''' Sends a blank ('') response from rtl_433 to rtl_433_2sqlite.
         '''
         DB_FILE = "/tmp/tempdb.sqlite"
         RTL433 = "/home/ciaran/Code/rtl_433/build/src/rtl_433"
         DEBUG = False
       
-        empty_string = ''.encode()
-        mock_get.return_value = empty_string
+        mock_popen.return_value = fakeProcess([b'\n', b'\n'])
         db = rtl_433_2sqlite.initDatabase(sq, DB_FILE)
         rtl_433_2sqlite.startSubProcess(RTL433, db, DEBUG)
-        self.assertEqual(mock_get.call_count, 2) # Data retrived from 
-                                                 # fileReader
         self.assertEqual(mock_database.call_count, 0) # Should be no database
                                                       # calls.
 
-    @patch.object(rtl_433_2sqlite.initDatabase, 'write')
-    @patch('time.sleep', return_value=None)
-    @patch.object(Queue.Queue, 'empty', side_effect=ErrorAfter(4))
-    @patch.object(Queue.Queue, 'get')
-    @patch.object(rtl_433_2sqlite.asyncFileReader, 'eof', side_effect=ErrorAfter(2))
-    def testGoodBadGoodResponse(self, mock_eof, mock_get, mock_empty, mock_sleep,
-                                    mock_database):
+    @patch('rtl_433_2sqlite.subprocess.Popen')
+    @patch.object(rtl_433_2sqlite.initDatabase, 'write_many')
+    def testGoodBadGoodResponse(self, mock_database, mock_popen):
         ''' Sends a "good" RTL_433 response, then a "bad" (blank) response, 
             then good again.
 
@@ -381,46 +1433,527 @@ class TestRTL433Errors(unittest.TestCase):
         DB_FILE = "/tmp/tempdb.sqlite"
         RTL433 = "/home/ciaran/Code/rtl_433/build/src/rtl_433"
         DEBUG = False 
-        empty_string = ''.encode()
+        empty_string = '\n'.encode()
         good_string = ('{"time" : "@0.000000s",'
                        ' "model" : "WG-PB12V1",'
                        ' "id" : 8,'
                        ' "temperature_C" : 20.900,'
-                       ' "io" : "111111110011001001100001011010001111111101001100"}').encode()
-        calls = [good_string, empty_string, good_string]
-        mock_get.side_effect = calls
+                       ' "io" : "111111110011001001100001011010001111111101001100"}\n').encode()
+        mock_popen.return_value = fakeProcess([good_string, empty_string,
+                                               good_string],
+                                              [b'Found 1 device(s)\n'])
         db = rtl_433_2sqlite.initDatabase(sq, DB_FILE)
-        try:
-            rtl_433_2sqlite.startSubProcess(RTL433, db, DEBUG)
-        except CallableExhausted:
-            # To catch the error thrown by third loop, see ErrorAfter()
-            pass
-        self.assertEqual(mock_get.call_count, 3) # check database calls.
-        self.assertEqual(mock_database.call_count, 2) # check database calls.
+        rtl_433_2sqlite.startSubProcess(RTL433, db, DEBUG, dedup_window=0)
+        self.assertEqual(mock_database.call_count, 1) # one batch written.
         json_good = json.loads(good_string.decode('utf-8'))
-        expected = [((json_good,),),((json_good,),)]
-        self.assertEqual(mock_database.call_args_list, expected)
+        self.assertEqual(mock_database.call_args[0][0], [json_good, json_good])
+
+    @patch('rtl_433_2sqlite.subprocess.Popen')
+    def testLatencyReported(self, mock_popen):
+        ''' A line is committed as soon as its batch is due, not after a
+            fixed sleep, and the read to commit time is reported.
+        '''
+        DB_FILE = "/tmp/tempdb.sqlite"
+        RTL433 = "/home/ciaran/Code/rtl_433/build/src/rtl_433"
+        good_string = ('{"time" : "@0.000000s", "model" : "WG-PB12V1",'
+                       ' "id" : 8, "temperature_C" : 20.900,'
+                       ' "io" : "1111"}\n').encode()
+        mock_popen.return_value = fakeProcess([good_string] * 5)
+        db = rtl_433_2sqlite.initDatabase(sq, DB_FILE)
+        with patch.object(rtl_433_2sqlite.latencyStats, 'record') as mock_record:
+            rtl_433_2sqlite.startSubProcess(RTL433, db, False,
+                                            flush_interval=50,
+                                            dedup_window=0)
+        self.assertEqual(mock_record.call_count, 5)
+        for call in mock_record.call_args_list:
+            self.assertLess(call[0][0], 1.0)
+
+    @patch('rtl_433_2sqlite.subprocess.Popen')
+    @patch.object(rtl_433_2sqlite.initDatabase, 'write_many')
+    def testRepeatsSuppressed(self, mock_database, mock_popen):
+        ''' A burst of three copies of a packet is written once.
+        '''
+        DB_FILE = "/tmp/tempdb.sqlite"
+        RTL433 = "/home/ciaran/Code/rtl_433/build/src/rtl_433"
+        good_string = ('{"time" : "@0.000000s", "model" : "WG-PB12V1",'
+                       ' "id" : 8, "temperature_C" : 20.900,'
+                       ' "io" : "1111"}\n').encode()
+        mock_popen.return_value = fakeProcess([good_string] * 3)
+        db = rtl_433_2sqlite.initDatabase(sq, DB_FILE)
+        rtl_433_2sqlite.startSubProcess(RTL433, db, False)
+        self.assertEqual(len(mock_database.call_args[0][0]), 1)
 
     @patch.object(os, 'getpid', return_value='7777')
-    @patch.object(rtl_433_2sqlite.initDatabase, 'write')
-    @patch('time.sleep', return_value=None)
-    @patch.object(Queue.Queue, 'empty', side_effect=ErrorAfter(1))
-    @patch.object(Queue.Queue, 'get')
-    @patch.object(rtl_433_2sqlite.asyncFileReader, 'eof', side_effect=ErrorAfter(1))
-    def testRTL4332sqlitePIDDeleted(self, mock_eof, mock_get, mock_empty, mock_sleep,
-                                mock_database, mock_getpid):
+    @patch('rtl_433_2sqlite.subprocess.Popen')
+    @patch.object(rtl_433_2sqlite.initDatabase, 'write_many')
+    def testRTL4332sqlitePIDDeleted(self, mock_database, mock_popen,
+                                    mock_getpid):
         ''' Test that when RTL_433_2sqlite been errors out that the PID file is
             no longer present.
         '''
         DB_FILE = "/tmp/tempdb.sqlite"
         RTL433 = "/home/ciaran/Code/rtl_433/build/src/rtl_433"
         DEBUG = False 
+        mock_popen.return_value = fakeProcess([])
         db = rtl_433_2sqlite.initDatabase(sq, DB_FILE)
         rtl_433_2sqlite.startSubProcess(RTL433, db, DEBUG)
      
         with self.assertRaises(FileNotFoundError):
             open('/tmp/rtl_433_2sqlite.pid')
 
+class TestReceivers(unittest.TestCase):
+    ''' Tests running several receivers into one writer.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_receivers_db.sqlite'
+        self.pid_dir = '/tmp/test_receivers'
+        os.makedirs(self.pid_dir, exist_ok=True)
+        try:
+            os.remove(self.db_path)
+        except FileNotFoundError:
+            pass
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.receivers = [rtl_433_2sqlite.receiver('433', ['rtl_433']),
+                          rtl_433_2sqlite.receiver('868', ['rtl_433'])]
+
+    def tearDown(self):
+        '''
+        '''
+        os.remove(self.db_path)
+        for name in os.listdir(self.pid_dir):
+            os.remove(os.path.join(self.pid_dir, name))
+        os.rmdir(self.pid_dir)
+
+    @patch('rtl_433_2sqlite.subprocess.Popen')
+    def testTagged(self, mock_popen):
+        ''' Both receivers' rows are written, tagged with their names, and
+            their PID files are removed at the end.
+        '''
+        line = '{{"model" : "WG-PB12V1", "id" : {}, "temperature_C" : 20.9}}\n'
+        mock_popen.side_effect = [fakeProcess([line.format(1).encode()]),
+                                  fakeProcess([line.format(2).encode()])]
+        rtl_433_2sqlite.startReceivers(self.receivers, self.db,
+                                       report_interval=None,
+                                       pid_dir=self.pid_dir)
+        self.db.connect()
+        self.db.cur.execute("SELECT sensorID, receiver FROM sensor_data "
+                            "ORDER BY sensorID")
+        self.assertEqual(self.db.cur.fetchall(), [(1, '433'), (2, '868')])
+        self.db.close()
+        self.assertEqual(os.listdir(self.pid_dir), [])
+
+    @patch('rtl_433_2sqlite.subprocess.Popen')
+    def testLocked(self, mock_popen):
+        ''' A receiver that is already running isn't started again, and
+            nothing is left locked.
+        '''
+        logger_pid, rtl_pid = rtl_433_2sqlite.receiverPIDs('868',
+                                                           self.pid_dir)
+        rtl_433_2sqlite.createPID(logger_pid, '1')
+        self.assertRaises(rtl_433_2sqlite.alreadyRunningError,
+                          rtl_433_2sqlite.startReceivers, self.receivers,
+                          self.db, pid_dir=self.pid_dir)
+        self.assertFalse(mock_popen.called)
+        self.assertEqual(os.listdir(self.pid_dir),
+                         [os.path.basename(logger_pid)])
+
+    def testNames(self):
+        ''' Receivers need unique names.
+        '''
+        self.assertRaises(ValueError, rtl_433_2sqlite.startReceivers,
+                          self.receivers[:1] * 2, self.db,
+                          pid_dir=self.pid_dir)
+
+class TestRestart(unittest.TestCase):
+    ''' Tests restarting rtl_433 when it exits.
+    '''
+
+    # Prints a reading then exits, like rtl_433 losing its dongle.
+    SCRIPT = ('print(\'{"model" : "WG-PB12V1", "id" : 8, '
+              '"temperature_C" : 20.9}\'); exit(1)')
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_restart_db.sqlite'
+        self.rtl_pid = '/tmp/test_restart.pid'
+        try:
+            os.remove(self.db_path)
+        except FileNotFoundError:
+            pass
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.command = [sys.executable, '-c', self.SCRIPT]
+
+    def tearDown(self):
+        '''
+        '''
+        os.remove(self.db_path)
+
+    def rows(self):
+        ''' Returns the number of rows written.
+        '''
+        self.db.connect()
+        self.db.cur.execute("SELECT COUNT(*) FROM sensor_data")
+        count = self.db.cur.fetchone()[0]
+        self.db.close()
+        return count
+
+    def testBackoff(self):
+        ''' Delays double after short runs and reset after a healthy one.
+        '''
+        backoff = rtl_433_2sqlite.restartBackoff(1, 4, healthy=60)
+        self.assertEqual([backoff.delay(0) for _ in range(4)], [1, 2, 4, 4])
+        self.assertEqual(backoff.delay(60), 1)
+
+    def testReceiverProcess(self):
+        ''' rtl_433 is started again after it exits, and the gap between
+            its last line and the next one is counted.
+        '''
+        stdout_queue = Queue.Queue()
+        process = rtl_433_2sqlite.receiverProcess(
+                        rtl_433_2sqlite.receiver(None, self.command),
+                        self.rtl_pid, stdout_queue, Queue.Queue(),
+                        rtl_433_2sqlite.restartBackoff(0.01, 0.01))
+        process.start()
+        deadline = time.monotonic() + 10
+        while process.gaps.restarts < 2 and time.monotonic() < deadline:
+            self.assertFalse(process.eof())
+            time.sleep(0.01)
+        while stdout_queue.qsize() < 3 and time.monotonic() < deadline:
+            process.eof()
+            time.sleep(0.01)
+        process.eof()
+        process.stop()
+        self.assertEqual(process.gaps.restarts, 2)
+        self.assertGreater(process.gaps.seconds, 0)
+        self.assertEqual(stdout_queue.qsize(), 3)
+        self.assertFalse(os.path.exists(self.rtl_pid))
+
+    def testThreadEngine(self):
+        ''' The thread engine keeps restarting until it is interrupted,
+            then writes what it has read and cleans up.
+        '''
+        timer = threading.Timer(1.0, _thread.interrupt_main)
+        timer.start()
+        with patch('sys.stdout', new=io.StringIO()), \
+             patch('sys.stderr', new=io.StringIO()) as stderr:
+            rtl_433_2sqlite.startReceivers(
+                    [rtl_433_2sqlite.receiver('r1', self.command)], self.db,
+                    flush_interval=50, report_interval=None,
+                    dedup_window=0, restart=True, backoff=0.05,
+                    max_backoff=0.05, pid_dir='/tmp')
+        timer.join()
+        self.assertGreater(self.rows(), 2)
+        self.assertIn('restarting in 0.05 s', stderr.getvalue())
+        self.assertEqual([name for name in os.listdir('/tmp')
+                          if name.endswith('-r1.pid')], [])
+
+    def testAsyncEngine(self):
+        ''' The asyncio engine keeps restarting until it is cancelled.
+        '''
+        async def run():
+            try:
+                await asyncio.wait_for(
+                        rtl_433_2sqlite.asyncIngest(
+                            self.command, self.db, flush_interval=50,
+                            report_interval=None, dedup_window=0,
+                            backoff=rtl_433_2sqlite.restartBackoff(0.05,
+                                                                   0.05)),
+                        1.0)
+            except asyncio.TimeoutError:
+                pass
+        with patch('sys.stderr', new=io.StringIO()):
+            asyncio.run(run())
+        self.assertGreater(self.rows(), 2)
+        self.assertFalse(os.path.isfile('/tmp/rtl_433.pid'))
+
+class TestReplay(unittest.TestCase):
+    ''' Tests replaying captured rtl_433 output.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_replay_db.sqlite'
+        self.capture = '/tmp/test_replay.json'
+        try:
+            os.remove(self.db_path)
+        except FileNotFoundError:
+            pass
+        lines = ['{"time" : "@0.000000s", "model" : "WG-PB12V1", "id" : 8, '
+                 '"temperature_C" : 20.9, "io" : "1111"}',
+                 'garbled',
+                 '{"time" : "@0.100000s", "model" : "WG-PB12V1", "id" : 8, '
+                 '"temperature_C" : 20.9, "io" : "1111"}',
+                 '{"time" : "@0.300000s", "model" : "WG-PB12V1", "id" : 3, '
+                 '"temperature_C" : 18.2, "io" : "0000"}']
+        with open(self.capture, 'w') as capture:
+            capture.write('\n'.join(lines) + '\n')
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+
+    def tearDown(self):
+        '''
+        '''
+        os.remove(self.db_path)
+        os.remove(self.capture)
+
+    def testFullSpeed(self):
+        ''' Every line is read, the repeat and garbled line aren't stored.
+        '''
+        stats = rtl_433_2sqlite.replay(self.capture, self.db)
+        self.assertEqual(stats['lines'], 4)
+        self.assertEqual(stats['rows'], 2)
+        self.assertEqual(stats['parse_failures'], 1)
+        self.assertLess(stats['seconds'], 0.3)
+        self.assertGreater(stats['peak_rss_kb'], 0)
+        self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+
+    def testRecordedTime(self):
+        ''' Identical readings a minute apart aren't repeats, however fast
+            they are replayed.
+        '''
+        with open(self.capture, 'w') as capture:
+            for minute in range(200):
+                capture.write('{{"time" : "@{}.000000s", "model" : '
+                              '"WG-PB12V1", "id" : 8, "temperature_C" : '
+                              '20.9, "io" : "1111"}}\n'.format(minute * 60))
+        stats = rtl_433_2sqlite.replay(self.capture, self.db)
+        self.assertEqual(stats['rows'], 200)
+
+    def testRecordedHeartbeat(self):
+        ''' The deadband's heartbeat goes by the recorded times too.
+        '''
+        with open(self.capture, 'w') as capture:
+            for minute in range(30):
+                capture.write('{{"time" : "@{}.000000s", "model" : '
+                              '"WG-PB12V1", "id" : 8, "temperature_C" : '
+                              '20.9, "io" : "1111"}}\n'.format(minute * 60))
+        deadband = rtl_433_2sqlite.deadbandFilter()
+        stats = rtl_433_2sqlite.replay(self.capture, self.db,
+                                       deadband=deadband)
+        self.assertEqual(stats['rows'], 3)
+
+    def testChunked(self):
+        '''
+        '''
+        stats = rtl_433_2sqlite.replay(self.capture, self.db, chunk_size=16)
+        self.assertEqual(stats['lines'], 4)
+        self.assertEqual(stats['rows'], 2)
+        self.assertEqual(stats['parse_failures'], 1)
+
+    def testPaced(self):
+        ''' At the recorded pace the replay takes as long as the recording.
+        '''
+        stats = rtl_433_2sqlite.replay(self.capture, self.db, pace=True,
+                                       flush_interval=10)
+        self.assertGreaterEqual(stats['seconds'], 0.3)
+        self.assertEqual(stats['rows'], 2)
+
+    def testParseTime(self):
+        '''
+        '''
+        self.assertEqual(rtl_433_2sqlite.parseTime('@1.500000s'), 1.5)
+        self.assertEqual(rtl_433_2sqlite.parseTime('2017-10-01 12:00:01') - 
+                         rtl_433_2sqlite.parseTime('2017-10-01 12:00:00'), 1)
+        self.assertEqual(rtl_433_2sqlite.parseTime('soon'), None)
+
+class TestAsyncIngest(unittest.TestCase):
+    ''' Tests the asyncio engine against a real child process.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_async_db.sqlite'
+        try:
+            os.remove(self.db_path)
+        except FileNotFoundError:
+            pass
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+
+    def tearDown(self):
+        '''
+        '''
+        os.remove(self.db_path)
+
+    def testGoodBadGoodResponse(self):
+        ''' Good lines are written, garbled ones are skipped and the child's
+            stderr doesn't stop the engine.
+        '''
+        script = ('import sys\n'
+                  'good = \'{"model" : "WG-PB12V1", "id" : 8, '
+                  '"temperature_C" : 20.9, "io" : "1111"}\'\n'
+                  'print(good); print("garbled {"); print(good)\n'
+                  'sys.stderr.write("Found 1 device(s)\\n")\n')
+        command = [sys.executable, '-c', script]
+        asyncio.run(rtl_433_2sqlite.asyncIngest(command, self.db,
+                                                flush_interval=50,
+                                                report_interval=None,
+                                                dedup_window=0))
+        self.db.connect()
+        self.db.cur.execute("SELECT sensorID, temperature_C FROM sensor_data")
+        self.assertEqual(self.db.cur.fetchall(), [(8, 20.9), (8, 20.9)])
+        self.db.close()
+        self.assertFalse(os.path.isfile('/tmp/rtl_433.pid'))
+
+    def testWriterFails(self):
+        ''' If the writer fails while rtl_433 is being restarted, reading
+            stops and the error is raised.
+        '''
+        script = ('print(\'{"model" : "WG-PB12V1", "id" : 8, '
+                  '"temperature_C" : 20.9}\'); exit(1)')
+        latest = Mock()
+        latest.update.side_effect = RuntimeError('broken')
+        with patch('sys.stderr', new=io.StringIO()):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(asyncio.wait_for(
+                        rtl_433_2sqlite.asyncIngest(
+                            [sys.executable, '-c', script], self.db,
+                            flush_interval=50, report_interval=None,
+                            backoff=rtl_433_2sqlite.restartBackoff(0.01,
+                                                                   0.01),
+                            latest=latest),
+                        10))
+        self.assertFalse(os.path.isfile('/tmp/rtl_433.pid'))
+
+    def testOldDatabase(self):
+        ''' A database that needs migrating is written to, and migrated,
+            from the worker thread.
+        '''
+        self.db.close()
+        os.remove(self.db_path)
+        old = sq.connect(self.db_path)
+        old.execute('''CREATE TABLE sensor_data
+                       (id integer, date text, sensorID int,
+                        temperature_C float, io text)''')
+        old.execute('CREATE TABLE current_id (max_id int)')
+        old.execute("INSERT INTO sensor_data VALUES (0, ?, 8, 20.0, '1')",
+                    ('2017-10-01 12:00:00',))
+        old.execute('INSERT INTO current_id VALUES (1)')
+        old.commit()
+        old.close()
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        script = ('print(\'{"model" : "WG-PB12V1", "id" : 3, '
+                  '"temperature_C" : 18.5}\')\n')
+        asyncio.run(rtl_433_2sqlite.asyncIngest([sys.executable, '-c', script],
+                                                self.db, flush_interval=50,
+                                                report_interval=None))
+        self.db.connect()
+        self.db.cur.execute("SELECT sensorID FROM sensor_data ORDER BY rowid")
+        self.assertEqual(self.db.cur.fetchall(), [(8,), (3,)])
+        # The rebuild was started after the commit.
+        self.db.cur.execute('''SELECT name FROM sqlite_master
+                               WHERE name='rebuild_state';''')
+        self.assertEqual(self.db.cur.fetchall(), [('rebuild_state',)])
+        self.db.close()
+
+    def testSpill(self):
+        ''' Readings that don't fit on the queue are spilled and still
+            written in order.
+        '''
+        script = ('for n in range(50):\n'
+                  '    print(\'{"model" : "WG-PB12V1", "id" : %d, '
+                  '"temperature_C" : 20.9}\' % n)\n')
+        command = [sys.executable, '-c', script]
+        journal = rtl_433_2sqlite.spillJournal('/tmp/test_async_spill')
+        asyncio.run(rtl_433_2sqlite.asyncIngest(command, self.db,
+                                                flush_interval=50,
+                                                report_interval=None,
+                                                queue_size=1,
+                                                journal=journal))
+        self.assertTrue(journal.spilled > 0)
+        journal.close()
+        self.assertFalse(os.path.exists('/tmp/test_async_spill'))
+        self.db.connect()
+        self.db.cur.execute("SELECT sensorID FROM sensor_data ORDER BY id")
+        self.assertEqual([row[0] for row in self.db.cur.fetchall()],
+                         list(range(50)))
+        self.db.close()
+
+    def testGarbledJournal(self):
+        ''' A journal left by the thread engine, which spills lines before
+            they are parsed, may hold garbled lines. They are skipped.
+        '''
+        path = '/tmp/test_async_spill'
+        journal = rtl_433_2sqlite.spillJournal(path)
+        journal.append(1506000000000, b'garbled {\n')
+        journal.append(1506000001000, b'{"model" : "WG-PB12V1", "id" : 8, '
+                                      b'"temperature_C" : 20.9}\n', 'rx')
+        journal.close()
+        journal = rtl_433_2sqlite.spillJournal(path)
+        metrics = rtl_433_2sqlite.pipelineMetrics()
+        asyncio.run(rtl_433_2sqlite.asyncIngest([sys.executable, '-c', ''],
+                                                self.db, flush_interval=50,
+                                                report_interval=None,
+                                                journal=journal,
+                                                metrics=metrics))
+        journal.close()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(metrics.parse_failures.value, 1)
+        self.db.connect()
+        self.db.cur.execute("SELECT date, sensorID, receiver FROM sensor_data")
+        (date, sensor, receiver), = self.db.cur.fetchall()
+        self.db.close()
+        # Dates go through time.monotonic() and back.
+        self.assertAlmostEqual(date, 1506000001000, delta=100)
+        self.assertEqual((sensor, receiver), (8, 'rx'))
+
+
+class TestFakeRTL433(unittest.TestCase):
+    ''' Runs both engines against fake_rtl_433.py.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_fake_db.sqlite'
+        self.fake = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'fake_rtl_433.py')
+
+    def tearDown(self):
+        '''
+        '''
+        self.removeDatabase()
+
+    def removeDatabase(self):
+        ''' Removes the database and its WAL files.
+        '''
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.db_path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def testEngines(self):
+        ''' Every model is written, repeats are dropped and garbled lines
+            and stderr noise are survived.
+        '''
+        environment = {'FAKE_RTL_433_COUNT' : '200',
+                       'FAKE_RTL_433_RATE' : '0',
+                       'FAKE_RTL_433_REPEATS' : '3',
+                       'FAKE_RTL_433_GARBLE' : '0.05',
+                       'FAKE_RTL_433_STDERR_NOISE' : '0.1'}
+        for name, engine in sorted(rtl_433_2sqlite.ENGINES.items()):
+            with self.subTest(engine=name), \
+                 patch.dict(os.environ, environment), \
+                 patch('sys.stdout', new=io.StringIO()), \
+                 patch('sys.stderr', new=io.StringIO()):
+                self.removeDatabase()
+                db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+                engine(self.fake, db, PIDFILE='/tmp/test_fake.pid',
+                       flush_interval=50, report_interval=None)
+                db.connect()
+                db.cur.execute("SELECT COUNT(*) FROM sensor_data")
+                rows = db.cur.fetchone()[0]
+                db.cur.execute("SELECT DISTINCT model FROM sensor_data")
+                models = set(row[0] for row in db.cur.fetchall())
+                db.close()
+                self.assertTrue(0 < rows <= 200)
+                self.assertEqual(len(models), 4)
+
 
 if __name__ == "__main__":
     unittest.main()
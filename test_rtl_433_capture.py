@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the rtl_433_capture.py
+# Ciarán Mooney 2017
+
+import unittest
+from unittest.mock import patch
+
+import glob
+import os
+import queue as Queue
+import time
+
+import rtl_433_capture
+
+class TestCaptureWriter(unittest.TestCase):
+    ''' Tests the captureWriter class.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.path = '/tmp/test_capture.json'
+        self.tearDown()
+
+    def tearDown(self):
+        '''
+        '''
+        for path in glob.glob(self.path + '*'):
+            os.remove(path)
+
+    def testAppend(self):
+        ''' Lines are appended, bytes or str, to what is already there.
+        '''
+        with open(self.path, 'wb') as capture:
+            capture.write(b'old\n')
+        writer = rtl_433_capture.captureWriter(self.path)
+        writer.write(b'{"id" : 1}\n')
+        writer.write('{"id" : 2}\n')
+        writer.close()
+        writer.close()
+        with open(self.path, 'rb') as capture:
+            self.assertEqual(capture.read(),
+                             b'old\n{"id" : 1}\n{"id" : 2}\n')
+        self.assertEqual(writer.report(),
+                         "capture: 2 lines, 0 dropped, 0 rotations")
+
+    def testSeveralLines(self):
+        ''' A chunk of lines is counted, and dropped, as its lines.
+        '''
+        writer = rtl_433_capture.captureWriter(self.path)
+        writer.write(b'one\ntwo\n')
+        with patch.object(writer._queue, 'put_nowait',
+                          side_effect=Queue.Full):
+            writer.write(b'three\nfour')
+        writer.close()
+        self.assertEqual((writer.lines, writer.dropped), (2, 2))
+
+    def testRotateBySize(self):
+        ''' Segments are compressed and can be read back with openCapture.
+        '''
+        writer = rtl_433_capture.captureWriter(self.path, max_bytes=20,
+                                               compress='gzip')
+        for n in range(5):
+            writer.write('{{"id" : {}}}\n'.format(n).encode())
+        writer.close()
+        segments = sorted(glob.glob(self.path + '.*.gz'))
+        self.assertEqual(writer.rotations, 2)
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(glob.glob(self.path + '.*Z'), [])
+        lines = []
+        for segment in segments + [self.path]:
+            with rtl_433_capture.openCapture(segment) as capture:
+                lines.extend(capture.readlines())
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0], b'{"id" : 0}\n')
+
+    def testRotateByTime(self):
+        ''' An empty file isn't rotated.
+        '''
+        writer = rtl_433_capture.captureWriter(self.path, max_seconds=0.05,
+                                               flush_interval=0.01)
+        writer.write(b'one\n')
+        time.sleep(0.2)
+        writer.close()
+        self.assertEqual(writer.rotations, 1)
+        self.assertFalse(os.path.exists(self.path))
+
+    def testDropWhenFull(self):
+        ''' write() never waits for the disk.
+        '''
+        writer = rtl_433_capture.captureWriter(self.path, backlog=1)
+        with patch.object(writer._queue, 'put_nowait',
+                          side_effect=Queue.Full):
+            writer.write(b'dropped\n')
+        self.assertEqual(writer.dropped, 1)
+        writer.close()
+
+    def testZstdNeedsZstandard(self):
+        '''
+        '''
+        try:
+            import zstandard
+        except ImportError:
+            with self.assertRaises(RuntimeError):
+                rtl_433_capture.captureWriter(self.path, compress='zstd')
+        with self.assertRaises(ValueError):
+            rtl_433_capture.captureWriter(self.path, compress='bzip2')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the rtl_433_export.py
+# Ciarán Mooney 2017
+
+import unittest
+
+import contextlib
+import importlib.util
+import math
+import sqlite3 as sq
+import os
+
+import rtl_433_2sqlite
+import rtl_433_export
+
+HAVE_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+class TestExport(unittest.TestCase):
+    ''' Tests exporting a small database.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_export_db.sqlite'
+        self.out = '/tmp/test_export.npy'
+        self.state = '/tmp/test_export.state'
+        self.tearDown()
+        self.database = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        self.write(0)
+        self.pool = self.database.read_pool(size=1)
+
+    def write(self, first):
+        rows = []
+        timestamps = []
+        for minute in range(first, first + 10):
+            for sensor in (3, 8):
+                rows.append({"model" : "WG-PB12V1", "id" : sensor,
+                             "temperature_C" : 20.0 + minute})
+                timestamps.append(60000 * minute)
+        rows.append({"model" : "WG-PB12V1", "id" : 9})
+        timestamps.append(60000 * first)
+        self.database.write_many(rows, timestamps)
+
+    def tearDown(self):
+        '''
+        '''
+        if hasattr(self, 'pool'):
+            self.pool.close()
+            self.database.close()
+        for path in (self.db_path, self.db_path + '-wal',
+                     self.db_path + '-shm', self.out, self.state,
+                     '/tmp/test_export.parquet'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def testChunks(self):
+        ''' Chunks are at most chunk_size rows, in the order written.
+        '''
+        chunks = list(rtl_433_export.fetchChunks(self.pool, chunk_size=6))
+        self.assertEqual([len(chunk) for chunk in chunks], [6, 6, 6, 3])
+        ids = [row[0] for chunk in chunks for row in chunk]
+        self.assertEqual(ids, sorted(ids))
+
+    def testNpy(self):
+        ''' NULL temperatures come out as NaN.
+        '''
+        self.assertEqual(rtl_433_export.export(self.pool, self.out,
+                                               chunk_size=4), 21)
+        self.assertEqual(os.path.getsize(self.out), 192 + 21 * 24)
+        descr, rows = rtl_433_export.readNpy(self.out)
+        self.assertEqual(descr, rtl_433_export.npyWriter.DTYPE)
+        self.assertEqual(rows[0], (0, 3, 20.0))
+        self.assertTrue(math.isnan(rows[-1][2]))
+
+    def testFilters(self):
+        '''
+        '''
+        rtl_433_export.export(self.pool, self.out, start=60000, end=180000,
+                              sensors=[8])
+        descr, rows = rtl_433_export.readNpy(self.out)
+        self.assertEqual(rows, [(60000, 8, 21.0), (120000, 8, 22.0)])
+
+    def testIncremental(self):
+        ''' A second export only has the rows written since the first.
+        '''
+        self.assertEqual(rtl_433_export.export(self.pool, self.out,
+                                               state_path=self.state), 21)
+        self.write(10)
+        self.assertEqual(rtl_433_export.export(self.pool, self.out,
+                                               state_path=self.state), 21)
+        descr, rows = rtl_433_export.readNpy(self.out)
+        self.assertEqual(rows[0], (600000, 3, 30.0))
+        self.assertEqual(rtl_433_export.export(self.pool, self.out,
+                                               state_path=self.state), 0)
+
+    def testUnknownFormat(self):
+        '''
+        '''
+        with self.assertRaises(ValueError):
+            rtl_433_export.export(self.pool, '/tmp/test_export.csv')
+
+    @unittest.skipUnless(HAVE_PYARROW, "needs pyarrow")
+    def testParquet(self):
+        '''
+        '''
+        import pyarrow.parquet
+        path = '/tmp/test_export.parquet'
+        rtl_433_export.export(self.pool, path, chunk_size=8)
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.num_rows, 21)
+        self.assertEqual(table.column_names, list(rtl_433_export.COLUMNS))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the rtl_433_latest.py
+# Ciarán Mooney 2017
+
+import unittest
+
+import os
+import threading
+
+import rtl_433_2sqlite
+import rtl_433_latest
+
+class TestServe(unittest.TestCase):
+    ''' Tests serving a latestCache and talking to it with latestClient.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.path = '/tmp/test_latest.sock'
+        self.cache = rtl_433_2sqlite.latestCache()
+        self.cache.update([{"model" : "WG-PB12V1", "id" : 8,
+                            "temperature_C" : 20.5}], [1000])
+        self.server = rtl_433_latest.serve(self.cache, self.path)
+        self.client = rtl_433_latest.latestClient(self.path)
+
+    def tearDown(self):
+        '''
+        '''
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testRequests(self):
+        ''' Requests can follow each other on one connection.
+        '''
+        self.assertEqual(self.client.latest(8)['temperature_C'], 20.5)
+        self.assertEqual(self.client.latest(3), None)
+        self.assertEqual([r['sensorID'] for r in self.client.all()], [8])
+        with self.assertRaises(ValueError):
+            self.client._request('latest eight')
+        with self.assertRaises(ValueError):
+            self.client._request('newest 8')
+        self.assertEqual(self.client.latest(8)['date'], 1000)
+
+    def testSubscribe(self):
+        ''' Updates are pushed until the server is closed.
+        '''
+        readings = []
+        updates = self.client.subscribe([3])
+
+        def read():
+            for reading in updates:
+                readings.append(reading)
+        # The subscription is made once the request has been read.
+        thread = threading.Thread(target=read)
+        thread.start()
+        while not self.cache.subscribers():
+            thread.join(0.01)
+        self.cache.update([{"id" : 8, "temperature_C" : 1.0},
+                           {"id" : 3, "temperature_C" : 2.0}], [2000, 2000])
+        self.server.shutdown()
+        self.server.server_close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([(r['sensorID'], r['temperature_C'])
+                          for r in readings], [(3, 2.0)])
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the rtl_433_metrics.py
+# Ciarán Mooney 2017
+
+import unittest
+
+import http.client
+import os
+import socket
+
+import rtl_433_metrics
+
+class TestRegistry(unittest.TestCase):
+    ''' Tests the registry and its metrics.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.registry = rtl_433_metrics.registry()
+
+    def testCounterAndGauge(self):
+        ''' Counters add up, gauges are set, either can read a function.
+        '''
+        lines = self.registry.counter('lines_total', 'Lines.')
+        lines.inc()
+        lines.inc(2)
+        self.registry.gauge('depth', 'Depth.', lambda: 7)
+        self.assertEqual(self.registry.get('lines_total'), 3)
+        self.assertEqual(self.registry.get('depth'), 7)
+        self.assertEqual(self.registry.render(),
+                         '# HELP lines_total Lines.\n'
+                         '# TYPE lines_total counter\n'
+                         'lines_total 3\n'
+                         '# HELP depth Depth.\n'
+                         '# TYPE depth gauge\n'
+                         'depth 7\n')
+
+    def testHistogram(self):
+        ''' Buckets are cumulative and end with +Inf.
+        '''
+        rows = self.registry.histogram('rows', 'Rows.', (1, 10))
+        for value in (1, 5, 50):
+            rows.observe(value)
+        self.assertEqual(self.registry.render().splitlines()[2:],
+                         ['rows_bucket{le="1"} 1',
+                          'rows_bucket{le="10"} 2',
+                          'rows_bucket{le="+Inf"} 3',
+                          'rows_sum 56',
+                          'rows_count 3'])
+
+class TestServe(unittest.TestCase):
+    ''' Tests serving a registry over TCP and a Unix socket.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.registry = rtl_433_metrics.registry()
+        self.registry.counter('lines_total', 'Lines.').inc(4)
+
+    def testTCP(self):
+        '''
+        '''
+        server = rtl_433_metrics.serve(self.registry, '127.0.0.1:0')
+        try:
+            connection = http.client.HTTPConnection(*server.server_address)
+            connection.request('GET', '/metrics')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertIn(b'lines_total 4\n', response.read())
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testUnixSocket(self):
+        '''
+        '''
+        path = '/tmp/test_metrics.sock'
+        server = rtl_433_metrics.serve(self.registry, path)
+        try:
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(path)
+            client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                response += data
+            client.close()
+            self.assertTrue(response.startswith(b'HTTP/1.0 200'))
+            self.assertIn(b'lines_total 4\n', response)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
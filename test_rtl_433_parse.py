@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the rtl_433_parse.py
+# Ciarán Mooney 2017
+
+import unittest
+
+import json
+
+import rtl_433_parse
+
+def reading(model, sensor):
+    ''' Returns an rtl_433 JSON line.
+    '''
+    return (json.dumps({"time" : "@0.000000s", "model" : model, "id" : sensor,
+                        "temperature_C" : 20.9}) + '\n').encode('utf-8')
+
+class TestLineParser(unittest.TestCase):
+    ''' Tests the lineParser class, with each backend that is installed.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.backends = ['json']
+        try:
+            rtl_433_parse.loader('orjson')
+            self.backends.append('orjson')
+        except RuntimeError:
+            pass
+
+    def testBatch(self):
+        ''' Garbled lines anywhere in a batch only lose themselves, and the
+            readings come out in order.
+        '''
+        lines = [reading('WG-PB12V1', n) for n in range(20)]
+        lines[0] = b'{"model" : "WG-PB\n'
+        lines[7] = b'{"time" : "@0.000000s", "model" : \n'
+        lines[8] = b'[1,\n'
+        lines[9] = b'2]\n'
+        lines[15] = b'\xff\n'
+        lines[19] = b'"WG-PB12V1"\n'
+        for backend in self.backends:
+            with self.subTest(backend=backend):
+                parser = rtl_433_parse.lineParser(backend=backend)
+                readings = parser.parse(lines)
+                self.assertEqual([data['id'] for data in readings],
+                                 [n for n in range(20)
+                                  if n not in (0, 7, 8, 9, 15, 19)])
+                self.assertEqual(parser.failures, 6)
+                self.assertEqual(parser.backend, backend)
+                self.assertEqual(parser.parse([lines[1]])[0]['id'], 1)
+
+    def testGarbledBatch(self):
+        ''' A large batch of garbled lines neither recurses nor rejoins
+            the whole batch for each of them.
+        '''
+        lines = [b'garbled %d\n' % n for n in range(5000)]
+        lines[2500] = reading('WG-PB12V1', 8)
+        for backend in self.backends:
+            with self.subTest(backend=backend):
+                parser = rtl_433_parse.lineParser(backend=backend)
+                calls = []
+                loads = parser.loads
+                parser.loads = lambda line: calls.append(line) or loads(line)
+                readings = parser.parse(lines)
+                self.assertEqual([data['id'] for data in readings], [8])
+                self.assertEqual(parser.failures, 4999)
+                self.assertLess(sum(len(line) for line in calls),
+                                20 * sum(len(line) for line in lines))
+
+    def testModels(self):
+        ''' Other models are dropped, even if the name turns up elsewhere.
+        '''
+        lines = [reading('WG-PB12V1', 8), reading('Acurite-Tower', 3),
+                 b'{"model" : "Acurite-Tower", "note" : "WG-PB12V1"}\n',
+                 b'garbled "WG-PB12V1"\n']
+        for backend in self.backends:
+            with self.subTest(backend=backend):
+                parser = rtl_433_parse.lineParser(['WG-PB12V1'], backend)
+                readings = parser.parse(lines)
+                self.assertEqual([data['id'] for data in readings], [8])
+                self.assertEqual((parser.lines, parser.filtered,
+                                  parser.failures), (4, 2, 1))
+                self.assertEqual(parser.report(),
+                                 "parser: 4 lines, 2 filtered, 1 failures, "
+                                 + backend)
+
+    def testLoader(self):
+        '''
+        '''
+        self.assertIs(rtl_433_parse.loader('json'), json.loads)
+        self.assertEqual(rtl_433_parse.lineParser().backend,
+                         self.backends[-1])
+        with self.assertRaises(ValueError):
+            rtl_433_parse.loader('simplejson')
+        if 'orjson' not in self.backends:
+            with self.assertRaises(RuntimeError):
+                rtl_433_parse.loader('orjson')
+
+
+if __name__ == "__main__":
+    unittest.main()
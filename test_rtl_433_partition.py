@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the rtl_433_partition.py
+# Ciarán Mooney 2017
+
+import unittest
+
+from datetime import datetime, timezone
+import glob
+import sqlite3 as sq
+import os
+
+import rtl_433_2sqlite
+import rtl_433_partition
+
+def millis(*date):
+    return int(datetime(*date, tzinfo=timezone.utc).timestamp() * 1000)
+
+class TestPeriods(unittest.TestCase):
+    ''' Tests working out partition starts and names.
+    '''
+
+    def testStarts(self):
+        '''
+        '''
+        when = millis(2017, 12, 20, 13, 5)
+        self.assertEqual(rtl_433_partition.partitionStart(when, 'day'),
+                         millis(2017, 12, 20))
+        self.assertEqual(rtl_433_partition.partitionStart(when, 'week'),
+                         millis(2017, 12, 18))
+        self.assertEqual(rtl_433_partition.partitionStart(when, 'month'),
+                         millis(2017, 12, 1))
+        self.assertEqual(rtl_433_partition.nextPartition(millis(2017, 12, 1)),
+                         millis(2018, 1, 1))
+        with self.assertRaises(ValueError):
+            rtl_433_partition.partitionStart(when, 'fortnight')
+
+    def testPath(self):
+        '''
+        '''
+        self.assertEqual(rtl_433_partition.partitionPath(
+                            '/tmp/temp.sqlite', millis(2017, 10, 1)),
+                         '/tmp/temp-2017-10.sqlite')
+        self.assertEqual(rtl_433_partition.partitionPath(
+                            '/tmp/temp.sqlite', millis(2017, 12, 18), 'week'),
+                         '/tmp/temp-2017-W51.sqlite')
+
+class TestPartitionedDatabase(unittest.TestCase):
+    ''' Tests writing across a month boundary and querying it back.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_partition_db.sqlite'
+        self.tearDown()
+        self.db = rtl_433_partition.partitionedDatabase(sq, self.db_path)
+        rows = []
+        timestamps = []
+        # An hour either side of midnight at the end of each month.
+        for start in (millis(2017, 10, 31, 23), millis(2017, 11, 30, 23)):
+            for minute in range(0, 120, 30):
+                rows.append({"model" : "WG-PB12V1", "id" : 8,
+                             "temperature_C" : 20.0 + minute / 30,
+                             "io" : "1"})
+                timestamps.append(start + 60000 * minute)
+        self.db.write_many(rows, timestamps)
+        self.db.close()
+        self.query = rtl_433_partition.partitionQuery(sq, self.db_path)
+
+    def tearDown(self):
+        '''
+        '''
+        base = os.path.splitext(self.db_path)[0]
+        for path in glob.glob(base + '*'):
+            os.remove(path)
+
+    def testRotation(self):
+        ''' A file for each month the rows fell in.
+        '''
+        self.assertEqual([os.path.basename(path) for start, path in
+                          rtl_433_partition.partitions(self.db_path)],
+                         ['test_partition_db-2017-10.sqlite',
+                          'test_partition_db-2017-11.sqlite',
+                          'test_partition_db-2017-12.sqlite'])
+        db = sq.connect('/tmp/test_partition_db-2017-11.sqlite')
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM sensor_data')
+                           .fetchone()[0], 4)
+        db.close()
+
+    def testMigrated(self):
+        ''' New partitions start at the current schema version.
+        '''
+        db = rtl_433_partition.partitionedDatabase(sq, self.db_path)
+        self.assertTrue(db.migrated)
+        self.assertTrue(db.migrate_step())
+        db.partition(millis(2017, 11, 1))
+        self.assertTrue(db.migrated)
+        self.assertEqual(db.partition(millis(2017, 11, 1)).schema_version(),
+                         rtl_433_2sqlite.initDatabase.SCHEMA_VERSION)
+        db.close()
+
+    def testOnlyNeededPartitions(self):
+        '''
+        '''
+        found = rtl_433_partition.partitions(self.db_path, 'month',
+                                             millis(2017, 11, 1),
+                                             millis(2017, 11, 30, 12))
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0][0], millis(2017, 11, 1))
+
+    def testQuery(self):
+        ''' Ranges and rollups span partitions, the others search back.
+        '''
+        readings = self.query.range(8, millis(2017, 10, 31, 23, 30),
+                                    millis(2017, 12, 1, 0, 1))
+        self.assertEqual(len(readings), 6)
+        self.assertEqual([r.date for r in readings],
+                         sorted(r.date for r in readings))
+        hours = self.query.rollup(8, millis(2017, 10, 31, 23),
+                                  millis(2017, 11, 1, 1))
+        self.assertEqual([h.count for h in hours], [2, 2])
+        self.assertEqual(self.query.latest(8).date,
+                         millis(2017, 12, 1, 0, 30))
+        self.assertEqual(self.query.value_at(8, millis(2017, 11, 15)).date,
+                         millis(2017, 11, 1, 0, 30))
+        self.assertEqual([r.sensorID for r in self.query.latest_all()], [8])
+
+    def testDropPartitions(self):
+        '''
+        '''
+        dropped = rtl_433_partition.dropPartitions(self.db_path,
+                                                   millis(2017, 11, 15))
+        self.assertEqual([os.path.basename(path) for path in dropped],
+                         ['test_partition_db-2017-10.sqlite'])
+        self.assertEqual(len(rtl_433_partition.partitions(self.db_path)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the rtl_433_query.py
+# Ciarán Mooney 2017
+
+import unittest
+
+from datetime import datetime
+import sqlite3 as sq
+import os
+
+import rtl_433_2sqlite
+import rtl_433_query
+
+class TestSensorQuery(unittest.TestCase):
+    ''' Tests the sensorQuery class against a small database.
+    '''
+
+    def setUp(self):
+        '''
+        '''
+        self.db_path = '/tmp/test_query_db.sqlite'
+        try:
+            os.remove(self.db_path)
+        except FileNotFoundError:
+            pass
+        self.db = rtl_433_2sqlite.initDatabase(sq, self.db_path)
+        rows = []
+        timestamps = []
+        for minute in range(10):
+            for sensor in (3, 8):
+                rows.append({"model" : "WG-PB12V1", "id" : sensor,
+                             "temperature_C" : 20.0 + minute, "io" : "1"})
+                timestamps.append(60000 * minute)
+        self.db.write_many(rows, timestamps)
+        self.db.close()
+        self.pool = self.db.read_pool()
+        self.query = rtl_433_query.sensorQuery(self.pool)
+
+    def tearDown(self):
+        '''
+        '''
+        self.pool.close()
+        os.remove(self.db_path)
+
+    def testLatest(self):
+        '''
+        '''
+        latest = self.query.latest(8)
+        self.assertEqual(latest.date, 540000)
+        self.assertEqual(latest.temperature_C, 29.0)
+        self.assertEqual(self.query.latest(99), None)
+
+    def testIO(self):
+        ''' io is unpacked whether it was stored packed or as text.
+        '''
+        self.assertEqual(self.query.latest(8).io, '1')
+        self.db.connect()
+        with self.db.db:
+            self.db.cur.execute("UPDATE sensor_data SET io = '0110' "
+                                "WHERE sensorID = 8")
+        self.db.close()
+        self.assertEqual(self.query.latest(8).io, '0110')
+        for io in ('', '0', '1' * 48, '0' * 9 + '1', '1' * 65535, 'f00d',
+                   None):
+            with self.subTest(io=io and io[:10]):
+                packed = rtl_433_2sqlite.packIO(io)
+                self.assertEqual(rtl_433_query.unpackIO(packed), io)
+        self.assertEqual(len(rtl_433_2sqlite.packIO('1' * 48)), 8)
+        self.assertEqual(rtl_433_2sqlite.packIO('1' * 65536), '1' * 65536)
+
+    def testRange(self):
+        ''' start is included and end isn't.
+        '''
+        readings = self.query.range(3, 60000, 180000)
+        self.assertEqual([r.date for r in readings], [60000, 120000])
+        self.assertEqual(set(r.sensorID for r in readings), set([3]))
+
+    def testStep(self):
+        ''' The reading in force at start is carried in.
+        '''
+        self.assertEqual(self.query.value_at(8, 90000).date, 60000)
+        self.assertEqual(self.query.value_at(8, -1), None)
+        readings = self.query.step(8, 90000, 200000)
+        self.assertEqual([r.date for r in readings], [60000, 120000, 180000])
+        readings = self.query.step(8, 120000, 200000)
+        self.assertEqual([r.date for r in readings], [120000, 180000])
+
+    def testRollup(self):
+        ''' The setUp readings are one a minute, so each minute holds one
+            and the hour all ten.
+        '''
+        minutes = self.query.rollup(8, 0, 180000, 'minute')
+        self.assertEqual([(r.bucket, r.mean) for r in minutes],
+                         [(0, 20.0), (60000, 21.0), (120000, 22.0)])
+        hours = self.query.rollup(8, 0, 3600000)
+        self.assertEqual(hours, [rtl_433_query.rollup(0, 10, 20.0, 24.5, 29.0)])
+
+    def testLatestAll(self):
+        '''
+        '''
+        readings = self.query.latest_all()
+        self.assertEqual([(r.sensorID, r.date) for r in readings],
+                         [(3, 540000), (8, 540000)])
+
+    def testToMillis(self):
+        '''
+        '''
+        when = datetime(2017, 10, 1, 12)
+        self.assertEqual(rtl_433_query.toMillis(when),
+                         int(when.timestamp()) * 1000)
+        self.assertEqual(rtl_433_query.toMillis(1234), 1234)
+
+
+if __name__ == "__main__":
+    unittest.main()